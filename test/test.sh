@@ -387,7 +387,8 @@ else
     sleep 1
     set -x
     #curl -k -o $tids.out "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42"
-    wget "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42" -O $tids.out
+    wget "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42" -O $tids.out && \
+        curl -s "http://localhost:$Port/templates/test.tmpl?title=T&arg1=%7Bsysdir%7D&arg2=42" | grep -F 'arg1 = {sysdir}'
     st=$?
     set +x
     if (( $st )) ; then
@@ -405,6 +406,624 @@ fi
 
 kill_webserver $Port
 
+# ================================================================
+# Test 012 - worker thread pool test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --workers 4 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    wget http://localhost:$Port -O $tids.out
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "wget"
+    else
+        diff $tids.out test001.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            set -x
+            wget http://localhost:$Port/webserver/info -O $tids.out
+            set +x
+            grep 'workers_busy' $tids.out
+            if (( $? )) ; then
+                test_failed $tid "grep"
+            else
+                test_passed $tid
+                rm -f $tids.out $tids.diff
+            fi
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 013 - pre-fork worker process test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --processes 2 \
+           --reuseport \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    wget http://localhost:$Port -O $tids.out
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "wget"
+    else
+        diff $tids.out test001.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 014 - event engine test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --engine event \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    wget "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42" -O $tids.out
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "wget"
+    else
+        diff $tids.out test011.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 015 - range request test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -r 100-199 -o $tids.out http://localhost:$Port/webserver.png
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        head -c 200 $RootDir/www/webserver.png | tail -c 100 | cmp - $tids.out >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 016 - conditional request test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    ETag=$(curl -s -D - -o /dev/null http://localhost:$Port/webserver.png | grep -i '^etag:' | cut -d' ' -f2 | tr -d '\r')
+    curl -s -o /dev/null -w '%{http_code}\n' -H "If-None-Match: $ETag" http://localhost:$Port/webserver.png >$tids.out
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        echo 304 | diff - $tids.out >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 017 - file cache test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --file-cache-size 1m \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -o /dev/null http://localhost:$Port/webserver.png && \
+        curl -s -o $tids.out http://localhost:$Port/webserver.png && \
+        curl -s http://localhost:$Port/webserver/info | grep -E 'file_cache_hits +1$'
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        cmp $RootDir/www/webserver.png $tids.out >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 018 - compression test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --file-cache-size 1m \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -D - -H 'Accept-Encoding: gzip' -o /dev/null http://localhost:$Port/webserver.css | grep -i '^content-encoding: gzip' && \
+        curl -s --compressed -o $tids.out http://localhost:$Port/webserver.css
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        cmp $RootDir/www/webserver.css $tids.out >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 019 - template worker process pool test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+rm -rf $tids.www
+mkdir -p $tids.www/templates
+cp $RootDir/www/templates/test.tmpl $tids.www/templates/
+cat >$tids.www/templates/loop.tmpl <<EOF
+<!-- python
+while True: pass
+-->
+{title}
+EOF
+cat >$tids.www/templates/error.tmpl <<EOF
+<!-- python
+raise ValueError('template error')
+-->
+{title}
+EOF
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $TestDir/$tids.www \
+           --template-workers 2 \
+           --template-timeout 2 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    wget "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42" -O $tids.out
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "wget"
+    else
+        # A fragment that exceeds a limit fails with 503 and a
+        # fragment that fails with 500.
+        set -x
+        limit=$(curl -s -o /dev/null -w '%{http_code}' "http://localhost:$Port/templates/loop.tmpl")
+        error=$(curl -s -o /dev/null -w '%{http_code}' "http://localhost:$Port/templates/error.tmpl")
+        set +x
+        diff $tids.out test011.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        elif [[ "$limit" != "503" || "$error" != "500" ]] ; then
+            test_failed $tid "status $limit $error"
+        else
+            test_passed $tid
+            rm -rf $tids.out $tids.diff $tids.www
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 020 - precompiled template test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+rm -rf $tids.dir
+set -x
+$Webserver --webdir $RootDir/www --template-compile-dir $tids.dir --precompile
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "precompile"
+else
+    # The server loads all of the precompiled templates when it
+    # starts so the request does not parse or load the template.
+    set -x
+    $Webserver --extra "testid=$tids" \
+               --port $Port \
+               --webdir $RootDir/www \
+               --template-compile-dir $tids.dir \
+               --precompile-on-start \
+               -L debug &
+    sleep 2
+    wget "http://localhost:$Port/templates/test.tmpl?title=Template%20Test&arg1=foo&arg2=42" -O $tids.out && \
+        curl -s http://localhost:$Port/webserver/info >$tids.info && \
+        grep -E 'template_compile_misses +0$' $tids.info && \
+        grep -E 'template_compile_hits +[1-9][0-9]*$' $tids.info && \
+        grep -E 'template_cache_hits +1$' $tids.info
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "wget"
+    else
+        diff $tids.out test011.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -rf $tids.out $tids.diff $tids.info $tids.dir
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 021 - executed script output cache test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --exec-cache-ttl 60 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -o /dev/null "http://localhost:$Port/scripts/script.sh!" && \
+        curl -s -o $tids.out "http://localhost:$Port/scripts/script.sh!" && \
+        curl -s http://localhost:$Port/webserver/info | grep -E 'exec_cache_hits +1$'
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        diff $tids.out test005.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 022 - command executor test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --exec-max-running 1 \
+           --exec-timeout 5 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -o $tids.out "http://localhost:$Port/scripts/script.sh!" && \
+        curl -s http://localhost:$Port/webserver/info | grep -E 'exec_started +1$'
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        diff $tids.out test005.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 023 - python script worker process test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --script-workers 1 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -o $tids.out "http://localhost:$Port/scripts/script.py!" && \
+        curl -s http://localhost:$Port/webserver/info | grep -E 'script_pool_runs +1$'
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        diff $tids.out test005.ok >$tids.diff 2>&1
+        if (( $? )) ; then
+            test_failed $tid "diff"
+        else
+            test_passed $tid
+            rm -f $tids.out $tids.diff
+        fi
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 024 - plugin lifecycle hooks test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --plugin $RootDir/www/plugins/lifecycle.py \
+           --entry Plugin \
+           --workers 2 \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    curl -s -o /dev/null http://localhost:$Port/ && \
+        curl -s http://localhost:$Port/ | grep -E '^starts=1 workers=2 requests=2$'
+    st=$?
+    set +x
+    if (( $st )) ; then
+        test_failed $tid "curl"
+    else
+        test_passed $tid
+    fi
+fi
+
+kill_webserver $Port
+
+# ================================================================
+# Test 025 - streaming upload test
+# ================================================================
+(( tid++ ))
+tids=$(printf 'test%03d' $tid)
+test_banner $tid
+Port=$(( $PortBase + $tid ))
+kill_webserver $Port
+head -c 100000 /dev/urandom > $tids.bin
+set -x
+$Webserver --extra "testid=$tids" \
+           --port $Port \
+           --webdir $RootDir/www \
+           --max-body-size 200k \
+           --upload-spool-size 10k \
+           -L debug &
+st=$?
+set +x
+if (( $st )) ; then
+    test_failed $tid "webserver"
+else
+    sleep 1
+    set -x
+    Status1=$(curl -s -o /dev/null -w '%{http_code}' -F a=1 -F f=@$tids.bin http://localhost:$Port/)
+    Status2=$(curl -s -o /dev/null -w '%{http_code}' -F f=@$tids.bin -F g=@$tids.bin -F h=@$tids.bin http://localhost:$Port/)
+    Status3=$(curl -s -o /dev/null -w '%{http_code}' -H 'Transfer-Encoding: chunked' -d a=1 http://localhost:$Port/)
+    # The contents of a small uploaded file are also a parameter.
+    echo 'small upload' >$tids.txt
+    curl -s -F title=T -F arg1=@$tids.txt -F arg2=2 http://localhost:$Port/templates/test.tmpl | grep -F 'arg1 = small upload' && \
+        curl -s http://localhost:$Port/webserver/info | grep -E 'uploads_spooled +1$'
+    st=$?
+    set +x
+    if (( $st )) || [[ "$Status1/$Status2/$Status3" != "200/413/200" ]] ; then
+        test_failed $tid "curl"
+    else
+        # The event engine writes a large request to a temporary
+        # file as it is received.
+        kill_webserver $Port
+        Port=$(( $Port + 100 ))
+        kill_webserver $Port
+        set -x
+        $Webserver --extra "testid=$tids" \
+                   --port $Port \
+                   --webdir $RootDir/www \
+                   --engine event \
+                   --max-body-size 200k \
+                   --upload-spool-size 10k \
+                   -L debug &
+        sleep 1
+        Status1=$(curl -s -o /dev/null -w '%{http_code}' -H 'Transfer-Encoding: chunked' -F a=1 -F f=@$tids.bin http://localhost:$Port/)
+        curl -s http://localhost:$Port/webserver/info | grep -E 'spooled_requests +1$' && \
+            curl -s http://localhost:$Port/webserver/info | grep -E 'uploads_spooled +1$'
+        st=$?
+        set +x
+        if (( $st )) || [[ "$Status1" != "200" ]] ; then
+            test_failed $tid "event"
+        else
+            test_passed $tid
+        fi
+    fi
+fi
+rm -f $tids.bin $tids.txt
+
+kill_webserver $Port
+
 # ================================================================
 # Done.
 # ================================================================
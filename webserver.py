@@ -63,7 +63,8 @@ used in the HTML.
 The format of the variables is the same that used for string.format()
 operations (string.Formatter objects) so they are very flexible.
 
-The embedded python can also reference other files. Here is an
+The template can also include other files with the include
+directive. The included files can use the same variables. Here is an
 example of how that works:
 
     <!DOCTYPE html>
@@ -73,24 +74,10 @@ example of how that works:
       # The params dictionary is defined by the
       # request handler.
       import datetime
-      import os
       import sys
 
-      def read_file(params, ifn):
-        """
-        Read a file.
-        """
-        try:
-          ifn = os.path.join(params['sysdir'], ifn)
-          with open(ifn, 'r') as ifp:
-            return ifp.read()
-        except IOError as exc:
-          return 'Read failed for {0}: {1!r}.'.format(ifn, exc)
-
       params = locals()
 
-      params['page_header'] = read_file(params, 'page_header.html')
-      params['page_footer'] = read_file(params, 'page_footer.html')
       params['title'] = 'Template Test of Embedded Python'
 
       # This is referenced by the page_header after the substitution.
@@ -116,7 +103,7 @@ example of how that works:
       </head>
       <body>
         <!-- page header (references {title} and {date}) -->
-        {page_header}
+        <!-- include page_header.html -->
 
         <!-- page body -->
         <pre>
@@ -127,7 +114,7 @@ example of how that works:
         </pre>
     {top}
         <!-- page footer -->
-        {page_footer}
+        <!-- include page_footer.html -->
       </body>
     </html>
 
@@ -157,21 +144,46 @@ del pver
 # Standard imports.
 import argparse
 import cgi
+import collections
 import Cookie
+import copy
+import cPickle as pickle
+import ctypes
+import ctypes.util
 import datetime
+import email.utils
+import errno
+import fnmatch
+import hashlib
 import imp
+import inspect
 import logging
 import logging.handlers
+import marshal
 import mimetypes
+import multiprocessing
+import multiprocessing.reduction
+import _multiprocessing
 import random
 import re
 import os
+import Queue
+import resource
+import runpy
 import select
+import shutil
+import signal
 import socket
 import SocketServer
 import ssl
 import string
+import StringIO
 import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import zlib
 
 
 VERSION = '1.0'
@@ -327,6 +339,49 @@ def getopts():
             raise argparse.ArgumentTypeError('Certificate file is not a file.')
         return os.path.abspath(val)
 
+    def count_opt(val):
+        '''
+        A count, like the number of workers.
+        Must be a non-negative integer.
+        '''
+        try:
+            ival = int(val)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Not a non-negative integer.')
+        if ival < 0:
+            raise argparse.ArgumentTypeError('Must be a non-negative integer.')
+        return ival
+
+    def secs_opt(val):
+        '''
+        A number of seconds that must be finite, like a timeout.
+        Must be a positive integer.
+        '''
+        try:
+            ival = int(val)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Not a positive integer.')
+        if ival <= 0:
+            raise argparse.ArgumentTypeError('Must be a positive integer.')
+        return ival
+
+    def compile_dir_opt(val):
+        '''
+        Make sure that the compiled template directory is writable.
+        It is created if it does not exist.
+        '''
+        if os.path.exists(val):
+            if os.path.isdir(val) is False:
+                raise argparse.ArgumentTypeError('Compiled template directory is not a directory.')
+        else:
+            try:
+                os.makedirs(val)
+            except OSError as exc:
+                raise argparse.ArgumentTypeError('Cannot create {0}: {1}'.format(val, exc))
+        if os.access(val, os.W_OK) is False:
+            raise argparse.ArgumentTypeError('Compiled template directory is not writable.')
+        return os.path.abspath(val)
+
     def entry_obj(val):
         '''
         Plugin module entry point.
@@ -336,6 +391,22 @@ def getopts():
             return val
         raise argparse.ArgumentTypeError('Not a valid python function name.')
 
+    def exec_cache_path_opt(val):
+        '''
+        The cache time to live of the executed scripts that match
+        a URL path pattern: PATTERN=SECS.
+        '''
+        pattern, sep, secs = val.rpartition('=')
+        if sep == '' or pattern == '':
+            raise argparse.ArgumentTypeError('Not of the form PATTERN=SECS.')
+        try:
+            ttl = int(secs)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Not a non-negative integer: {0}.'.format(secs))
+        if ttl < 0:
+            raise argparse.ArgumentTypeError('Must be a non-negative integer: {0}.'.format(secs))
+        return (pattern, ttl)
+
     def log_file_opt(val):
         '''
         Make sure that we have write permissions for this file.
@@ -364,9 +435,10 @@ def getopts():
             raise argparse.ArgumentTypeError('Cannot create {0}: {1}'.format(dirpath, exc))
         return val
 
-    def log_size_opt(val):
+    def size_opt(val):
         '''
-        Verify that the log size variable has the correct format.
+        Verify that a size variable, like the log size, has the
+        correct format.
 
         Size can be specified as the number of bytes or by using
         suffix: k=KB, m=MB, g=GB.
@@ -570,6 +642,17 @@ EXAMPLES:
         --https \
         --cert /opt/projects/mysite/www/server.pem \
         --port 8443
+
+  $ # ================================
+  $ # Example 9: Daemonized HTTP server that uses all of the cores.
+  $ {0} \
+        --webdir /opt/projects/mysite/www \
+        --processes 4 \
+        --workers 8 \
+        --cpu-affinity \
+        --daemonize \
+        --log-file /opt/projects/mysite/log/webserver.log \
+        --pid-file /opt/projects/mysite/log/webserver.pid
  '''.format(base)
     afc = argparse.RawTextHelpFormatter
     parser = argparse.ArgumentParser(formatter_class=afc,
@@ -593,6 +676,12 @@ Default=%(default)s.
  ''')
 
 
+    parser.add_argument('--cpu-affinity',
+                        action='store_true',
+                        help='''Pin each worker process (--processes) to a CPU.
+Default=%(default)s.
+ ''')
+
     parser.add_argument('-d', '--daemonize',
                         action='store_true',
                         help='''Daemonize the server.
@@ -603,6 +692,28 @@ Note that for a system service you would not use this option. Instead
 you would use something like systemd or supervisord to daemonize the
 process for you.
 Default=%(default)s (console mode).
+ ''')
+
+    parser.add_argument('-E', '--engine',
+                        action='store',
+                        type=str,
+                        default='socketserver',
+                        metavar=('ENGINE'),
+                        choices=['socketserver', 'event'],
+                        help='''The server engine.
+   socketserver  Each connection is handled by the server thread or
+                 by a worker thread (--workers) until it is closed.
+   event         A single threaded, non-blocking event loop (epoll or
+                 select) reads the requests incrementally and hands
+                 the complete requests to the request handler. It can
+                 hold many slow or idle clients at a flat memory cost.
+                 It cannot be used with --workers. The handler runs
+                 in the event loop and its output is sent when it
+                 returns, so streamed responses (<!-- stream -->
+                 templates and executed scripts) are buffered and a
+                 slow script blocks the loop for up to --exec-timeout.
+Choices=%(choices)s.
+Default=%(default)s.
  ''')
 
     parser.add_argument('-e', '--entry',
@@ -613,13 +724,138 @@ Default=%(default)s (console mode).
 It is a module level function named 'request_handler' that accepts the
 request object and displays the page information.
 
+It can also be a plugin class, a plugin object or a function without
+arguments that returns the plugin object. The plugin object has a
+handle(req) method that displays the page information and optional
+lifecycle hooks that are called with the server object:
+
+   on_start(server)         Called once in each server process before
+                            it accepts requests. Set up the shared state.
+   on_worker_start(server)  Called once in each thread that handles
+                            the requests.
+   on_shutdown(server)      Called when the server stops.
+
+The server object has the ws_opts, ws_logger and ws_routes attributes.
+
 The request object is derived from SimpleHTTPServer.SimpleHTTPRequestHandler
 with a few additional methods.
 
    ws_get_logger()     Get the logger object (derived from the python logging module).
    ws_get_opts()       Get the argparse options object.
    ws_get_url_prefix() Get the protocol, domain and port (e.g. https://localhost:8080)
+   ws_get_stats()      Get the server statistics object.
+   ws_get_file_cache() Get the static file cache object or None (--file-cache-size).
+   ws_get_exec_cache() Get the executed script output cache object or None (--exec-cache-ttl).
+   ws_get_cmd_executor()
+                       Get the command executor object (--exec-max-running).
+   ws_get_path_index() Get the web directory index object (--stat-cache-ttl).
+   ws_get_template_cache()
+                       Get the parsed template cache object (--template-cache-size).
+   ws_get_template_pool()
+                       Get the template worker process pool object or None (--template-workers).
+   ws_get_routes()     Get the route table of the special URLs.
+   ws_send_file(ifp, offset, count)
+                       Send part of a file after the headers without
+                       reading it into memory (uses sendfile()).
+   ws_send_chunked(pieces)
+                       Send the pieces of the body after the headers as
+                       they are produced (chunked transfer encoding).
+
+If the plug-in module has a register_routes(routes) function, it is
+called with the route table when the server starts so that the plug-in
+can add its own special URLs with routes.add(pattern, function).
+
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-cache-path',
+                        action='append',
+                        type=exec_cache_path_opt,
+                        default=[],
+                        metavar=('PATTERN=SECS'),
+                        help='''The number of seconds that the output of the executed
+scripts (URLs ending in '!' and /system/name) whose URL path matches the
+shell style pattern is cached. It overrides --exec-cache-ttl. The first
+matching pattern wins. It can be specified multiple times.
+Example: --exec-cache-path '/scripts/report*.sh=60'
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-cache-ttl',
+                        action='store',
+                        type=count_opt,
+                        default=0,
+                        metavar=('SECS'),
+                        help='''The number of seconds that the output of the executed
+scripts (URLs ending in '!' and /system/name) is cached. The output is
+keyed by the script, its modification time and the URL parameters.
+Concurrent requests for the same output wait for a single run of the
+script. Cached output is sent when the script is done, the output of
+the other scripts is sent as it is produced.
+If it is 0, the output is not cached (see --exec-cache-path).
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-max-per-script',
+                        action='store',
+                        type=count_opt,
+                        default=4,
+                        metavar=('COUNT'),
+                        help='''The maximum number of copies of the same executed
+script (URLs ending in '!' and /system/name) that run at once.
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-max-running',
+                        action='store',
+                        type=count_opt,
+                        default=16,
+                        metavar=('COUNT'),
+                        help='''The maximum number of executed scripts (URLs ending
+in '!' and /system/name) that run at once. The other requests wait in
+a queue (--exec-queue-size).
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-queue-size',
+                        action='store',
+                        type=count_opt,
+                        default=32,
+                        metavar=('COUNT'),
+                        help='''The maximum number of requests that wait for an
+executed script to finish (--exec-max-running, --exec-max-per-script).
+When the queue is full or a request waited for --exec-timeout seconds,
+the response is 503 (Service Unavailable).
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--exec-timeout',
+                        action='store',
+                        type=count_opt,
+                        default=300,
+                        metavar=('SECS'),
+                        help='''The maximum number of seconds that an executed script
+(URLs ending in '!' and /system/name) runs. The script and the
+processes that it started are killed when it times out or when the
+client goes away.
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
 
+    parser.add_argument('--file-cache-size',
+                        action='store',
+                        type=size_opt,
+                        default='0',
+                        metavar=('SIZE'),
+                        help='''The maximum number of bytes of static files that
+are cached in memory. The least recently used files are evicted first
+and a file is reloaded if its modification time or size changes.
+Each worker process (--processes) has its own cache.
+If it is 0, there is no cache.
+Acceptable suffixes: k=KB, m=MB, g=GB.
+Examples: 1048576, 1m, 1024k, 1g
 Default=%(default)s.
  ''')
 
@@ -644,6 +880,36 @@ Default=%(default)s.
                         action='store_true',
                         help=r'''Run in secure HTTPS mode.
 You must specify a certificate file for HTTPS using -c or --cert.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--keep-alive-max',
+                        action='store',
+                        type=count_opt,
+                        default=100,
+                        metavar=('COUNT'),
+                        help='''The maximum number of requests handled on a
+persistent (HTTP/1.1 keep-alive) connection before it is closed.
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--keep-alive-timeout',
+                        action='store',
+                        type=count_opt,
+                        default=15,
+                        metavar=('SECS'),
+                        help='''The number of seconds that an idle persistent
+(HTTP/1.1 keep-alive) connection is kept open. Note that an idle
+connection holds a worker thread (--workers) but not the event
+engine (--engine event).
+If it is 0, connections are closed after each request. They are also
+closed after each request when there are no worker threads and the
+event engine is not used because an idle connection would block all
+of the other clients.
+
+Plugins must send a Content-length header for the connection to be
+kept open.
 Default=%(default)s.
  ''')
 
@@ -678,7 +944,7 @@ Default=%(default)s.
 
     parser.add_argument('--log-size',
                         action='store',
-                        type=log_size_opt,
+                        type=size_opt,
                         default='10m',
                         metavar=('SIZE'),
                         help='''The maximum size of the log file before rollover.
@@ -695,6 +961,33 @@ Default=%(default)s.
                         choices=['notset', 'debug', 'info', 'warning', 'error', 'critical',],
                         help='''Define the logging level.
 Choices=%(choices)s.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--max-body-size',
+                        action='store',
+                        type=size_opt,
+                        default='100m',
+                        metavar=('SIZE'),
+                        help='''The maximum size of a request body.
+A request with a larger Content-Length is rejected with 413 (Request
+Entity Too Large) before the body is read. A chunked body is rejected
+as soon as it gets too large.
+If it is 0, there is no limit.
+Acceptable suffixes: k=KB, m=MB, g=GB.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--max-part-size',
+                        action='store',
+                        type=size_opt,
+                        default='0',
+                        metavar=('SIZE'),
+                        help='''The maximum size of a part of a multipart/form-data
+request body, like an uploaded file. A request with a larger part is
+rejected with 413 (Request Entity Too Large).
+If it is 0, the parts are only limited by --max-body-size.
+Acceptable suffixes: k=KB, m=MB, g=GB.
 Default=%(default)s.
  ''')
 
@@ -715,8 +1008,8 @@ Default=%(default)s.
 This is the python plugin module that contains the entry point for
 processing requests. The entry point is a module level function name
 'request_handler' that accepts the request object and displays the
-page information. The entry point name can be changed using the
---entry option.
+page information or a plugin object with lifecycle hooks (see --entry).
+The entry point name can be changed using the --entry option.
 
 If a plugin is not specified, the default behavior is to display the
 file specified. If a directory is specified, it will look for an
@@ -725,6 +1018,39 @@ it is not found, the directory is displayed with linkable file names
 and subdirectories,
 
 Default=%(default)s (no plugin).
+ ''')
+
+    parser.add_argument('--precompile',
+                        action='store_true',
+                        help='''Parse and compile all of the templates in the web
+directory into the compiled template directory (--template-compile-dir)
+and exit. Run it after a deploy so that the first requests do not
+have to parse the templates.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--precompile-on-start',
+                        action='store_true',
+                        help='''Parse and compile all of the templates in the web
+directory when the server starts so that the first requests do not
+have to parse them. They are loaded from the compiled template
+directory (--template-compile-dir) when it has an up to date copy and
+saved there otherwise. It is an alternative to running --precompile
+as a deploy step.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('-n', '--processes',
+                        action='store',
+                        type=count_opt,
+                        default=0,
+                        metavar=('COUNT'),
+                        help='''The number of pre-forked worker processes.
+Each process runs the request loop (using worker threads if --workers
+is specified) so that the server can use all of the cores. The parent
+process restarts any worker process that dies. When the server is
+daemonized, the parent process owns the PID file.
+Default=%(default)s (no worker processes).
  ''')
 
     parser.add_argument('-q', '--pid-file',
@@ -735,6 +1061,191 @@ Default=%(default)s (no plugin).
                         help='''PID file.
 This file is used when daemonizing the process.
 Default=%(default)s (no PID file).
+ ''')
+
+    parser.add_argument('--queue-size',
+                        action='store',
+                        type=count_opt,
+                        default=64,
+                        metavar=('COUNT'),
+                        help='''The maximum number of accepted connections that can
+wait for a free worker (--workers). When the queue is full the
+server stops accepting new connections until a worker is free.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--reuseport',
+                        action='store_true',
+                        help='''Each worker process (--processes) binds its own
+socket using SO_REUSEPORT so that the kernel distributes the
+connections between them instead of sharing a single socket.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--script-max-requests',
+                        action='store',
+                        type=count_opt,
+                        default=1000,
+                        metavar=('COUNT'),
+                        help='''The number of python scripts that a script worker
+process (--script-workers) runs before it is replaced.
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--script-memory-limit',
+                        action='store',
+                        type=size_opt,
+                        default='512m',
+                        metavar=('SIZE'),
+                        help='''The maximum memory that a script worker process
+(--script-workers) can allocate. It is enforced with an address space
+limit, a script that exceeds it fails and the worker process is
+replaced.
+If it is 0, there is no limit.
+Acceptable suffixes: k=KB, m=MB, g=GB.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--script-workers',
+                        action='store',
+                        type=count_opt,
+                        default=0,
+                        metavar=('COUNT'),
+                        help='''The number of long lived worker processes that run
+the executable python scripts (URLs ending in '.py!' for files with
+a python #! line), like FastCGI. The scripts run in the server's
+python interpreter as __main__, so the interpreter start up and the
+imports are not paid for each request. The output written to
+sys.stdout and sys.stderr is sent, the output of the processes that
+a script starts is not. The --exec-* limits apply.
+If it is 0, python scripts are run by the shell like the other scripts.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--stat-cache-ttl',
+                        action='store',
+                        type=count_opt,
+                        default=1,
+                        metavar=('SECS'),
+                        help='''The number of seconds that an entry in the index of
+the web directory, including the entries for paths that were not found,
+is trusted before the file system is checked again. The index is built
+when the server starts and maps the paths to the files, index files,
+sizes, modification times and content types. An entry is only resolved
+again when the modification time or size of its file or directory
+changed, otherwise it is trusted for another period.
+If it is 0, there is no index.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--template-cache-size',
+                        action='store',
+                        type=count_opt,
+                        default=128,
+                        metavar=('COUNT'),
+                        help='''The maximum number of parsed templates that are
+cached. The python code in a cached template is already compiled and
+its HTML is already stripped of the python code. The least recently
+used templates are evicted first and a template is parsed again if its
+modification time or size, or the modification time or size of a file
+that it includes, changes. The files are checked at most once every
+--stat-cache-ttl seconds.
+If it is 0, templates are parsed for each request.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--template-compile-dir',
+                        action='store',
+                        type=compile_dir_opt,
+                        default=None,
+                        metavar=('DIR'),
+                        help='''The directory of the compiled templates.
+The code objects and segments of each parsed template are saved there
+and loaded instead of parsing the template again, after a restart for
+example. A compiled template is used only if the checksum of the
+template and the modification times and sizes, or checksums, of the
+files that it includes have not changed. See --precompile.
+Default=%(default)s (templates are parsed by each server process).
+ ''')
+
+    parser.add_argument('--template-cpu-limit',
+                        action='store',
+                        type=count_opt,
+                        default=10,
+                        metavar=('SECS'),
+                        help='''The maximum CPU time of a template python fragment
+in a template worker process (--template-workers).
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--template-memory-limit',
+                        action='store',
+                        type=size_opt,
+                        default='512m',
+                        metavar=('SIZE'),
+                        help='''The maximum memory that a template worker
+process (--template-workers) can allocate. It is enforced with an
+address space limit, a worker process that exceeds it fails the
+request and is replaced.
+If it is 0, there is no limit.
+Acceptable suffixes: k=KB, m=MB, g=GB.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--template-timeout',
+                        action='store',
+                        type=count_opt,
+                        default=30,
+                        metavar=('SECS'),
+                        help='''The maximum wall clock time of a template python
+fragment in a template worker process (--template-workers). A worker
+process that exceeds it is killed and replaced.
+If it is 0, there is no limit.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--template-workers',
+                        action='store',
+                        type=count_opt,
+                        default=0,
+                        metavar=('COUNT'),
+                        help='''The number of worker processes that run the
+python fragments of the templates. They are isolated from the server
+so a slow or runaway template cannot hang it, CPU bound templates run
+on multiple cores and the fragments cannot change the globals of the
+request handler. Only the parameters that can be pickled are sent back.
+If it is 0, the fragments run in the server process.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--tls-handshake-timeout',
+                        action='store',
+                        type=secs_opt,
+                        default=10,
+                        metavar=('SECS'),
+                        help='''The maximum number of seconds that the TLS handshake
+of an HTTPS connection (--https) can take. A client that does not
+finish it in time is disconnected. It is separate from
+--keep-alive-timeout and it cannot be 0, so that a client that never
+sends its hello cannot hold the thread that handles the connections.
+Default=%(default)s.
+ ''')
+
+    parser.add_argument('--upload-spool-size',
+                        action='store',
+                        type=size_opt,
+                        default='1m',
+                        metavar=('SIZE'),
+                        help='''The size of an uploaded file (a multipart/form-data
+part with a file name) that is kept in memory. Larger files are
+written to a temporary file (TMPDIR) as they are received. The event
+engine (--engine event) also writes the requests that are larger than
+it to a temporary file as they are received.
+If it is 0, all of the uploaded files are written to temporary files.
+Acceptable suffixes: k=KB, m=MB, g=GB.
+Default=%(default)s.
  ''')
 
     parser.add_argument('-V', '--version',
@@ -750,6 +1261,19 @@ Default=%(default)s (no PID file).
                         metavar=('DIR'),
                         help='''The web root directory that contains the HTML/CSS/JS files.
 Default=%(default)s (current directory).
+ ''')
+
+    parser.add_argument('-W', '--workers',
+                        action='store',
+                        type=count_opt,
+                        default=0,
+                        metavar=('COUNT'),
+                        help='''The number of worker threads used to handle requests.
+Accepted connections are queued (--queue-size) and handled by
+a bounded pool of worker threads so that a slow request does
+not stall the other clients. If it is 0, the requests are handled
+one at a time by the server thread.
+Default=%(default)s (no worker threads).
  ''')
 
     parser.add_argument('-x', '--extra',
@@ -764,13 +1288,20 @@ Default=%(default)s.
 ''')
 
     opts = parser.parse_args()
+    if opts.precompile and opts.template_compile_dir is None:
+        parser.error('--precompile requires --template-compile-dir.')
 
     return opts, name
 
 
-def default_request_handler(req):
+def default_plugin():
     '''
-    This is the default request handler.
+    This is the default plugin. It returns the plugin object.
+
+    The helper functions are defined once, when the plugin is
+    created, and the setup that is shared by all of the requests,
+    like the globals and the routes of the special URLs, is done
+    once in on_start(). Each request only dispatches and renders.
 
     It is not meant for production but it shows how flexible the
     system is. Here is how it behaves.
@@ -889,10 +1420,16 @@ def default_request_handler(req):
            req.m_syspath   system path
            req.m_protocol  HTTP or HTTPS
            req.m_params    GET/POST parameters
-        '''
-        # Initialize the globals.
-        init_globals(opts)
+           req.m_files     uploaded files (UploadFile objects)
+
+        The contents of the uploaded files that are kept in memory
+        (--upload-spool-size) are also in req.m_params, like in the
+        earlier versions, so that the plugins that read them there
+        still work.
 
+        It returns False if the POST data could not be read, the
+        error response was sent.
+        '''
         # Parse the GET options.
         if req.path.find('?') >= 0:
             parts = req.path.split('?')
@@ -903,20 +1440,25 @@ def default_request_handler(req):
             urlpath = req.path
 
         # Parse the POST options.
+        # The uploaded files are not read into memory.
+        files = {}
         if req.command == 'POST':
             assert len(params) == 0
-            ctype, pdict = cgi.parse_header(req.headers.getheader('content-type'))
-            if ctype == 'multipart/form-data':
-                params = cgi.parse_multipart(req.rfile, pdict)
-            elif ctype == 'application/x-www-form-urlencoded':
-                length = int(req.headers['content-length'])
-                data = req.rfile.read(length)
-                params = cgi.parse_qs(data, keep_blank_values=1)
+            form = req.ws_read_form()
+            if form is None:
+                return False
+            params, files = form
+            for name, entries in files.items():
+                if not any(entry.spooled() for entry in entries):
+                    params.setdefault(name, []).extend(entry.read() for entry in entries)
 
             # some browser send 2 more bytes
-            rdy, _, _ = select.select([req.connection], [], [], 0)
-            if rdy:
-                req.rfile.read(2)
+            # Only discard them when the connection is about to be
+            # closed, otherwise they could belong to the next request.
+            if req.close_connection:
+                rdy, _, _ = select.select([req.connection], [], [], 0)
+                if rdy:
+                    req.rfile.read(2)
 
         # Get the system path and the root path.
         syspath = req.translate_path(urlpath)
@@ -928,6 +1470,7 @@ def default_request_handler(req):
         setattr(req, 'm_syspath', syspath)   # system path, file or dir
         setattr(req, 'm_sysroot', sysroot)   # system path to the root directory
         setattr(req, 'm_params', params)     # parameters from GET or POST
+        setattr(req, 'm_files', files)       # uploaded files from POST
         setattr(req, 'm_protocol', protocol) # HTTP or HTTPS
         setattr(req, 'm_headers', [])        # additional headers
 
@@ -966,6 +1509,7 @@ def default_request_handler(req):
             for header in headers.split('\n'):
                 if len(header):  # skip zero length headers
                     logger.debug('   {0} {1}'.format(len(header), header))
+        return True
 
     def nocache(req):
         '''
@@ -976,13 +1520,15 @@ def default_request_handler(req):
             req.m_headers.append(('Pragma', 'no-cache'))  # HTTP 1.0
             req.m_headers.append(('Expires', '0'))  # HTTP 1.0 proxies
 
-    def send(req, ctype, out):
+    def send_headers(req, ctype, length, code=200):
         '''
-        Send the page.
+        Send the response headers.
         '''
-        req.send_response(200)
-        req.send_header('Content-type', ctype)
-        req.send_header('Content-length', len(out))
+        req.send_response(code)
+        if ctype is not None:
+            req.send_header('Content-type', ctype)
+        if length is not None:
+            req.send_header('Content-length', length)
 
         # Cookies - this always resets all of the cookies.
         for morsel in req.m_cookie.values():  # SimpleCookie object.
@@ -994,85 +1540,493 @@ def default_request_handler(req):
 
         req.end_headers()
 
+    def send(req, ctype, out):
+        '''
+        Send the page.
+
+        It is compressed on the fly if the client accepts it.
+        '''
+        if isinstance(out, unicode):
+            out = out.encode('utf-8')  # the length must be in bytes
+        encoding = choose_encoding(req, ctype, len(out))
+        if encoding is not None:
+            out = compress(out, encoding)
+            req.m_headers.append(('Content-Encoding', encoding))
+        send_headers(req, ctype, len(out))
         req.wfile.write(out)
 
-    def escape_text(text):
+    def compressible(ctype):
         '''
-        Escape text for HTML presentation.
+        Is it worth compressing this content type?
+        Images (other than SVG), audio, video and archives are
+        already compressed.
         '''
-        tbl = {'&': '&amp;',
-               '"': '&quot;',
-               "'": '&apos;',
-               '>': '&gt;',
-               '<': '&lt;',}
-        return ''.join(tbl.get(c, c) for c in text)
+        ctype = ctype.split(';')[0].strip().lower()
+        return ctype.startswith('text/') or ctype in ['application/javascript',
+                                                      'application/json',
+                                                      'application/x-javascript',
+                                                      'application/xml',
+                                                      'image/svg+xml', ]
+
+    def choose_encoding(req, ctype, size, min_size=256):
+        '''
+        Choose the content encoding (gzip or deflate) from the
+        Accept-Encoding header.
 
-    def webserver_info(req, opts, logger):
+        It is None if the content is not compressible, too small
+        to be worth compressing or the client does not accept a
+        compressed encoding.
         '''
-        Report some webserver information.
+        if ctype is None or compressible(ctype) is False:
+            return None
+
+        # The response depends on the Accept-Encoding header.
+        if ('Vary', 'Accept-Encoding') not in req.m_headers:
+            req.m_headers.append(('Vary', 'Accept-Encoding'))
+
+        header = req.headers.getheader('accept-encoding')
+        if header is None or size < min_size:
+            return None
+
+        qvals = {}
+        for item in header.split(','):
+            fields = item.split(';')
+            qval = 1.
+            for field in fields[1:]:
+                key, _, val = field.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        qval = float(val)
+                    except ValueError:
+                        qval = 0.
+            qvals[fields[0].strip().lower()] = qval
+
+        for encoding in ['gzip', 'deflate']:
+            if qvals.get(encoding, qvals.get('*', 0.)) > 0:
+                return encoding
+        return None
+
+    def compressor(encoding):
         '''
-        lines = []
-        lines.append('<!DOCTYPE HTML>')
-        lines.append('<html>')
-        lines.append('  <head>')
-        lines.append('    <meta charset="utf-8">')
-        lines.append('    <title>Webserver - Directory</title>')
-        lines.append('  </head>')
-        lines.append('  <body>')
-        lines.append('    <pre>')
-        lines.append('Configuration Options')
-
-        entries = vars(opts)
-        for key in sorted(entries, key=str.lower):
-            val = entries[key]
-            lines.append('   --{0:<12} {1}'.format(key, val))
-
-        lines.append('')
-
-        lines.append('Server Information')
-        entries = vars(req)
-        for key in sorted(entries, key=str.lower):
-            val = entries[key]
-            text = escape_text(str(val)).replace('\r\n', '\\r\\n\n')
-            if text.find('\n'):
-                text = '\n                    '.join(text.split('\n'))
-                text = text.rstrip()
-            lines.append('   {0:<16} {1}'.format(key, text))
-
-        lines.append('    </pre>')
-        lines.append('  </body>')
-        lines.append('</html>')
-
-        out = '\n'.join(lines)
-        send(req, 'text/html', out)
+        Create a compression object for the gzip or deflate (zlib)
+        content encoding.
+        '''
+        wbits = zlib.MAX_WBITS
+        if encoding == 'gzip':
+            wbits += 16  # gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, wbits)
 
-    def runcmd(cmd):
+    def compress(data, encoding):
         '''
-        Run a command with a lot of output.
+        Compress the data using the gzip or deflate (zlib)
+        content encoding.
         '''
-        proc = subprocess.Popen(cmd,
-                                shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-
-        # Read the output 1 character at a time so that it can be
-        # displayed in real time.
-        text = ''
-        while not proc.returncode:
-            data = proc.stdout.read(32)
-            if not data:
-                break # all done, wait for returncode to get populated
-            text += data.decode('utf-8')
-        proc.wait()
-        return proc.returncode, text
+        cobj = compressor(encoding)
+        return cobj.compress(data) + cobj.flush()
 
-    def redirect(req, opts, logger, url):
+    def compress_stream(pieces, encoding):
         '''
-        Redirect to the login page.
+        Compress the pieces of a stream. Each piece is flushed so
+        that the client can decompress it right away.
         '''
-        logger.debug('REDIRECT: "{0}".'.format(url))
-        req.send_response(301)
-        req.send_header('Location', url)
+        cobj = compressor(encoding)
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            if piece:
+                yield cobj.compress(piece) + cobj.flush(zlib.Z_SYNC_FLUSH)
+        yield cobj.flush()
+
+    def stream_pieces(first, pieces):
+        '''
+        Generate the first piece, that was already produced, followed
+        by the rest of the pieces.
+        '''
+        yield first
+        for piece in pieces:
+            yield piece
+
+    def send_stream(req, ctype, pieces):
+        '''
+        Send the page pieces as they are produced.
+
+        The headers are sent, without a Content-length, once the
+        first piece is produced so that an error raised before that,
+        like a missing template variable, can still be reported by
+        the caller. The pieces are sent using the chunked transfer
+        encoding.
+        '''
+        source = pieces
+        try:
+            pieces = iter(pieces)
+            first = next(pieces, '')
+        except Exception:
+            if hasattr(source, 'close'):
+                source.close()
+            raise
+        pieces = stream_pieces(first, pieces)
+
+        if req.request_version == 'HTTP/1.0':
+            req.close_connection = 1  # the end of the connection ends the body
+        else:
+            req.m_headers.append(('Transfer-Encoding', 'chunked'))
+        encoding = choose_encoding(req, ctype, 0, min_size=0)  # the size is not known
+        if encoding is not None:
+            pieces = compress_stream(pieces, encoding)
+            req.m_headers.append(('Content-Encoding', encoding))
+        send_headers(req, ctype, None)
+        try:
+            req.ws_send_chunked(pieces)
+        except Exception as exc:
+            # It is too late to report the error to the client.
+            # Closing the connection without the last chunk tells
+            # it that the page is not complete.
+            req.ws_get_logger().error('Streaming failed for {0}: {1!r}.'.format(req.path, exc))
+            req.close_connection = 1
+        finally:
+            # Release what produces the pieces, like a command,
+            # even if the client went away.
+            if hasattr(source, 'close'):
+                source.close()
+
+    def file_etag(stat):
+        '''
+        Get the strong entity tag of a static file from its
+        modification time and size.
+        '''
+        return '"{0:x}-{1:x}"'.format(int(stat.st_mtime * 1000000), stat.st_size)
+
+    def template_etag(req, tmpl):
+        '''
+        Get the weak entity tag of a rendered template from the
+        versions of the template and its included files and the
+        parameters.
+
+        Templates with embedded python do not have one because
+        the python code can produce different output for the same
+        parameters (the date, for example).
+        '''
+        if tmpl.m_python:
+            return None
+        params = define_template_parameters(req)
+        key = '{0}:{1!r}'.format(tmpl.m_version, sorted(params.items()))
+        return 'W/"{0}"'.format(hashlib.md5(key).hexdigest())
+
+    def not_modified(req, etag, mtime):
+        '''
+        Check the conditional request headers.
+
+        Return True if the client copy is still valid so that a
+        304 (Not Modified) response can be sent.
+        '''
+        if req.command not in ['GET', 'HEAD']:
+            return False
+
+        if_none_match = req.headers.getheader('if-none-match')
+        if if_none_match is not None:
+            # It takes precedence over If-Modified-Since.
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags:
+                return True
+            # Weak comparison.
+            return etag.replace('W/', '', 1) in [tag.replace('W/', '', 1) for tag in tags]
+
+        if_modified_since = req.headers.getheader('if-modified-since')
+        if if_modified_since is not None and mtime is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= email.utils.mktime_tz(date)
+        return False
+
+    def send_not_modified(req, etag, last_modified=None):
+        '''
+        Send the 304 (Not Modified) response.
+        It does not have a body.
+        '''
+        req.m_headers.append(('ETag', etag))
+        if last_modified is not None:
+            req.m_headers.append(('Last-Modified', last_modified))
+        send_headers(req, None, None, 304)
+
+    def parse_ranges(req, size, last_modified, etag):
+        '''
+        Parse the Range header of a request for a file with the
+        specified size.
+
+        Return None if the whole file should be sent, otherwise
+        return the list of (first, last) byte positions. The list
+        is empty if none of the ranges can be satisfied.
+        '''
+        header = req.headers.getheader('range')
+        if header is None or req.command != 'GET':
+            return None
+
+        # The range only applies if the file has not changed.
+        if_range = req.headers.getheader('if-range')
+        if if_range is not None and if_range.strip() not in [last_modified, etag]:
+            return None
+
+        match = re.search(r'^\s*bytes\s*=(.+)$', header)
+        if match is None:
+            return None  # not a byte range, ignore it
+        specs = match.group(1).split(',')
+        if len(specs) > 32:
+            return None  # too many ranges, ignore them
+
+        ranges = []
+        for spec in specs:
+            match = re.search(r'^\s*(\d*)\s*-\s*(\d*)\s*$', spec)
+            if match is None or match.group(1) + match.group(2) == '':
+                return None  # invalid syntax, ignore the header
+            if match.group(1) == '':
+                # Suffix range: the last N bytes.
+                count = int(match.group(2))
+                if count > 0 and size > 0:
+                    ranges.append((max(size - count, 0), size - 1))
+                continue
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.group(2) else None
+            if last is not None and last < first:
+                return None  # invalid syntax, ignore the header
+            if first < size:
+                ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+        return ranges
+
+    def file_info(req, ctype, stat, encoding=None):
+        '''
+        Get the precomputed headers of a static file.
+
+        Compressed variants have their own entity tag.
+        '''
+        etag = file_etag(stat)
+        if encoding is not None:
+            etag = etag[:-1] + '-' + encoding + '"'
+        return {'ctype': ctype,
+                'encoding': encoding,
+                'etag': etag,
+                'last_modified': req.date_time_string(stat.st_mtime),
+                'mtime': stat.st_mtime}
+
+    def send_file(req, ctype, ifp, encoding=None):
+        '''
+        Send a static file without reading it into memory.
+        Each range is sent directly from the file.
+        '''
+        stat = os.fstat(ifp.fileno())
+        info = file_info(req, ctype, stat, encoding)
+        send_ranges(req, info, stat.st_size, lambda offset, count: req.ws_send_file(ifp, offset, count))
+
+    def send_compressed_file(req, ctype, path, encoding, cache):
+        '''
+        Send the compressed variant of a static file.
+
+        A precompressed gzip sibling (path + '.gz') that is not
+        older than the file is sent directly. Otherwise the file
+        is compressed once and kept in the file cache.
+
+        Return False if there is no compressed variant.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        if encoding == 'gzip':
+            try:
+                gzstat = os.stat(path + '.gz')
+            except OSError:
+                gzstat = None
+            if gzstat is not None and gzstat.st_mtime >= stat.st_mtime:
+                etag = file_info(req, ctype, gzstat, encoding)['etag']
+                if not_modified(req, etag, gzstat.st_mtime):
+                    send_not_modified(req, etag, req.date_time_string(gzstat.st_mtime))
+                    return True
+                try:
+                    ifp = open(path + '.gz', 'rb')
+                except IOError:
+                    return False
+                with ifp:
+                    send_file(req, ctype, ifp, encoding)
+                return True
+
+        if cache is None:
+            return False
+        entry = cache.lookup(path, encoding)
+        if entry is None:
+            if cache.cacheable(stat.st_size) is False:
+                return False
+            try:
+                with open(path, 'rb') as ifp:
+                    stat = os.fstat(ifp.fileno())
+                    data = compress(ifp.read(), encoding)
+            except IOError:
+                return False
+            info = file_info(req, ctype, stat, encoding)
+            cache.store(path, stat, data, info, encoding)
+            entry = (data, info)
+        send_cached_file(req, *entry)
+        return True
+
+    def send_cached_file(req, data, info):
+        '''
+        Send a static file from the file cache.
+        '''
+        etag = info['etag']
+        if not_modified(req, etag, info['mtime']):
+            send_not_modified(req, etag, info['last_modified'])
+            return
+        send_ranges(req, info, len(data), lambda offset, count: req.wfile.write(data[offset:offset + count]))
+
+    def send_ranges(req, info, size, write):
+        '''
+        Send the static file data with the write(offset, count)
+        function.
+
+        It supports byte range requests (206 Partial Content)
+        so that clients can resume downloads or seek in media
+        files.
+        '''
+        ctype = info['ctype']
+        last_modified = info['last_modified']
+        etag = info['etag']
+        if info['encoding'] is not None:
+            req.m_headers.append(('Content-Encoding', info['encoding']))
+        req.m_headers.append(('Accept-Ranges', 'bytes'))
+        req.m_headers.append(('ETag', etag))
+        req.m_headers.append(('Last-Modified', last_modified))
+
+        ranges = parse_ranges(req, size, last_modified, etag)
+        if ranges is None:
+            send_headers(req, ctype, size)
+            write(0, size)
+        elif len(ranges) == 0:
+            req.m_headers.append(('Content-Range', 'bytes */{0}'.format(size)))
+            send_headers(req, ctype, 0, 416)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            req.m_headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, size)))
+            send_headers(req, ctype, last - first + 1, 206)
+            write(first, last - first + 1)
+        else:
+            # Multiple ranges are sent as multipart/byteranges.
+            boundary = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(24))
+            parts = []
+            length = 0
+            for first, last in ranges:
+                part = '\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(boundary,
+                                                                                                                 ctype,
+                                                                                                                 first,
+                                                                                                                 last,
+                                                                                                                 size)
+                parts.append((part, first, last - first + 1))
+                length += len(part) + last - first + 1
+            end = '\r\n--{0}--\r\n'.format(boundary)
+            length += len(end)
+
+            send_headers(req, 'multipart/byteranges; boundary=' + boundary, length, 206)
+            for part, first, count in parts:
+                req.wfile.write(part)
+                write(first, count)
+            req.wfile.write(end)
+
+    def escape_text(text):
+        '''
+        Escape text for HTML presentation.
+        '''
+        tbl = {'&': '&amp;',
+               '"': '&quot;',
+               "'": '&apos;',
+               '>': '&gt;',
+               '<': '&lt;',}
+        return ''.join(tbl.get(c, c) for c in text)
+
+    def webserver_info(req, opts, logger):
+        '''
+        Report some webserver information.
+        '''
+        lines = []
+        lines.append('<!DOCTYPE HTML>')
+        lines.append('<html>')
+        lines.append('  <head>')
+        lines.append('    <meta charset="utf-8">')
+        lines.append('    <title>Webserver - Directory</title>')
+        lines.append('  </head>')
+        lines.append('  <body>')
+        lines.append('    <pre>')
+        lines.append('Configuration Options')
+
+        entries = vars(opts)
+        for key in sorted(entries, key=str.lower):
+            val = entries[key]
+            lines.append('   --{0:<12} {1}'.format(key, val))
+
+        lines.append('')
+
+        lines.append('Server Information')
+        entries = vars(req)
+        for key in sorted(entries, key=str.lower):
+            val = entries[key]
+            text = escape_text(str(val)).replace('\r\n', '\\r\\n\n')
+            if text.find('\n'):
+                text = '\n                    '.join(text.split('\n'))
+                text = text.rstrip()
+            lines.append('   {0:<16} {1}'.format(key, text))
+
+        lines.append('')
+
+        lines.append('Server Statistics')
+        entries = req.ws_get_stats().snapshot()
+        for key in sorted(entries, key=str.lower):
+            lines.append('   {0:<24} {1}'.format(key, entries[key]))
+
+        lines.append('    </pre>')
+        lines.append('  </body>')
+        lines.append('</html>')
+
+        out = '\n'.join(lines)
+        send(req, 'text/html', out)
+
+    def send_cmd(req, ctype, cmd, key):
+        '''
+        Send the output of a command.
+
+        If the output of the URL path is cached (--exec-cache-ttl),
+        the cached output is sent or the command is run once for
+        all of the concurrent requests. Otherwise the output is sent
+        as it is produced.
+
+        The commands are run by the command executor, which limits
+        how many run at once and how long they run. If there is no
+        free slot the response is 503 (Service Unavailable), if the
+        command times out before anything was sent it is 504 (Gateway
+        Timeout).
+        '''
+        executor = req.ws_get_cmd_executor()
+        cache = req.ws_get_exec_cache()
+        ttl = 0 if cache is None else cache.ttl(req.m_urlpath)
+        try:
+            if ttl == 0:
+                send_stream(req, ctype, executor.start(cmd))
+                return
+            out = cache.get(key, ttl, lambda: ''.join(executor.start(cmd)))
+        except executor.Busy as exc:
+            req.send_error(503, str(exc))
+            return
+        except executor.Timeout as exc:
+            req.send_error(504, str(exc))
+            return
+        send(req, ctype, out)
+
+    def redirect(req, opts, logger, url):
+        '''
+        Redirect to the login page.
+        '''
+        logger.debug('REDIRECT: "{0}".'.format(url))
+        req.send_response(301)
+        req.send_header('Location', url)
+        req.send_header('Content-length', 0)
 
         # Cookies - this always resets all of the cookies.
         for morsel in req.m_cookie.values():  # SimpleCookie object.
@@ -1102,51 +2056,75 @@ def default_request_handler(req):
         params['sid'] = req.m_sid  # session id
         return params
 
+    def run_python(req, tmpl, index, params):
+        '''
+        Run a python fragment of a template.
+
+        If there is a template worker process pool (--template-workers)
+        it runs there and only the parameters that it sets are sent
+        back, otherwise it runs here.
+        '''
+        pool = req.ws_get_template_pool()
+        if pool is None:
+            exec(tmpl.m_codes[index], globals(), params)
+        else:
+            params.update(pool.execute(tmpl, index, params))
 
-    def compile_template(data, depth=8):
+    def compile_template(req, tmpl, depth=8, stream=False):
         '''
         Compile a template with embedded python code.
 
         The python code sits between <!-- python and --> statements.
         It sets the parameter values so that they can be used
         for variable substitution.
+
+        The template was parsed by the template cache so the python
+        code is already compiled, it only has to be executed.
         '''
         params = define_template_parameters(req)
+        initial = dict(params)
 
-        # Find all of the python fragments.
+        # Run all of the python fragments to get all of the
+        # parameters. They look like this.
         # <!-- python
         #   # Set the variables here.
         #   params = locals()
         #   params['title'] = 'Template Test of Embedded Python'
         # -->
-        fragments = re.findall(r'<!-- python(.*?)-->', data, flags=re.DOTALL | re.MULTILINE)
-        if len(fragments) == 0:
-            html = data
-            if re.search(r'[^{][{][^}]+[}][^}]', html):
-                html = html.format(**params)
-        else:
-            # Load up all of the fragments to get all of the
-            # parameters.
-            for fragment in fragments:
-                # left justify so that statements are in the leftmost column.
-                min_indent = min(map(len, re.findall('^([ ]+)', fragment, re.MULTILINE)))
-                fragment = re.sub('^[ ]{' + str(min_indent) + '}', '', fragment, flags=re.MULTILINE)
-                exec(fragment, globals(), params)
-
-            # Remove the python fragments.
-            html = re.sub(r'<!-- python.*?-->\s*\n?', '', data, flags=re.DOTALL | re.MULTILINE).strip()
-
-            # Substitute the values for the variables.
-            # This must be done multiple times because
-            # there may be variables defined in nested
-            # files.
-            html = html.format(**params)
-            for i in range(depth):
-                if not re.search(r'[^{][{][^}]+[}][^}]', html):
-                    break
-                html = html.format(**params)
-
-        return html
+        #
+        # Cached fragments only run when the parameters that they
+        # set are not cached.
+        for index, fragment in enumerate(tmpl.m_fragments):
+            if fragment is None:
+                run_python(req, tmpl, index, params)
+                continue
+            key = fragment.key(params)
+            cached = fragment.get_values(key)
+            if cached is None:
+                before = dict(params)
+                run_python(req, tmpl, index, params)
+                # The params = locals() idiom refers to the
+                # parameters of this request, it is not cached.
+                aliases = [k for k, v in params.items() if v is params]
+                values = dict((k, v) for k, v in params.items()
+                              if v is not params and (k not in before or before[k] is not v))
+                fragment.put_values(key, values, aliases)
+                cached = (values, aliases)
+            values, aliases = cached
+            params.update(values)
+            for alias in aliases:
+                params[alias] = params
+
+        # Substitute the values for the variables in a single
+        # pass. Variables in the values set by the python code
+        # are expanded up to depth levels. The values that come
+        # from the request are substituted literally so that a
+        # client cannot inject variables. Streamed templates
+        # produce the output in pieces.
+        literal = set(key for key, val in initial.items() if params.get(key) is val)
+        if stream:
+            return tmpl.render_iter(params, depth, literal)
+        return tmpl.render(params, depth, literal)
 
     def template(req, logger, ext='.tmpl'):
         '''
@@ -1218,20 +2196,48 @@ def default_request_handler(req):
         # Do the substitution and display the results.
         logger.debug('TEMPLATE: "{0}".'.format(req.m_syspath))
         try:
-            with open(req.m_syspath, 'r') as ifp:
-                out = ifp.read()
-            out = compile_template(out)
-            send(req, 'text/html', out)
-        except IOError:
+            tmpl = req.ws_get_template_cache().get(req.m_syspath)
+        except (IOError, OSError):
             req.send_error(404, 'Not found')
+            return True
+
+        # The template worker errors, if there are template workers.
+        pool = req.ws_get_template_pool()
+        limit_error = () if pool is None else pool.LimitError
+        worker_error = () if pool is None else pool.Error
+        try:
+            send_template(req, 'text/html', tmpl)
         except KeyError as exc:
             # At least one of the arguments is not
             # defined. Display the result as plain
             # text.
-            out = '<!-- ERROR: {0!r} -->\n{1}'.format(exc, out)
+            out = '<!-- ERROR: {0!r} -->\n{1}'.format(exc, tmpl.m_data)
             send(req, 'text/plain', out)
+        except limit_error as exc:
+            logger.warning('TEMPLATE: {0}'.format(exc))
+            req.send_error(503, 'Template limit exceeded')
+        except worker_error as exc:
+            logger.error('TEMPLATE: {0}'.format(exc))
+            req.send_error(500, 'Template error')
         return True
 
+    def send_template(req, ctype, tmpl):
+        '''
+        Send the compiled template unless the client copy is
+        still valid.
+        '''
+        etag = template_etag(req, tmpl)
+        if etag is not None:
+            if not_modified(req, etag, None):
+                send_not_modified(req, etag)
+                return
+            req.m_headers.append(('ETag', etag))
+        if tmpl.m_stream:
+            send_stream(req, ctype, compile_template(req, tmpl, stream=True))
+            return
+        out = compile_template(req, tmpl)
+        send(req, ctype, out)
+
     def display_directory(req):
         '''
         Display the directory listing with active links.
@@ -1278,7 +2284,7 @@ def default_request_handler(req):
         out = '\n'.join(lines)
         send(req, 'text/html', out)
 
-    def display_file(req, opts, logger, path):
+    def display_file(req, opts, logger, path, ctype=None):
         '''
         Display the file specified by the path
         argument.
@@ -1286,24 +2292,67 @@ def default_request_handler(req):
         If it is HTML, allow embedded python code.
         '''
         # Load the file data.
-        ctype = req.guess_type(path)
+        if ctype is None:
+            ctype = req.guess_type(path)
         if ctype in ['application/x-sh', ]:
             ctype = 'text/plain'  # fix .sh
         logger.debug('Content type is "{0}".'.format(ctype))
-        
-        try:
-            mode = 'r' if ctype.startswith('text/') else 'rb'
-            with open(path, mode) as ifp:
-                out = ifp.read()
 
+        if ctype == 'text/html':
             # Allow embedded python in HTML code.
-            if ctype == 'text/html':
-                out = compile_template(out)
+            try:
+                tmpl = req.ws_get_template_cache().get(path)
+            except (IOError, OSError) as exc:
+                req.send_error(404, 'File not found {0}'.format(exc))
+                return
+            send_template(req, ctype, tmpl)
+            return
+
+        # Send the compressed variant of static files if the
+        # client accepts it.
+        cache = req.ws_get_file_cache()
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        encoding = choose_encoding(req, ctype, size)
+        if encoding is not None and send_compressed_file(req, ctype, path, encoding, cache):
+            return
+
+        # Static files in the file cache already have
+        # their headers.
+        if cache is not None:
+            entry = cache.lookup(path)
+            if entry is not None:
+                send_cached_file(req, *entry)
+                return
 
-            # Create the page.
-            send(req, ctype, out)
-        except IOError as exc:
+        try:
+            # Static files are only opened if the client
+            # copy is not valid.
+            stat = os.stat(path)
+            etag = file_etag(stat)
+            if not_modified(req, etag, stat.st_mtime):
+                send_not_modified(req, etag, req.date_time_string(stat.st_mtime))
+                return
+            mode = 'r' if ctype.startswith('text/') else 'rb'
+            ifp = open(path, mode)
+        except (IOError, OSError) as exc:
             req.send_error(404, 'File not found {0}'.format(exc))
+            return
+
+        with ifp:
+            if cache is not None and cache.cacheable(stat.st_size):
+                # Small static files are read once and then sent
+                # from the file cache.
+                stat = os.fstat(ifp.fileno())
+                data = ifp.read()
+                info = file_info(req, ctype, stat)
+                cache.store(path, stat, data, info)
+                send_cached_file(req, data, info)
+            else:
+                # Static files are sent directly from the file.
+                send_file(req, ctype, ifp)
 
     def url_webinfo(req, opts, logger):
         '''
@@ -1315,9 +2364,8 @@ def default_request_handler(req):
         '''
         Special dispatched URL: /system/name.
         '''
-        # run uname -a, capture the output and display it
-        sts, out = runcmd('uname -a')
-        send(req, 'text/plain', out)
+        # run uname -a and display the output
+        send_cmd(req, 'text/plain', 'uname -a', ('uname -a', ))
 
     def url_redirect1(req, opts, logger, path):
         '''
@@ -1371,6 +2419,10 @@ def default_request_handler(req):
         # If the content-type parameter is not specified
         # then display the output as plain text.
         #
+        # The output is sent as it is produced so long running
+        # scripts show progress and the output is never held
+        # in memory, unless it is cached (--exec-cache-ttl).
+        #
         # Here is an example:
         #   localhost:8080/scripts/make_page.sh?content-type=text/html
         if 'content-type' in req.m_params:
@@ -1382,8 +2434,11 @@ def default_request_handler(req):
         req.m_urlpath = req.m_urlpath[:-1]
 
         if os.path.isfile(req.m_syspath):
-            sts, out = runcmd(req.m_syspath)
-            send(req, ctype, out)
+            # The cached output depends on the script version
+            # and the URL parameters.
+            params = tuple((key, tuple(val)) for key, val in sorted(req.m_params.items()))
+            key = (req.m_syspath, os.path.getmtime(req.m_syspath), params)
+            send_cmd(req, ctype, req.m_syspath, key)
         else:
             req.send_error(404, 'Not found: "{0}"'.format(req.m_syspath))
 
@@ -1394,101 +2449,187 @@ def default_request_handler(req):
         # If control reaches this point, this is not a special
         # case, the user specified a directory or file to
         # handle.
-        if os.path.exists(req.m_syspath) is False:
+        # The web directory index knows whether it exists, whether
+        # it is a directory and which index file to use.
+        entry = req.ws_get_path_index().lookup(req.m_syspath)
+        if entry is None:
             req.send_error(404, 'Not found {0}'.format(req.m_syspath))  # path must exist
             return
 
-        if os.path.isdir(req.m_syspath) is True:
-            # This is a directory.
-            # See if index files are there.
-            sysfile = None
-            for index in ['index.html', 'index.htm', 'default.htm', ]:
-                path = os.path.join(req.m_syspath, index)
-                if os.path.exists(path) is True:
-                    sysfile = path
-                    break
-
-            # Special case, if this is a directory with no
-            # index files, display the directory contents.
-            if sysfile is None:
-                display_directory(req)
-                return
+        # Special case, if this is a directory with no
+        # index files, display the directory contents.
+        if entry['file'] is None:
+            display_directory(req)
+            return
 
-            req.m_syspath = sysfile
+        req.m_syspath = entry['file']
 
         # Process templates or non-templates.
         if template(req, logger) is False:
-            display_file(req, opts, logger, req.m_syspath)
+            display_file(req, opts, logger, req.m_syspath, entry['ctype'])
 
     def url_dispatcher(req, opts, logger):
         '''
         Dispatch the special urls to functions.
         '''
-        global ws_globals
-        logger.debug('REQUEST PATH {0}'.format(req.path))
+        # The log messages are only formatted if debug logging is on.
+        logger.debug('REQUEST PATH %s', req.path)
+
+        route = req.ws_get_routes().match(req.m_urlpath)
+        if route is not None:
+            function, args, kwargs = route
+            logger.debug('URL DISPATCH "%s" "%s".', function.__name__, req.m_urlpath)
+            function(req, opts, logger, *args, **kwargs)
+            return
+
+        url_general_dispatch(req, opts, logger)
+
+    class DefaultPlugin(object):
+        '''
+        The plugin object.
+        '''
+        def on_start(self, server):
+            '''
+            Set up the shared state once per process.
+            '''
+            init_globals(server.ws_opts)
 
-        if 'url_dispatch' not in ws_globals:
             # Add in the url dispatches for the 'special' URLs.
-            # This is done here to avoid re-compiling them every
-            # time a request is handled.
+            # The route table compiles them.
             # The first argument is the URL pattern to match.
-            # The second argument is the name of the dispatch function.
+            # The second argument is the dispatch function.
             # The dispatch function has 3 fixed arguments plus the arguments
             # defined in the re.
             # Example:
-            #    (re.compile('/foo/([^/]+)/([^/]+)/?'), 'url_func'), # <-- dispatch: 2 args: arg1, arg2
+            #    (r'^/foo/([^/]+)/([^/]+)/?$', url_func), # <-- dispatch: 2 args: arg1, arg2
             #
             #    def url_func(req, opts, logger, arg1, arg2): ...
-            ws_globals['url_dispatch'] = (
-                (re.compile(r'^/webserver/info/?$'), url_webinfo),
-                (re.compile(r'^/system/name/?$'), url_sysname),
-                (re.compile('^/redirect/to/(https?)/(.+)$'), url_redirect2),
-                (re.compile('^/redirect/to(/.+)$'), url_redirect1),
-                (re.compile('^(.+)@$'), url_dir),
-                (re.compile('^(.+)!$'), url_exec),
-            )
-
-        for dispatch in ws_globals['url_dispatch']:
-            regex = dispatch[0]
-            function = dispatch[1]  # function name
-            match = regex.search(req.m_urlpath)
-            logger.debug('URL_DISPATCH DEBUG "{0}" "{1}" "{2}"'.format(req.m_urlpath, regex.pattern, function.__name__))
-            if match:
-                args = match.groups()
-                kwargs = match.groupdict()
-                logger.debug('URL DISPATCH "{0}" "{1}".'.format(function.__name__, req.m_urlpath))
-                function(req, opts, logger, *args, **kwargs)
+            #
+            # Routes added by the plugin register_routes(routes)
+            # function come first.
+            server.ws_routes.add_group('default', (
+                (r'^/webserver/info/?$', url_webinfo),
+                (r'^/system/name/?$', url_sysname),
+                (r'^/redirect/to/(https?)/(.+)$', url_redirect2),
+                (r'^/redirect/to(/.+)$', url_redirect1),
+                (r'^(.+)@$', url_dir),
+                (r'^(.+)!$', url_exec),
+            ))
+
+        def on_worker_start(self, server):
+            '''
+            Set up the state of a thread that handles requests.
+            '''
+            pass
+
+        def handle(self, req):
+            '''
+            Handle a request.
+            '''
+            logger = req.ws_get_logger()
+            opts = req.ws_get_opts()
+            if not init(req, opts, logger):
                 return
+            # nocache(req)  # test
+            url_dispatcher(req, opts, logger)
 
-        url_general_dispatch(req, opts, logger)
+        def on_shutdown(self, server):
+            '''
+            Release the shared state.
+            '''
+            pass
+
+    return DefaultPlugin()
+
+
+class Plugin(object):
+    '''
+    The plugin and its lifecycle hooks.
+
+    It wraps the plugin object, which has a handle(req) method and
+    optional on_start(server), on_worker_start(server),
+    on_shutdown(server) and register_routes(routes) methods, or a
+    request handler function for the plugins that do not have hooks.
+    A register_routes() function in the plugin module is also used.
 
-    # Main.
-    logger = req.ws_get_logger()
-    opts = req.ws_get_opts()
-    init(req, opts, logger)
-    # nocache(req)  # test
-    url_dispatcher(req, opts, logger)
+    The server calls on_start() once in each process that serves the
+    requests, on_worker_start() once in each thread that handles
+    them, handle() for each request and on_shutdown() when it stops.
+    '''
+    def __init__(self, obj, module=None):
+        if callable(getattr(obj, 'handle', None)):
+            self.m_obj = obj
+            self.handle = obj.handle
+        else:
+            self.m_obj = None
+            self.handle = obj  # a request handler function
+        self.m_module = module
+
+    def hook(self, name, *args):
+        '''
+        Call a hook of the plugin object if it has one.
+        '''
+        function = getattr(self.m_obj, name, None)
+        if function is not None:
+            function(*args)
+
+    def register_routes(self, routes):
+        '''
+        Let the plugin add its special URLs.
+        '''
+        for owner in (self.m_obj, self.m_module):
+            function = getattr(owner, 'register_routes', None)
+            if function is not None:
+                function(routes)
+                return
+
+    def on_start(self, server):
+        '''
+        Called once in each process that serves the requests.
+        '''
+        self.hook('on_start', server)
+
+    def on_worker_start(self, server):
+        '''
+        Called once in each thread that handles the requests.
+        '''
+        self.hook('on_worker_start', server)
+
+    def on_shutdown(self, server):
+        '''
+        Called when the server stops.
+        '''
+        self.hook('on_shutdown', server)
 
 
-def get_request_handler(opts, logger):
+def get_plugin(opts, logger):
     '''
-    Load the plugin to get the request handler.
+    Load the plugin.
 
-    If a plugin was not specified, then use the default_request_handler.
+    The entry point (--entry) is a plugin class, a plugin object, a
+    function without arguments that returns the plugin object (like
+    the generated plugin) or a request handler function that accepts
+    the request object.
+
+    If a plugin was not specified, then use the default_plugin.
     '''
     if opts.plugin is None:
-        return default_request_handler
+        return Plugin(default_plugin())
 
     if os.path.exists(opts.plugin) is False:
         logger.error('Plugin file does not exist: "{0}".'.format(opts.plugin))
         sys.exit(1)
     module_name = os.path.splitext(os.path.basename(opts.plugin))[0]
     module = imp.load_source(module_name, opts.plugin)
-    function = getattr(module, opts.entry)
-    return function
+    entry = getattr(module, opts.entry)
+    if inspect.isclass(entry):
+        entry = entry()
+    elif inspect.isfunction(entry) and not inspect.getargspec(entry).args:
+        entry = entry()
+    return Plugin(entry, module)
 
 
-def create_request_handler_class(opts, logger, request_handler):
+def create_request_handler_class(opts, logger, plugin):
     '''
     Factory to make the request handler and add arguments to it.
 
@@ -1503,6 +2644,13 @@ def create_request_handler_class(opts, logger, request_handler):
         s_opts = opts
         s_logger = logger
         allow_reuse_address = True
+        protocol_version = 'HTTP/1.1'  # persistent connections
+        timeout = opts.keep_alive_timeout if opts.keep_alive_timeout > 0 else None
+        ws_requests = 0  # requests handled on this connection
+
+        # An idle persistent connection would hold the only thread
+        # that handles the requests when there are no worker threads.
+        ws_keep_alive = opts.keep_alive_timeout > 0 and (opts.workers > 0 or opts.engine == 'event')
 
         def ws_get_opts(self):
             '''
@@ -1527,61 +2675,3879 @@ def create_request_handler_class(opts, logger, request_handler):
             prefix = '{0}://{1}:{2}'.format(protocol, opts.host, opts.port)
             return prefix
 
-        def do_GET(self):
+        def ws_get_stats(self):
             '''
-            Handle a get request.
+            Provide the server statistics object.
             '''
-            request_handler(self)
+            return self.server.ws_stats
 
-        def do_POST(self):
+        def ws_get_file_cache(self):
             '''
-            Handle a get request.
+            Provide the static file cache object.
+            It is None if there is no cache.
             '''
-            request_handler(self)
+            return self.server.ws_file_cache
 
-    return RequestHandler
+        def ws_get_exec_cache(self):
+            '''
+            Provide the executed script output cache object.
+            It is None if there is no cache.
+            '''
+            return self.server.ws_exec_cache
 
+        def ws_get_cmd_executor(self):
+            '''
+            Provide the command executor object.
+            '''
+            return self.server.ws_cmd_executor
 
-def serve(opts, logger, request_handler):
-    '''
-    Run the webserver until the user types ^C or the process is
-    killed.
-    '''
-    if opts.https is True and opts.cert is None:
-        logger.error('HTTPS must have a cert file (--cert).')
-        sys.exit(1)
-    if opts.https is False and opts.cert is not None:
-        logger.warning('Cert file specified but --https was not specified, did you mean to specify --https?')
+        def ws_get_routes(self):
+            '''
+            Provide the route table of the special URLs.
+            '''
+            return self.server.ws_routes
 
-    try:
-        RequestHandlerClass = create_request_handler_class(opts, logger, request_handler)
-        port = int(opts.port)
-        server = SocketServer.TCPServer((opts.host, port), RequestHandlerClass)
-    except socket.error as exc:
-        logger.error('Failed to start server {0}:{1}: {2}'.format(opts.host, port, exc))
-        sys.exit(1)
+        def ws_get_path_index(self):
+            '''
+            Provide the web directory index object.
+            '''
+            return self.server.ws_path_index
 
-    protocol = 'HTTP'
-    if opts.https:
-        server.socket = ssl.wrap_socket(server.socket, certfile=opts.cert, server_side=True)
-        protocol += 'S'
+        def ws_get_template_cache(self):
+            '''
+            Provide the parsed template cache object.
+            '''
+            return self.server.ws_template_cache
 
+        def ws_get_template_pool(self):
+            '''
+            Provide the template worker process pool object.
+            It is None if there is no pool.
+            '''
+            return self.server.ws_template_pool
 
-    logger.info('Listening on {0}:{1} for {2} requests.'.format(opts.host, opts.port, protocol))
-    os.chdir(opts.webdir)
+        def ws_send_file(self, ifp, offset, count):
+            '''
+            Send count bytes of the file object, starting at offset,
+            after the headers.
 
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        logger.info('Keyboard interrupt.')
+            It uses sendfile() so that the data is copied directly
+            from the file to the socket. HTTPS connections and systems
+            that do not have sendfile() copy it in chunks. Either way
+            the file is never read into memory.
+            '''
+            self.wfile.flush()
+            if SENDFILE is not None and not isinstance(self.connection, ssl.SSLSocket):
+                out_fd = self.connection.fileno()
+                in_fd = ifp.fileno()
+                while count > 0:
+                    try:
+                        sent = SENDFILE(out_fd, in_fd, offset, min(count, 1 << 30))
+                    except OSError as exc:
+                        if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                            raise
+                        # The socket has a timeout, so it is non-blocking.
+                        _, wdy, _ = select.select([], [out_fd], [], self.timeout)
+                        if not wdy:
+                            raise socket.timeout('timed out')
+                        continue
+                    if sent == 0:
+                        break  # the file is shorter than expected
+                    offset += sent
+                    count -= sent
+            else:
+                ifp.seek(offset)
+                while count > 0:
+                    data = ifp.read(min(count, 65536))
+                    if not data:
+                        break  # the file is shorter than expected
+                    self.wfile.write(data)
+                    count -= len(data)
+
+            if count > 0:
+                # The Content-length was wrong, the client
+                # must not reuse the connection.
+                self.close_connection = 1
+
+        def ws_get_body(self):
+            '''
+            Provide the request body object (RequestBody).
+
+            It raises RequestBodyError if the body is invalid or
+            larger than --max-body-size.
+            '''
+            if self.ws_body is None:
+                self.ws_body = RequestBody(self.rfile,
+                                           self.headers,
+                                           RequestHandler.s_opts.max_body_size)
+            return self.ws_body
+
+        def ws_read_form(self):
+            '''
+            Read the form data of a POST request.
+
+            It returns (params, files) where params maps the field
+            names to lists of values, like cgi.parse_qs(), and files
+            maps the names of the file fields of a multipart/form-data
+            body to lists of UploadFile objects. The files are closed
+            after the request is handled.
+
+            If the body is invalid or too large, the error response
+            is sent and None is returned.
+            '''
+            opts = RequestHandler.s_opts
+            ctype, pdict = cgi.parse_header(self.headers.getheader('content-type', ''))
+            try:
+                body = self.ws_get_body()
+                if ctype == 'multipart/form-data':
+                    params, files = parse_multipart(body,
+                                                    pdict.get('boundary'),
+                                                    opts.upload_spool_size,
+                                                    opts.max_part_size)
+                elif ctype == 'application/x-www-form-urlencoded':
+                    params, files = cgi.parse_qs(body.read(), keep_blank_values=1), {}
+                else:
+                    params, files = {}, {}  # the plugin reads the body
+            except RequestBodyError as exc:
+                self.ws_send_body_error(exc)
+                return None
+
+            stats = self.ws_get_stats()
+            for entries in files.values():
+                for entry in entries:
+                    self.ws_uploads.append(entry)
+                    stats.incr('uploads')
+                    stats.incr('upload_bytes', entry.m_size)
+                    if entry.spooled():
+                        stats.incr('uploads_spooled')
+            return params, files
+
+        def ws_send_body_error(self, exc):
+            '''
+            Reject a request because of its body.
+            The connection is closed because the rest of the body
+            was not read.
+            '''
+            self.ws_get_stats().incr('request_body_errors')
+            RequestHandler.s_logger.info('Rejected the body of {0} {1}: {2}.'.format(self.command, self.path, exc))
+            self.close_connection = 1
+            self.send_error(exc.status, str(exc))
+
+        def ws_send_continue(self):
+            '''
+            Tell the client that sent "Expect: 100-continue" to send
+            the body.
+            '''
+            if self.request_version != 'HTTP/1.0' and \
+               self.headers.getheader('expect', '').lower() == '100-continue':
+                self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+                self.wfile.flush()
+
+        def ws_send_chunked(self, pieces):
+            '''
+            Send the pieces of the body, after the headers, as they
+            are produced using the chunked transfer encoding.
+
+            The headers must include "Transfer-Encoding: chunked"
+            for HTTP/1.1 requests. HTTP/1.0 clients do not support
+            it so the pieces are sent as they are and the connection
+            must be closed to end the body (close_connection).
+            '''
+            chunked = self.request_version != 'HTTP/1.0'
+            for piece in pieces:
+                if isinstance(piece, unicode):
+                    piece = piece.encode('utf-8')
+                if not piece:
+                    continue  # an empty chunk ends the body
+                if chunked:
+                    piece = '{0:x}\r\n{1}\r\n'.format(len(piece), piece)
+                self.wfile.write(piece)
+            if chunked:
+                self.wfile.write('0\r\n\r\n')
+
+        def setup(self):
+            '''
+            Do the TLS handshake for HTTPS connections.
+
+            It is done here, in the thread that handles the
+            connection, so that with worker threads (--workers) a
+            slow client does not stall the server thread that
+            accepts the connections. Without them that thread does
+            the handshake, so it always has a timeout
+            (--tls-handshake-timeout).
+            '''
+            self.ws_handshake_failed = False
+            context = getattr(self.server, 'ws_ssl_context', None)
+            if context is not None:
+                stats = self.ws_get_stats()
+                start = time.time()
+                try:
+                    self.request.settimeout(RequestHandler.s_opts.tls_handshake_timeout)
+                    self.request = context.wrap_socket(self.request,
+                                                       server_side=True,
+                                                       do_handshake_on_connect=False)
+                    self.request.do_handshake()
+                    self.request.settimeout(self.timeout)  # the keep-alive timeout or none
+                    stats.add_time('tls_handshake', time.time() - start)
+                except (ssl.SSLError, socket.error) as exc:
+                    stats.incr('tls_handshake_failures')
+                    RequestHandler.s_logger.debug('TLS handshake failed for {0}: {1}.'.format(self.client_address, exc))
+                    self.ws_handshake_failed = True
+            HTTPServer.SimpleHTTPRequestHandler.setup(self)
+
+        def handle(self):
+            '''
+            Handle the requests unless the TLS handshake failed.
+            '''
+            if self.ws_handshake_failed is False:
+                HTTPServer.SimpleHTTPRequestHandler.handle(self)
+
+        def handle_one_request(self):
+            '''
+            Count the requests handled on this connection.
+            '''
+            self.ws_requests += 1
+            self.ws_body = None
+            self.ws_uploads = []
+            HTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+
+        def end_headers(self):
+            '''
+            Tell the client whether the connection will be kept
+            open before ending the headers.
+            '''
+            if not self.close_connection:
+                opts = RequestHandler.s_opts
+                if self.ws_keep_alive is False or (0 < opts.keep_alive_max <= self.ws_requests):
+                    self.send_header('Connection', 'close')
+                else:
+                    if self.request_version == 'HTTP/1.0':
+                        self.send_header('Connection', 'keep-alive')
+                    keep_alive = 'timeout={0}'.format(opts.keep_alive_timeout)
+                    if opts.keep_alive_max > 0:
+                        keep_alive += ', max={0}'.format(opts.keep_alive_max - self.ws_requests)
+                    self.send_header('Keep-Alive', keep_alive)
+            HTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+        def do_GET(self):
+            '''
+            Handle a get request.
+            '''
+            plugin.handle(self)
+
+        def do_POST(self):
+            '''
+            Handle a post request.
+
+            The size of the body is checked before the plugin runs so
+            that a body that is too large is rejected before it is read.
+            '''
+            try:
+                body = self.ws_get_body()
+            except RequestBodyError as exc:
+                self.ws_send_body_error(exc)
+                return
+            self.ws_send_continue()
+            try:
+                plugin.handle(self)
+            finally:
+                for entry in self.ws_uploads:
+                    entry.close()
+                if not body.finished():
+                    # The next request would start in the middle
+                    # of the body.
+                    self.close_connection = 1
+
+    return RequestHandler
+
+
+class RequestBodyError(Exception):
+    '''
+    The request body is invalid.
+    The status is the HTTP error code of the response.
+    '''
+    def __init__(self, msg, status=400):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+class RequestTooLarge(RequestBodyError):
+    '''
+    The request body, or one of its parts, is too large.
+    '''
+    def __init__(self, msg):
+        RequestBodyError.__init__(self, msg, 413)
+
+
+class RequestBody(object):
+    '''
+    File like object that reads the request body without reading
+    past it, so that the connection can be reused.
+
+    The body is delimited by the Content-Length header or it uses
+    the chunked transfer encoding, which is decoded. If max_size is
+    greater than 0, RequestTooLarge is raised when the body is larger:
+    when the object is created for a Content-Length, before any of
+    the body is read, and as soon as the chunks add up to more than
+    max_size for a chunked body.
+    '''
+    def __init__(self, rfile, headers, max_size=0):
+        self.m_rfile = rfile
+        self.m_max_size = max_size
+        self.m_size = 0  # bytes read
+        self.m_left = 0  # bytes left in the body or the current chunk
+        self.m_chunked = False
+        self.m_chunks = 0
+        self.m_done = True  # no more chunks
+
+        encoding = headers.getheader('transfer-encoding', 'identity').strip().lower()
+        if encoding == 'chunked':
+            self.m_chunked = True
+            self.m_done = False
+            return  # the Content-Length is ignored
+        if encoding != 'identity':
+            raise RequestBodyError('Unsupported transfer encoding "{0}"'.format(encoding), 501)
+
+        length = headers.getheader('content-length', '0').strip()
+        if not length.isdigit():
+            raise RequestBodyError('Invalid Content-Length "{0}"'.format(length))
+        self.m_left = int(length)
+        if 0 < max_size < self.m_left:
+            raise RequestTooLarge('Request body is larger than {0} bytes'.format(max_size))
+
+    def finished(self):
+        '''
+        Has all of the body been read?
+        '''
+        return self.m_left == 0 and self.m_done
+
+    def next_chunk(self):
+        '''
+        Read the size line of the next chunk.
+        The trailer is skipped after the last chunk.
+        '''
+        if self.m_chunks > 0 and self.m_rfile.readline(3) not in ('\r\n', '\n'):
+            raise RequestBodyError('Invalid chunk, it does not end with CRLF')
+        line = self.m_rfile.readline(1024)
+        if not line.endswith('\n'):
+            raise RequestBodyError('Invalid or incomplete chunk size line')
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise RequestBodyError('Invalid chunk size')
+        self.m_chunks += 1
+
+        if size == 0:
+            while True:
+                line = self.m_rfile.readline(8192)
+                if not line.endswith('\n'):
+                    raise RequestBodyError('Invalid or incomplete chunk trailer')
+                if line in ('\r\n', '\n'):
+                    break
+            self.m_done = True
+            return
+
+        if 0 < self.m_max_size < self.m_size + size:
+            raise RequestTooLarge('Request body is larger than {0} bytes'.format(self.m_max_size))
+        self.m_left = size
+
+    def read(self, size=-1):
+        '''
+        Read at most size bytes, fewer if the end of a chunk is
+        reached, or the rest of the body if size is negative.
+        It returns '' at the end of the body.
+        '''
+        if size < 0:
+            pieces = []
+            while True:
+                data = self.read(65536)
+                if not data:
+                    return ''.join(pieces)
+                pieces.append(data)
+
+        while self.m_left == 0 and self.m_done is False:
+            self.next_chunk()
+        if self.m_left == 0 or size == 0:
+            return ''
+        data = self.m_rfile.read(min(size, self.m_left))
+        if not data:
+            raise RequestBodyError('Incomplete request body')
+        self.m_left -= len(data)
+        self.m_size += len(data)
+        return data
+
+
+def chunked_body_end(data, pos, total=0, max_size=0):
+    '''
+    Find the end of a chunked request body in data, scanning from
+    the chunk size line at the pos offset. The total is the size of
+    the chunks before it.
+
+    It returns (end, pos, total). The end is the offset after the
+    body or -1 if the body is incomplete. In that case the scan can
+    be resumed, when more data is received, from the pos and total
+    so that each chunk is only scanned once. It raises
+    RequestBodyError if the body is invalid and RequestTooLarge if
+    it is larger than max_size.
+    '''
+    while True:
+        eol = data.find('\n', pos)
+        if eol < 0:
+            if len(data) - pos > 1024:
+                raise RequestBodyError('Invalid chunk size line')
+            return (-1, pos, total)
+        try:
+            size = int(str(data[pos:eol]).split(';', 1)[0].strip(), 16)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise RequestBodyError('Invalid chunk size')
+
+        if size == 0:
+            # Skip the trailer.
+            end = eol + 1
+            while True:
+                eol = data.find('\n', end)
+                if eol < 0:
+                    return (-1, pos, total)  # rescan the last chunk
+                line = str(data[end:eol])
+                end = eol + 1
+                if line in ('', '\r'):
+                    return (end, pos, total)
+
+        total += size
+        if 0 < max_size < total:
+            raise RequestTooLarge('Request body is larger than {0} bytes'.format(max_size))
+        pos = eol + 1 + size + 2  # the data and the CRLF
+        if pos > len(data):
+            return (-1, pos, total)
+
+
+class UploadFile(object):
+    '''
+    A part of a multipart/form-data request body, like an uploaded
+    file.
+
+    The data is kept in memory until there is more than spool_size
+    bytes of it, then it is written to a temporary file. The
+    temporary file does not have a name, it is deleted when it is
+    closed.
+
+    The file name is the one sent by the client without the
+    directory. The plugin must not trust it.
+    '''
+    def __init__(self, name, filename, headers, spool_size, max_size=0):
+        self.m_name = name
+        self.m_filename = filename
+        self.m_headers = headers  # lower case name --> value
+        self.m_ctype = headers.get('content-type', 'text/plain')
+        self.m_size = 0
+        self.m_spool_size = spool_size
+        self.m_max_size = max_size
+        if spool_size > 0:
+            self.m_file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        else:
+            self.m_file = tempfile.TemporaryFile()
+
+    def write(self, data):
+        '''
+        Add data to the part.
+        '''
+        if not data:
+            return
+        self.m_size += len(data)
+        if 0 < self.m_max_size < self.m_size:
+            raise RequestTooLarge('Part "{0}" is larger than {1} bytes'.format(self.m_name, self.m_max_size))
+        self.m_file.write(data)
+
+    def spooled(self):
+        '''
+        Was the data written to a temporary file?
+        '''
+        return self.m_spool_size == 0 or self.m_size > self.m_spool_size
+
+    def read(self):
+        '''
+        Read all of the data into memory.
+        '''
+        self.m_file.seek(0)
+        return self.m_file.read()
+
+    def save(self, path):
+        '''
+        Copy the data to a file without reading it into memory.
+        '''
+        self.m_file.seek(0)
+        with open(path, 'wb') as ofp:
+            shutil.copyfileobj(self.m_file, ofp)
+
+    def close(self):
+        '''
+        Release the data.
+        '''
+        self.m_file.close()
+
+
+def parse_multipart(body, boundary, spool_size=1 << 20, max_part_size=0):
+    '''
+    Parse a multipart/form-data request body as it is read.
+
+    Unlike cgi.parse_multipart() the parts are never all in memory
+    at the same time, each one is written to an UploadFile object
+    (see spool_size) as it is received, a block at a time.
+
+    It returns (params, files) where params maps the names of the
+    fields that do not have a file name to lists of values and files
+    maps the names of the file fields to lists of UploadFile objects.
+    '''
+    if not boundary or len(boundary) > 200:
+        raise RequestBodyError('Invalid multipart boundary')
+    marker = '\r\n--' + boundary
+    keep = len(marker) - 1  # a marker can span two reads
+    params = {}
+    files = {}
+    part = None  # None for the preamble
+    buf = '\r\n'  # the first boundary does not follow a CRLF
+
+    def fill(buf):
+        '''
+        Read the next block of the body.
+        '''
+        data = body.read(65536)
+        if not data:
+            raise RequestBodyError('Incomplete multipart body')
+        return buf + data
+
+    try:
+        while True:
+            pos = buf.find(marker)
+            if pos < 0:
+                if len(buf) > keep:
+                    if part is not None:
+                        part.write(buf[:-keep])
+                    buf = buf[-keep:]
+                buf = fill(buf)
+                continue
+
+            if part is not None:
+                part.write(buf[:pos])
+                if part.m_name is None:
+                    part.close()  # it is not a form field
+                elif part.m_filename is None:
+                    params.setdefault(part.m_name, []).append(part.read())
+                    part.close()
+                else:
+                    files.setdefault(part.m_name, []).append(part)
+                part = None
+            buf = buf[pos + len(marker):]
+
+            # The rest of the boundary line and the part headers.
+            while len(buf) < 2 or (buf[:2] != '--' and buf.find('\r\n\r\n') < 0):
+                if len(buf) > 16384:
+                    raise RequestBodyError('Multipart headers are too long')
+                buf = fill(buf)
+            if buf[:2] == '--':
+                body.read()  # the epilogue
+                break
+
+            end = buf.find('\r\n\r\n')
+            headers = {}
+            for line in buf[:end].split('\r\n')[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            buf = buf[end + 4:]
+
+            _, pdict = cgi.parse_header(headers.get('content-disposition', ''))
+            filename = pdict.get('filename')
+            if filename is not None:
+                filename = os.path.basename(filename.replace('\\', '/'))
+            part = UploadFile(pdict.get('name'), filename, headers, spool_size, max_part_size)
+    except BaseException:
+        if part is not None:
+            part.close()
+        for entries in files.values():
+            for entry in entries:
+                entry.close()
+        raise
+
+    return params, files
+
+
+class ServerStats(object):
+    '''
+    Thread safe server statistics.
+
+    There are two kinds of statistics: counters, which are
+    incremented or decremented, and timers, which record the
+    count, total and maximum of a duration in seconds.
+    '''
+    def __init__(self):
+        self.m_lock = threading.Lock()
+        self.m_counters = {}
+        self.m_timers = {}
+        self.m_sources = []  # (prefix, function) pairs
+
+    def register(self, prefix, function):
+        '''
+        Register a function that returns a dictionary of statistics
+        that are maintained elsewhere, like the OpenSSL session
+        cache statistics.
+        '''
+        self.m_sources.append((prefix, function))
+
+    def incr(self, name, num=1):
+        '''
+        Increment a counter.
+        '''
+        with self.m_lock:
+            self.m_counters[name] = self.m_counters.get(name, 0) + num
+
+    def add_time(self, name, secs):
+        '''
+        Record a duration.
+        '''
+        with self.m_lock:
+            count, total, maxval = self.m_timers.get(name, (0, 0., 0.))
+            self.m_timers[name] = (count + 1, total + secs, max(maxval, secs))
+
+    def snapshot(self):
+        '''
+        Get a copy of the statistics as a flat dictionary.
+        '''
+        with self.m_lock:
+            entries = dict(self.m_counters)
+            for name, (count, total, maxval) in self.m_timers.items():
+                entries[name + '_count'] = count
+                entries[name + '_avg_ms'] = round(1000. * total / count, 3)
+                entries[name + '_max_ms'] = round(1000. * maxval, 3)
+        for prefix, function in self.m_sources:
+            for name, val in function().items():
+                entries[prefix + name] = val
+        return entries
+
+
+class WorkerProcess(object):
+    '''
+    A worker process and the pipe used to talk to it.
+    The worker is forked by the worker spawner process so it is not
+    a child of the server.
+    '''
+    def __init__(self, conn, pid):
+        self.m_conn = conn
+        self.m_pid = pid
+        self.m_keys = set()  # the code that the worker already has
+
+    def stop(self, kill=False):
+        '''
+        Stop the worker process.
+
+        A worker exits when its pipe is closed, the worker spawner
+        process waits for it.
+        '''
+        try:
+            if kill:
+                os.kill(self.m_pid, signal.SIGKILL)
+            self.m_conn.close()
+        except (OSError, IOError):
+            pass
+
+
+def worker_spawner_main(conn, server_conn):
+    '''
+    Fork the worker processes of the pools.
+
+    Each request is a (target, args) tuple. It forks a worker that
+    calls the target function with its end of a new pipe and the
+    arguments, and sends back the pid of the worker and the server
+    end of the pipe. It waits for the workers that exit and, when
+    the server closes the pipe, stops the workers that are left.
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the server stops the spawner
+    server_conn.close()  # so that the server closing it is seen
+
+    def reap(pids):
+        for pid in list(pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    pids.discard(pid)
+            except OSError:
+                pids.discard(pid)
+
+    pids = set()
+    while True:
+        try:
+            request = conn.recv() if conn.poll(1) else None
+        except (EOFError, IOError, KeyboardInterrupt):
+            break
+        reap(pids)
+        if request is None:
+            continue
+
+        target, args = request
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                conn.close()
+                parent_conn.close()
+                target(child_conn, *args)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+        pids.add(pid)
+        conn.send(pid)
+        multiprocessing.reduction.send_handle(conn, parent_conn.fileno(), None)
+        parent_conn.close()
+
+    # The server closed the worker pipes, give the workers a second
+    # to exit.
+    deadline = time.time() + 1
+    while pids and time.time() < deadline:
+        time.sleep(0.05)
+        reap(pids)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+class WorkerSpawner(object):
+    '''
+    The process that forks the worker processes of the pools.
+
+    The server is multithreaded when a worker is replaced and a
+    process forked by a thread only inherits the locks held by the
+    other threads, like a logging handler lock, in whatever state
+    they are in. The spawner is forked before the server starts its
+    threads and forks all of the workers for it instead.
+    '''
+    def __init__(self):
+        self.m_conn = None
+        self.m_process = None
+        self.m_lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start the worker spawner process.
+        '''
+        self.m_conn, child_conn = multiprocessing.Pipe()
+        self.m_process = multiprocessing.Process(target=worker_spawner_main, args=(child_conn, self.m_conn))
+        self.m_process.daemon = True
+        self.m_process.start()
+        child_conn.close()
+
+    def spawn(self, target, *args):
+        '''
+        Start a worker process that runs the target function.
+        '''
+        with self.m_lock:
+            self.m_conn.send((target, args))
+            pid = self.m_conn.recv()
+            fd = multiprocessing.reduction.recv_handle(self.m_conn)
+        return WorkerProcess(_multiprocessing.Connection(fd), pid)
+
+    def stop(self):
+        '''
+        Stop the worker spawner process and the workers that are left.
+        '''
+        self.m_conn.close()
+        self.m_process.join(2)
+        if self.m_process.is_alive():
+            self.m_process.terminate()
+            self.m_process.join()
+
+
+class WorkerPool(object):
+    '''
+    Pool of warm worker processes that run the target function.
+
+    The idle workers are in a queue. A worker that failed or
+    exceeded a limit is replaced by a new one. The workers are
+    forked by the worker spawner process (WorkerSpawner).
+    '''
+    def __init__(self, count, target, *args):
+        self.m_count = count
+        self.m_target = target
+        self.m_args = args
+        self.m_spawner = None
+        self.m_idle = Queue.Queue()
+        self.m_workers = []
+        self.m_lock = threading.Lock()
+        self.m_restarts = 0
+
+    def start(self, spawner):
+        '''
+        Start the worker processes.
+        It is called by the process that serves the requests.
+        '''
+        self.m_spawner = spawner
+        for i in range(self.m_count):
+            self.m_idle.put(self.spawn())
+
+    def spawn(self):
+        '''
+        Start a worker process.
+        '''
+        worker = self.m_spawner.spawn(self.m_target, *self.m_args)
+        with self.m_lock:
+            self.m_workers.append(worker)
+        return worker
+
+    def replace(self, worker, kill=False):
+        '''
+        Replace a worker process that failed or exceeded a limit.
+        '''
+        worker.stop(kill)
+        with self.m_lock:
+            self.m_workers.remove(worker)
+            self.m_restarts += 1
+        return self.spawn()
+
+    def stop(self):
+        '''
+        Stop all of the worker processes.
+        '''
+        with self.m_lock:
+            workers = list(self.m_workers)
+            self.m_workers = []
+        for worker in workers:
+            worker.stop()
+
+
+class ScriptOutput(object):
+    '''
+    File object for the standard output of a python script that
+    runs in a script worker process. The output is sent to the
+    server in pieces of up to size bytes and when it is flushed.
+    '''
+    def __init__(self, conn, size=65536):
+        self.m_conn = conn
+        self.m_size = size
+        self.m_pieces = []
+        self.m_length = 0
+        self.softspace = 0  # used by the print statement
+
+    def write(self, data):
+        '''
+        Write a string, unicode is encoded as UTF-8.
+        '''
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.m_pieces.append(data)
+        self.m_length += len(data)
+        if self.m_length >= self.m_size:
+            self.flush()
+
+    def writelines(self, lines):
+        '''
+        Write a sequence of strings.
+        '''
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        '''
+        Send the buffered output.
+        '''
+        if self.m_pieces:
+            self.m_conn.send(('out', ''.join(self.m_pieces)))
+            self.m_pieces = []
+            self.m_length = 0
+
+    def isatty(self):
+        '''
+        It is not a terminal.
+        '''
+        return False
+
+
+def script_worker_main(conn, max_requests, memory_limit):
+    '''
+    Run python scripts sent by the server as if they were run
+    by the python interpreter.
+
+    Each request is the path of a script. The output is sent as
+    ('out', data) messages, the end as a ('done', exit status,
+    recycle) message. The process exits after max_requests scripts
+    or when the memory limit is exceeded so that it is replaced.
+    The modules imported by the scripts stay loaded in between.
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the server stops the workers
+    if memory_limit > 0:
+        set_memory_limit(memory_limit)
+
+    cwd = os.getcwd()
+    count = 0
+    while True:
+        try:
+            path = conn.recv()
+        except (EOFError, IOError, KeyboardInterrupt):
+            break
+
+        count += 1
+        recycle = max_requests > 0 and count >= max_requests
+        out = ScriptOutput(conn)
+        saved = (sys.stdout, sys.stderr, sys.argv, list(sys.path))
+        sys.stdout = sys.stderr = out
+        sys.argv = [path]
+        sys.path.insert(0, os.path.dirname(path))
+        status = 0
+        try:
+            runpy.run_path(path, run_name='__main__')
+        except SystemExit as exc:
+            if exc.code is None or isinstance(exc.code, int):
+                status = exc.code or 0
+            else:
+                out.write('{0}\n'.format(exc.code))
+                status = 1
+        except MemoryError:
+            out.write('memory limit of {0} bytes exceeded\n'.format(memory_limit))
+            status = 1
+            recycle = True
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr, sys.argv, sys.path[:] = saved
+            os.chdir(cwd)
+        out.flush()
+        conn.send(('done', status, recycle))
+        if recycle:
+            break
+    conn.close()
+
+
+class ScriptPool(WorkerPool):
+    '''
+    Pool of long lived worker processes that run the python scripts
+    (URLs ending in '!') without starting a new interpreter and
+    importing the modules for each request.
+
+    The workers are forked from the server before it starts its
+    threads (see WorkerSpawner), so the modules that it imported are
+    already loaded.
+    '''
+    def __init__(self, count, max_requests, memory_limit):
+        WorkerPool.__init__(self, count, script_worker_main, max_requests, memory_limit)
+        self.m_runs = 0
+        self.m_recycles = 0
+
+    @staticmethod
+    def accepts(cmd):
+        '''
+        Is the command a python script that the workers can run?
+
+        Like the shell, it only runs executable files, and only
+        those with a python #! line are run by the workers so that
+        other .py files, like the plugins, are never run.
+        '''
+        if cmd.endswith('.py') is False or os.path.isfile(cmd) is False or os.access(cmd, os.X_OK) is False:
+            return False
+        try:
+            with open(cmd, 'r') as ifp:
+                line = ifp.readline(256)
+        except IOError:
+            return False
+        return line.startswith('#!') and line.find('python') > 0
+
+    def stats(self):
+        '''
+        Get the pool statistics.
+        '''
+        with self.m_lock:
+            return {'workers': len(self.m_workers),
+                    'idle': self.m_idle.qsize(),
+                    'runs': self.m_runs,
+                    'recycles': self.m_recycles,
+                    'restarts': self.m_restarts}
+
+
+class ScriptRun(object):
+    '''
+    A python script that runs in a script worker process.
+
+    It generates the output like a Command. The worker is given back
+    to the pool when the script is done, it is killed and replaced if
+    the script times out or if it is closed early (the client went
+    away).
+    '''
+    def __init__(self, executor, pool, path, timeout):
+        self.m_executor = executor
+        self.m_pool = pool
+        self.m_path = path
+        self.m_timeout = timeout
+        self.m_deadline = time.time() + timeout if timeout > 0 else None
+        self.m_closed = False
+        self.m_done = False
+        self.m_recycle = False
+        try:
+            self.m_worker = pool.m_idle.get(timeout=timeout if timeout > 0 else None)
+        except Queue.Empty:
+            raise CommandBusy('No free script worker')
+        try:
+            self.m_worker.m_conn.send(path)
+        except (IOError, OSError):
+            pool.m_idle.put(pool.replace(self.m_worker, kill=True))
+            raise
+        with pool.m_lock:
+            pool.m_runs += 1
+
+    def __iter__(self):
+        '''
+        Generate the output as it is produced.
+        It raises CommandTimeout if the script runs for too long.
+        '''
+        conn = self.m_worker.m_conn
+        try:
+            while True:
+                if self.m_deadline is not None:
+                    remaining = self.m_deadline - time.time()
+                    if remaining <= 0 or not conn.poll(remaining):
+                        self.m_executor.incr('m_timeouts')
+                        raise CommandTimeout('Command timed out after {0} seconds'.format(self.m_timeout))
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    raise IOError('The script worker process exited')
+                if msg[0] == 'out':
+                    yield msg[1]
+                else:
+                    self.m_done = True
+                    self.m_recycle = msg[2]
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Give the worker back to the pool, or replace it if it is
+        still running the script or it must be recycled, and release
+        the slot.
+        '''
+        if self.m_closed:
+            return
+        self.m_closed = True
+        pool = self.m_pool
+        if self.m_done and not self.m_recycle:
+            pool.m_idle.put(self.m_worker)
+        else:
+            if self.m_done:
+                with pool.m_lock:
+                    pool.m_recycles += 1
+            else:
+                self.m_executor.incr('m_killed')
+            pool.m_idle.put(pool.replace(self.m_worker, kill=not self.m_done))
+        self.m_executor.release(self.m_path)
+
+
+class CommandBusy(Exception):
+    '''
+    There is no free slot to run a command.
+    '''
+    pass
+
+
+class CommandTimeout(Exception):
+    '''
+    A command ran for too long.
+    '''
+    pass
+
+
+class Command(object):
+    '''
+    A running command whose output is read in pieces.
+
+    It runs in its own process group so that the shell and the
+    processes that it starts can be killed together when it times
+    out or when it is closed early (the client went away). Closing
+    it gives its slot back to the executor.
+    '''
+    def __init__(self, executor, cmd, timeout, size=65536):
+        self.m_executor = executor
+        self.m_cmd = cmd
+        self.m_size = size
+        self.m_deadline = time.time() + timeout if timeout > 0 else None
+        self.m_timeout = timeout
+        self.m_closed = False
+        self.m_proc = subprocess.Popen(cmd,
+                                       shell=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       preexec_fn=os.setpgrp)
+
+    def __iter__(self):
+        '''
+        Generate the output as it is produced.
+
+        os.read() returns as soon as there is any output, up to size
+        bytes, so the pieces can be sent in real time without reading
+        a character at a time. It raises CommandTimeout if the command
+        runs for too long.
+        '''
+        fd = self.m_proc.stdout.fileno()
+        try:
+            while True:
+                if self.m_deadline is not None:
+                    remaining = self.m_deadline - time.time()
+                    if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                        self.m_executor.incr('m_timeouts')
+                        raise CommandTimeout('Command timed out after {0} seconds'.format(self.m_timeout))
+                data = os.read(fd, self.m_size)
+                if not data:
+                    break  # all done
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Kill the command if it is still running and release its slot.
+        '''
+        if self.m_closed:
+            return
+        self.m_closed = True
+        self.m_proc.stdout.close()
+        if self.m_proc.poll() is None:
+            self.m_executor.incr('m_killed')
+            try:
+                os.killpg(self.m_proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.m_proc.wait()
+        self.m_executor.release(self.m_cmd)
+
+
+class CommandExecutor(object):
+    '''
+    Run commands with a limit on how many run at once, in total
+    and per command, and on how long they run.
+
+    Requests that cannot run a command right away wait in a bounded
+    queue. When the queue is full or the wait is longer than the
+    timeout, CommandBusy is raised so the request fails fast instead
+    of forking more processes than the host can handle.
+
+    The exceptions are also available as the Busy and Timeout class
+    attributes for plugins that cannot import them.
+    '''
+    Busy = CommandBusy
+    Timeout = CommandTimeout
+
+    def __init__(self, max_running, max_per_command, max_queued, timeout, scripts=None):
+        self.m_cond = threading.Condition()
+        self.m_scripts = scripts  # the ScriptPool or None
+        self.m_running = {}  # cmd --> number running
+        self.m_total = 0
+        self.m_queued = 0
+        self.m_max_running = max_running
+        self.m_max_per_command = max_per_command
+        self.m_max_queued = max_queued
+        self.m_timeout = timeout
+        self.m_started = 0
+        self.m_rejected = 0
+        self.m_timeouts = 0
+        self.m_killed = 0
+
+    def incr(self, attr):
+        '''
+        Increment a counter.
+        '''
+        with self.m_cond:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def available(self, cmd):
+        '''
+        Is there a free slot for the command?
+        The caller holds the lock.
+        '''
+        if self.m_max_running > 0 and self.m_total >= self.m_max_running:
+            return False
+        if self.m_max_per_command > 0 and self.m_running.get(cmd, 0) >= self.m_max_per_command:
+            return False
+        return True
+
+    def acquire(self, cmd):
+        '''
+        Wait for a free slot for the command.
+        It raises CommandBusy if there is none.
+        '''
+        with self.m_cond:
+            if not self.available(cmd):
+                if self.m_queued >= self.m_max_queued:
+                    self.m_rejected += 1
+                    raise CommandBusy('Too many commands are running')
+                self.m_queued += 1
+                deadline = time.time() + self.m_timeout if self.m_timeout > 0 else None
+                try:
+                    while not self.available(cmd):
+                        if deadline is None:
+                            self.m_cond.wait()
+                            continue
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.m_rejected += 1
+                            raise CommandBusy('Timed out waiting for a command to finish')
+                        self.m_cond.wait(remaining)
+                finally:
+                    self.m_queued -= 1
+            self.m_total += 1
+            self.m_running[cmd] = self.m_running.get(cmd, 0) + 1
+            self.m_started += 1
+
+    def release(self, cmd):
+        '''
+        Give back the slot of a command that finished.
+        '''
+        with self.m_cond:
+            self.m_total -= 1
+            self.m_running[cmd] -= 1
+            if self.m_running[cmd] == 0:
+                del self.m_running[cmd]
+            self.m_cond.notify_all()
+
+    def start(self, cmd):
+        '''
+        Start a command when there is a free slot.
+
+        The returned Command, or ScriptRun for python scripts if there
+        is a script worker pool, generates the output. It must be read
+        to the end or closed to release the slot.
+        '''
+        self.acquire(cmd)
+        try:
+            if self.m_scripts is not None and self.m_scripts.accepts(cmd):
+                return ScriptRun(self, self.m_scripts, cmd, self.m_timeout)
+            return Command(self, cmd, self.m_timeout)
+        except Exception:
+            self.release(cmd)
+            raise
+
+    def stats(self):
+        '''
+        Get the executor statistics.
+        '''
+        with self.m_cond:
+            return {'running': self.m_total,
+                    'queued': self.m_queued,
+                    'started': self.m_started,
+                    'rejected': self.m_rejected,
+                    'timeouts': self.m_timeouts,
+                    'killed': self.m_killed}
+
+
+class RouteTable(object):
+    '''
+    Thread safe table of the special URL routes.
+
+    A route is a regular expression and the function that handles
+    the URLs that it matches. The first route that matches wins.
+
+    Matching a URL does not try every route. The routes that start
+    with a literal first path segment, like ^/webserver/info/?$, are
+    grouped by that segment. The routes that end with a literal,
+    like ^(.+)!$, are grouped by the last character. The others are
+    combined into alternations that are matched at once. So the cost
+    of a dispatch stays flat as the number of routes grows.
+    '''
+    m_special = set('.^$*+?{}[]\\|()')
+    m_max_groups = 90  # the re module supports 100 groups
+
+    def __init__(self):
+        self.m_lock = threading.Lock()
+        self.m_routes = []  # (regex, function) in order
+        self.m_groups = set()
+        self.m_table = None
+        self.m_matches = 0
+        self.m_misses = 0
+
+    def __contains__(self, name):
+        '''
+        Has the group of routes been added?
+        '''
+        return name in self.m_groups
+
+    def add(self, pattern, function):
+        '''
+        Add a route.
+        The function is called with the request, the options, the
+        logger and the groups of the match.
+        '''
+        regex = re.compile(pattern)
+        with self.m_lock:
+            self.m_routes.append((regex, function))
+            self.m_table = None  # compiled on the next match
+
+    def add_group(self, name, routes):
+        '''
+        Add the (pattern, function) routes once.
+        '''
+        regexes = [(re.compile(pattern), function) for pattern, function in routes]
+        with self.m_lock:
+            if name in self.m_groups:
+                return
+            self.m_groups.add(name)
+            self.m_routes.extend(regexes)
+            self.m_table = None
+
+    @classmethod
+    def literal_prefix(cls, pattern):
+        '''
+        Get the literal text that every match starts with.
+        '''
+        if not pattern.startswith('^') or '|' in pattern:
+            return ''
+        prefix = []
+        for char in pattern[1:]:
+            if char in cls.m_special:
+                if char in '*?{' and prefix:
+                    prefix.pop()  # the last character is optional
+                break
+            prefix.append(char)
+        return ''.join(prefix)
+
+    @classmethod
+    def literal_suffix(cls, pattern):
+        '''
+        Get the literal text that every match ends with.
+        '''
+        if not pattern.endswith('$') or pattern.endswith('\\$') or '|' in pattern:
+            return ''
+        end = len(pattern) - 1
+        start = end
+        while start > 0 and pattern[start - 1] not in cls.m_special:
+            start -= 1
+        if start > 0 and pattern[start - 1] == '\\':
+            start += 1  # escaped
+        return pattern[start:end]
+
+    def compile(self):
+        '''
+        Build the lookup table from the routes.
+        '''
+        prefixes = {}  # first path segment --> [index]
+        suffixes = {}  # last character --> [index]
+        singles = []  # always tried
+        others = []
+        for index, (regex, function) in enumerate(self.m_routes):
+            prefix = self.literal_prefix(regex.pattern)
+            suffix = self.literal_suffix(regex.pattern)
+            segments = prefix.split('/')
+            if regex.flags:
+                singles.append(index)  # like (?i), the literals may not match as is
+            elif prefix.startswith('/') and len(segments) > 2 and segments[1]:
+                prefixes.setdefault(segments[1], []).append(index)
+            elif suffix:
+                suffixes.setdefault(suffix[-1], []).append(index)
+            elif regex.groupindex or re.search(r'\\\d|\(\?P=', regex.pattern):
+                singles.append(index)  # names and back references cannot be combined
+            else:
+                others.append(index)
+
+        # Combine the other routes into alternations. Each one is
+        # matched anywhere in the path like search() would, unless
+        # it is anchored, the first alternative that matches is the
+        # first route.
+        batches = []
+        batch = []
+        groups = 0
+        for index in others:
+            regex = self.m_routes[index][0]
+            if batch and groups + regex.groups + 1 > self.m_max_groups:
+                batches.append(batch)
+                batch = []
+                groups = 0
+            batch.append(index)
+            groups += regex.groups + 1
+        if batch:
+            batches.append(batch)
+        combined = []
+        for batch in batches:
+            alternatives = []
+            for index in batch:
+                pattern = self.m_routes[index][0].pattern
+                if not pattern.startswith('^'):
+                    pattern = '.*?(?:{0})'.format(pattern)
+                alternatives.append('(?:{0})(?P<r{1}>)'.format(pattern, index))
+            pattern = '|'.join(alternatives)
+            combined.append(re.compile(pattern))
+        return prefixes, suffixes, singles, combined
+
+    def match(self, path):
+        '''
+        Get the (function, args, kwargs) tuple of the first route
+        that matches the path. It is None if there is none.
+        '''
+        table = self.m_table
+        if table is None:
+            with self.m_lock:
+                if self.m_table is None:
+                    self.m_table = self.compile()
+                table = self.m_table
+        routes = self.m_routes
+        prefixes, suffixes, singles, combined = table
+
+        best = len(routes)
+        for regex in combined:
+            match = regex.match(path)
+            if match is not None:
+                best = int(match.lastgroup[1:])
+                break
+        segments = path.split('/', 2)
+        candidates = list(prefixes.get(segments[1], [])) if len(segments) > 1 else []
+        candidates += suffixes.get(path[-1:], []) + singles
+        for index in sorted(candidates):
+            if index >= best:
+                break
+            if routes[index][0].search(path) is not None:
+                best = index
+                break
+
+        with self.m_lock:
+            if best == len(routes):
+                self.m_misses += 1
+                return None
+            self.m_matches += 1
+        regex, function = routes[best]
+        match = regex.search(path)
+        return function, match.groups(), match.groupdict()
+
+    def stats(self):
+        '''
+        Get the route statistics.
+        '''
+        with self.m_lock:
+            return {'count': len(self.m_routes),
+                    'matches': self.m_matches,
+                    'misses': self.m_misses}
+
+
+class ExecCache(object):
+    '''
+    Thread safe cache of the output of executed scripts.
+
+    Each URL path has a time to live, the first matching pattern
+    wins, otherwise it is the default. The entries are evicted in
+    least recently used order.
+
+    Concurrent requests for the same key are coalesced: the first
+    one runs the script and the others wait for its output instead
+    of running it again.
+    '''
+    m_max_entries = 256
+
+    def __init__(self, ttl, path_ttls):
+        self.m_lock = threading.Lock()
+        self.m_entries = collections.OrderedDict()  # key --> (expires, data)
+        self.m_pending = {}  # key --> [event, data, exception]
+        self.m_ttl = ttl
+        self.m_path_ttls = path_ttls  # [(pattern, ttl)]
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_coalesced = 0
+
+    def ttl(self, urlpath):
+        '''
+        Get the time to live of the output for the URL path.
+        If it is 0, the output is not cached.
+        '''
+        for pattern, ttl in self.m_path_ttls:
+            if fnmatch.fnmatchcase(urlpath, pattern):
+                return ttl
+        return self.m_ttl
+
+    def get(self, key, ttl, produce):
+        '''
+        Get the output for the key.
+
+        If it is not cached or it expired, produce() is called to
+        get it. Only one thread calls it for a key, the others
+        wait for its output or its exception.
+        '''
+        with self.m_lock:
+            entry = self.m_entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.m_hits += 1
+                self.m_entries[key] = self.m_entries.pop(key)  # most recently used
+                return entry[1]
+            pending = self.m_pending.get(key)
+            if pending is None:
+                pending = [threading.Event(), None, None]
+                self.m_pending[key] = pending
+                self.m_misses += 1
+                leader = True
+            else:
+                self.m_coalesced += 1
+                leader = False
+
+        if not leader:
+            pending[0].wait()
+            if pending[2] is not None:
+                raise pending[2]
+            return pending[1]
+
+        try:
+            pending[1] = produce()
+        except Exception as exc:
+            pending[2] = exc
+            raise
+        finally:
+            with self.m_lock:
+                if pending[2] is None:
+                    self.m_entries.pop(key, None)
+                    self.m_entries[key] = (time.time() + ttl, pending[1])
+                    while len(self.m_entries) > self.m_max_entries:
+                        self.m_entries.popitem(last=False)
+                del self.m_pending[key]
+            pending[0].set()
+        return pending[1]
+
+    def stats(self):
+        '''
+        Get the cache statistics.
+        '''
+        with self.m_lock:
+            return {'entries': len(self.m_entries),
+                    'hits': self.m_hits,
+                    'misses': self.m_misses,
+                    'coalesced': self.m_coalesced}
+
+
+class FileCache(object):
+    '''
+    Thread safe in memory cache of static files.
+
+    The entries are keyed by path and evicted in least recently
+    used order when the total size of the cached data exceeds the
+    budget. Each lookup compares the modification time and size of
+    the file so that stale entries are reloaded.
+
+    The cache does not interpret the info object stored with the
+    data. The request handler uses it for the precomputed headers.
+    '''
+    def __init__(self, max_size):
+        self.m_lock = threading.Lock()
+        self.m_entries = collections.OrderedDict()  # (path, variant) --> (mtime, size, data, info)
+        self.m_max_size = max_size
+        self.m_max_file_size = max_size // 16  # a single file cannot flush the cache
+        self.m_size = 0
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_evictions = 0
+
+    def cacheable(self, size):
+        '''
+        Is a file of this size small enough to be cached?
+        '''
+        return size <= self.m_max_file_size
+
+    def lookup(self, path, variant=None):
+        '''
+        Get the (data, info) tuple for the path.
+        It is None if the path is not cached or the entry is stale.
+
+        The variant distinguishes different representations of
+        the same file, like the gzip compressed data.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        key = (path, variant)
+        with self.m_lock:
+            entry = self.m_entries.pop(key, None)
+            if entry is not None:
+                if stat is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                    self.m_entries[key] = entry  # most recently used
+                    self.m_hits += 1
+                    return entry[2], entry[3]
+                self.m_size -= len(entry[2])
+            self.m_misses += 1
+        return None
+
+    def store(self, path, stat, data, info, variant=None):
+        '''
+        Add the file data read from the path. The stat must have
+        been taken before the data was read.
+        '''
+        if not self.cacheable(len(data)):
+            return
+        key = (path, variant)
+        with self.m_lock:
+            entry = self.m_entries.pop(key, None)
+            if entry is not None:
+                self.m_size -= len(entry[2])
+            self.m_entries[key] = (stat.st_mtime, stat.st_size, data, info)
+            self.m_size += len(data)
+            while self.m_size > self.m_max_size:
+                _, entry = self.m_entries.popitem(last=False)
+                self.m_size -= len(entry[2])
+                self.m_evictions += 1
+
+    def stats(self):
+        '''
+        Get the cache statistics.
+        '''
+        with self.m_lock:
+            return {'entries': len(self.m_entries),
+                    'evictions': self.m_evictions,
+                    'hits': self.m_hits,
+                    'misses': self.m_misses,
+                    'size': self.m_size}
+
+
+class PathIndex(object):
+    '''
+    Thread safe index of the file system metadata of the web
+    directory.
+
+    It maps a system path to a dictionary with these entries:
+
+       path    the system path
+       isdir   True if it is a directory
+       file    the file to display, the index file for directories
+               (None if the directory does not have one)
+       size    the file size
+       mtime   the file modification time
+       ctype   the file content type
+
+    Paths that do not exist map to None so that requests for missing
+    paths do not probe the file system again (negative caching).
+
+    The index is built when the server starts. An entry that is
+    older than the ttl is checked with a single stat() of its
+    version: the modification time and size of the file (and of
+    the directory for directories) or the modification time of
+    the closest existing parent directory for missing paths. It is
+    trusted again until the next ttl if the version did not change,
+    otherwise it is resolved again.
+
+    The least recently used entries are evicted first. The missing
+    paths have their own, smaller, limit so that requests for
+    random paths cannot evict the entries of the existing files.
+    '''
+    m_index_files = ['index.html', 'index.htm', 'default.htm', ]
+    m_max_entries = 65536
+    m_max_missing = 4096
+
+    def __init__(self, webdir, ttl, extensions_map):
+        self.m_lock = threading.Lock()
+        self.m_entries = collections.OrderedDict()  # path --> (checked, entry, version)
+        self.m_missing = collections.OrderedDict()  # path --> (checked, None, version)
+        self.m_webdir = os.path.realpath(webdir)  # translate_path() uses os.getcwd()
+        self.m_ttl = ttl
+        self.m_extensions_map = extensions_map
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_negative_hits = 0
+        self.m_revalidated = 0
+
+    def build(self):
+        '''
+        Index the web directory.
+        '''
+        if self.m_ttl == 0:
+            return
+        now = time.time()
+        for root, dirs, files in os.walk(self.m_webdir):
+            for name in [''] + files:
+                if len(self.m_entries) >= self.m_max_entries:
+                    return
+                path = os.path.join(root, name)
+                entry = self.resolve(path)
+                self.store(path, (now, entry, self.version(path, entry)))
+
+    def guess_type(self, path):
+        '''
+        Guess the content type of a file the same way that the
+        SimpleHTTPRequestHandler does.
+        '''
+        ext = os.path.splitext(path)[1]
+        if ext in self.m_extensions_map:
+            return self.m_extensions_map[ext]
+        return self.m_extensions_map.get(ext.lower(), self.m_extensions_map[''])
+
+    def resolve(self, path):
+        '''
+        Get the index entry for the path from the file system.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        entry = {'path': path,
+                 'isdir': os.path.isdir(path),
+                 'file': path,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'ctype': None}
+        if entry['isdir']:
+            entry['file'] = None
+            for index in self.m_index_files:
+                ipath = os.path.join(path, index)
+                try:
+                    stat = os.stat(ipath)
+                except OSError:
+                    continue
+                entry['file'] = ipath
+                entry['size'] = stat.st_size
+                entry['mtime'] = stat.st_mtime
+                break
+        if entry['file'] is not None:
+            entry['ctype'] = self.guess_type(entry['file'])
+        return entry
+
+    @staticmethod
+    def version(path, entry):
+        '''
+        Get the version of an index entry from the file system.
+        It changes when the entry has to be resolved again.
+        '''
+        try:
+            if entry is None:
+                # A missing path appears when its closest existing
+                # parent directory changes.
+                parent = os.path.dirname(path)
+                while True:
+                    try:
+                        return (parent, os.stat(parent).st_mtime)
+                    except OSError:
+                        if os.path.dirname(parent) == parent:
+                            return None
+                        parent = os.path.dirname(parent)
+            stat = os.stat(entry['file'] or path)
+            version = (stat.st_mtime, stat.st_size)
+            if entry['isdir']:
+                version += (os.stat(path).st_mtime, )  # an index file was added or removed
+            return version
+        except OSError:
+            return None
+
+    def store(self, path, item):
+        '''
+        Store an entry, evicting the least recently used ones.
+        The caller must hold the lock, or be the only thread.
+        '''
+        entries, max_entries = self.m_entries, self.m_max_entries
+        if item[1] is None:
+            entries, max_entries = self.m_missing, self.m_max_missing
+        entries[path] = item
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+
+    def lookup(self, path):
+        '''
+        Get the index entry for the path.
+        It is None if the path does not exist.
+        '''
+        if self.m_ttl == 0:
+            return self.resolve(path)
+
+        now = time.time()
+        with self.m_lock:
+            item = self.m_entries.pop(path, None) or self.m_missing.pop(path, None)
+            if item is not None:
+                self.store(path, item)  # most recently used
+
+        if item is not None and now - item[0] > self.m_ttl:
+            if item[2] is not None and self.version(path, item[1]) == item[2]:
+                item = (now, item[1], item[2])  # trusted until the next ttl
+                with self.m_lock:
+                    self.m_revalidated += 1
+                    self.store(path, item)
+            else:
+                item = None
+
+        if item is not None:
+            with self.m_lock:
+                if item[1] is None:
+                    self.m_negative_hits += 1
+                else:
+                    self.m_hits += 1
+            return item[1]
+
+        entry = self.resolve(path)
+        item = (now, entry, self.version(path, entry))
+        with self.m_lock:
+            self.m_misses += 1
+            self.m_entries.pop(path, None)
+            self.m_missing.pop(path, None)
+            self.store(path, item)
+        return entry
+
+    def stats(self):
+        '''
+        Get the index statistics.
+        '''
+        with self.m_lock:
+            return {'entries': len(self.m_entries),
+                    'missing_entries': len(self.m_missing),
+                    'hits': self.m_hits,
+                    'misses': self.m_misses,
+                    'negative_hits': self.m_negative_hits,
+                    'revalidated': self.m_revalidated}
+
+
+class TemplateFragment(object):
+    '''
+    A part of a template whose output is cached for ttl seconds.
+
+    The cache key is made from the values of the key parameters so
+    the output can vary with them. HTML blocks sit between
+    <!-- cache --> and <!-- endcache --> statements, their segments
+    are rendered on a cache miss. Python blocks have the options on
+    the <!-- python cache line, the parameters that they set are
+    cached.
+
+    The options look like this: ttl=60 key=arg1,arg2 name=nav
+    '''
+    m_option_names = ['key', 'name', 'ttl']
+
+    def __init__(self, cache, version, options, default_name):
+        self.m_cache = cache
+        self.m_version = version  # of the file that defines it
+        self.m_name = options.get('name', default_name)
+        self.m_ttl = int(options.get('ttl', 60))
+        self.m_keys = [key for key in options.get('key', '').split(',') if key]
+        self.m_segments = []
+
+    @classmethod
+    def parse_options(cls, text):
+        '''
+        Parse the fragment options.
+        It raises ValueError for an unknown or malformed option so
+        that a typo does not silently cache the fragment.
+        '''
+        options = {}
+        for option in text.split():
+            name, sep, value = option.partition('=')
+            if sep == '' or value == '' or name not in cls.m_option_names:
+                raise ValueError('Invalid template cache option "{0}", expected one of: {1}.'.format(
+                    option, ', '.join(name + '=' for name in cls.m_option_names)))
+            options[name] = value
+        return options
+
+    def key(self, params):
+        '''
+        Get the cache key for the parameters.
+
+        The version of the file is part of the key so that
+        changes to the file are not hidden by the cache.
+        '''
+        return (self.m_version, tuple(repr(params.get(key)) for key in self.m_keys))
+
+    def get(self, key):
+        '''
+        Get the cached output, None if it is not cached.
+        '''
+        if self.m_cache is None:
+            return None
+        return self.m_cache.get_fragment(self.m_name, key)
+
+    def put(self, key, value):
+        '''
+        Cache the output.
+        '''
+        if self.m_cache is not None:
+            self.m_cache.put_fragment(self.m_name, key, value, self.m_ttl)
+
+    @staticmethod
+    def copy_values(values):
+        '''
+        Copy the parameters set by a python block so that the
+        requests, and the threads, that use the cached parameters
+        do not share mutable objects. The values that cannot be
+        copied, like the imported modules, are shared.
+        '''
+        copies = {}
+        for key, val in values.items():
+            try:
+                copies[key] = copy.deepcopy(val)
+            except Exception:
+                copies[key] = val
+        return copies
+
+    def get_values(self, key):
+        '''
+        Get a copy of the cached parameters of a python block
+        and the names of its params = locals() aliases.
+        It is None if they are not cached.
+        '''
+        cached = self.get(key)
+        if cached is None:
+            return None
+        values, aliases = cached
+        return (self.copy_values(values), aliases)
+
+    def put_values(self, key, values, aliases):
+        '''
+        Cache a copy of the parameters set by a python block.
+        '''
+        self.put(key, (self.copy_values(values), aliases))
+
+
+class Template(object):
+    '''
+    A template that has been parsed once.
+
+    The python fragments that sit between <!-- python and -->
+    statements are compiled to code objects and removed from
+    the HTML. The HTML is split into literal text and variable
+    segments so that it can be rendered in a single pass.
+
+    The <!-- include FILE --> directives are replaced by the segments
+    of the included file, loaded by the loader (the template cache).
+    The included files, including the nested ones, are recorded in
+    the dependencies.
+
+    The blocks between <!-- cache OPTIONS --> and <!-- endcache -->
+    statements and the <!-- python cache OPTIONS blocks are cached
+    fragments (see TemplateFragment).
+
+    Templates with a <!-- stream --> statement are sent as they are
+    rendered (see render_iter()).
+    '''
+    m_formatter = string.Formatter()
+    m_max_include_depth = 8
+
+    def __init__(self, path, data, stat, loader=None, python=True, stack=()):
+        self.m_path = path
+        self.m_data = data
+        self.m_mtime = stat.st_mtime
+        self.m_size = stat.st_size
+        self.m_codes = []
+        self.m_fragments = []  # the TemplateFragment of each code object or None
+        self.m_num_fragments = 0
+        self.m_stream = False
+        self.m_deps = {}  # included path --> (mtime, size)
+        self.m_stack = stack + (path, )  # the including files
+        self.m_checked = time.time()
+
+        fragments = []
+        if python:
+            fragments = re.findall(r'<!-- python(.*?)-->', data, flags=re.DOTALL | re.MULTILINE)
+        for fragment in fragments:
+            # Cached python blocks start with <!-- python cache OPTIONS.
+            cached = None
+            header, _, body = fragment.partition('\n')
+            match = re.match(r'\s+cache((?:\s+\S+=\S*)*)\s*$', header)
+            if match is not None:
+                cached = self.fragment(loader, TemplateFragment.parse_options(match.group(1)))
+                fragment = body
+
+            # left justify so that statements are in the leftmost column.
+            min_indent = min([len(x) for x in re.findall('^([ ]+)', fragment, re.MULTILINE)] or [0])
+            fragment = re.sub('^[ ]{' + str(min_indent) + '}', '', fragment, flags=re.MULTILINE)
+            self.m_codes.append(compile(fragment, path, 'exec'))
+            self.m_fragments.append(cached)
+
+        self.m_python = len(fragments) > 0
+        if self.m_python:
+            # Remove the python fragments.
+            self.m_html = re.sub(r'<!-- python.*?-->\s*\n?', '', data, flags=re.DOTALL | re.MULTILINE).strip()
+        else:
+            self.m_html = data
+
+        # Split the HTML at the include, cache and stream directives.
+        self.m_segments = []
+        stack = [self.m_segments]  # the segments of the nested cached blocks
+        substitute = self.m_python or re.search(r'[^{][{][^}]+[}][^}]', self.m_html) is not None
+        pieces = re.split(r'<!--\s*(include\s+\S+?|cache(?:\s[^>]*?)?|endcache|stream)\s*-->', self.m_html)
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0:
+                if substitute:
+                    stack[-1].extend(self.parse(piece))
+                elif piece:
+                    stack[-1].append(piece)  # nothing to substitute
+            elif piece.startswith('include'):
+                stack[-1].extend(self.include(loader, piece.split(None, 1)[1]))
+            elif piece == 'endcache':
+                if len(stack) > 1:
+                    stack.pop()
+            elif piece == 'stream':
+                self.m_stream = True
+            else:
+                options = TemplateFragment.parse_options(piece[len('cache'):])
+                cached = self.fragment(loader, options)
+                stack[-1].append(cached)
+                stack.append(cached.m_segments)
+
+        # The dependencies determine the version of the output.
+        self.m_version = '{0}:{1}:{2!r}'.format(self.m_mtime, self.m_size, sorted(self.m_deps.items()))
+
+    def encode(self):
+        '''
+        Get the parsed template as a dictionary that can be
+        marshalled (see TemplateCompileCache).
+        '''
+        return {'codes': self.m_codes,
+                'fragments': [self.encode_segment(fragment) for fragment in self.m_fragments],
+                'num_fragments': self.m_num_fragments,
+                'stream': self.m_stream,
+                'python': self.m_python,
+                'html': self.m_html,
+                'segments': [self.encode_segment(segment) for segment in self.m_segments]}
+
+    @classmethod
+    def encode_segment(cls, segment):
+        '''
+        Fragments are converted to dictionaries, the literal strings,
+        variable tuples and None values can be marshalled as they are.
+        '''
+        if not isinstance(segment, TemplateFragment):
+            return segment
+        return {'version': segment.m_version,
+                'name': segment.m_name,
+                'ttl': segment.m_ttl,
+                'keys': segment.m_keys,
+                'segments': [cls.encode_segment(item) for item in segment.m_segments]}
+
+    @classmethod
+    def decode(cls, path, data, stat, entry, deps, loader=None):
+        '''
+        Create a template from an encoded one without parsing it.
+        '''
+        tmpl = cls.__new__(cls)
+        tmpl.m_path = path
+        tmpl.m_data = data
+        tmpl.m_mtime = stat.st_mtime
+        tmpl.m_size = stat.st_size
+        tmpl.m_codes = entry['codes']
+        tmpl.m_fragments = [cls.decode_segment(loader, fragment) for fragment in entry['fragments']]
+        tmpl.m_num_fragments = entry['num_fragments']
+        tmpl.m_stream = entry['stream']
+        tmpl.m_python = entry['python']
+        tmpl.m_html = entry['html']
+        tmpl.m_segments = [cls.decode_segment(loader, segment) for segment in entry['segments']]
+        tmpl.m_deps = deps
+        tmpl.m_stack = (path, )
+        tmpl.m_checked = time.time()
+        tmpl.m_version = '{0}:{1}:{2!r}'.format(tmpl.m_mtime, tmpl.m_size, sorted(tmpl.m_deps.items()))
+        return tmpl
+
+    @classmethod
+    def decode_segment(cls, loader, segment):
+        '''
+        Convert the fragment dictionaries back to fragments.
+        '''
+        if not isinstance(segment, dict):
+            return segment
+        options = {'ttl': segment['ttl'], 'key': ','.join(segment['keys'])}
+        fragment = TemplateFragment(loader, segment['version'], options, segment['name'])
+        fragment.m_segments = [cls.decode_segment(loader, item) for item in segment['segments']]
+        return fragment
+
+    def fragment(self, loader, options):
+        '''
+        Create a cached fragment.
+        The default name is the file name and the fragment number.
+        '''
+        self.m_num_fragments += 1
+        name = '{0}:{1}'.format(os.path.basename(self.m_path), self.m_num_fragments)
+        return TemplateFragment(loader, (self.m_path, self.m_mtime, self.m_size), options, name)
+
+    def include(self, loader, name):
+        '''
+        Get the segments of an included file.
+
+        Relative names are relative to the directory of this file,
+        absolute names are relative to the web directory.
+        '''
+        if loader is None:
+            return ['<!-- include {0} failed: no loader -->'.format(name)]
+        path = loader.include_path(self.m_path, name)
+        if path in self.m_stack or len(self.m_stack) > self.m_max_include_depth:
+            return ['<!-- include {0} failed: too deep or recursive -->'.format(name)]
+        try:
+            inc = loader.get_include(path, self.m_stack)
+        except (IOError, OSError) as exc:
+            self.m_deps[path] = (None, None)  # creating it is a change
+            return ['<!-- include {0} failed: {1} -->'.format(name, exc.strerror)]
+        self.m_deps[path] = (inc.m_mtime, inc.m_size)
+        self.m_deps.update(inc.m_deps)
+        return inc.m_segments
+
+    @classmethod
+    def parse(cls, text):
+        '''
+        Split the text into literal strings and
+        (field_name, format_spec, conversion) variables using
+        the string.Formatter syntax.
+        '''
+        segments = []
+        for literal, field_name, format_spec, conversion in cls.m_formatter.parse(text):
+            if literal:
+                segments.append(literal)
+            if field_name is not None:
+                segments.append((field_name, format_spec, conversion))
+        return segments
+
+    def render(self, params, depth=8, literal=()):
+        '''
+        Substitute the parameter values for the variables.
+
+        Values that contain variables themselves, like the values
+        set by the python code, are expanded up to depth levels.
+        The values of the literal parameters, like the GET/POST
+        parameters, are never expanded because they come from the
+        client. Each variable is only formatted once and the output
+        is joined once so the time is linear in the size of the
+        output.
+        '''
+        out = []
+        self.render_segments(self.m_segments, params, depth, TemplateRenderState(literal), out)
+        return ''.join(self.flatten(out))
+
+    def render_iter(self, params, depth=8, literal=()):
+        '''
+        Generate the output pieces for streaming.
+
+        The text before a variable whose value is an iterator (like
+        a generator that produces the rows of a report) is produced
+        first, then the pieces of the iterator as they are produced.
+        '''
+        state = TemplateRenderState(literal)
+        text = []
+        for segment in self.m_segments:
+            out = []
+            self.render_segments([segment], params, depth, state, out)
+            for piece in out:
+                if isinstance(piece, basestring):
+                    text.append(piece)
+                    continue
+                if text:
+                    yield ''.join(text)
+                    text = []
+                for item in piece:
+                    yield item
+        if text:
+            yield ''.join(text)
+
+    @staticmethod
+    def flatten(out):
+        '''
+        Generate the rendered pieces, expanding the iterators.
+        '''
+        for piece in out:
+            if isinstance(piece, basestring):
+                yield piece
+            else:
+                for item in piece:
+                    yield item
+
+    def render_segments(self, segments, params, depth, state, out):
+        '''
+        Append the rendered segments to the out list.
+        The render state remembers the formatted variables.
+        '''
+        for segment in segments:
+            if isinstance(segment, tuple):
+                text = state.m_resolved.get(segment)
+                if text is None:
+                    text = self.render_field(segment, params, depth, state)
+                    if isinstance(text, basestring):
+                        state.m_resolved[segment] = text  # iterators can only be used once
+                out.append(text)
+            elif isinstance(segment, TemplateFragment):
+                key = segment.key(params)
+                text = segment.get(key)
+                if text is None:
+                    block = []
+                    self.render_segments(segment.m_segments, params, depth, state, block)
+                    text = ''.join(self.flatten(block))
+                    segment.put(key, text)
+                out.append(text)
+            else:
+                out.append(segment)
+
+    def render_field(self, field, params, depth, state):
+        '''
+        Format a variable, expanding the variables in its value
+        unless it is a literal parameter.
+        It raises KeyError if a variable is not defined.
+
+        Iterators, like generators, are returned as they are so that
+        their pieces can be streamed.
+        '''
+        field_name, format_spec, conversion = field
+        obj, _ = self.m_formatter.get_field(field_name, (), params)
+        if isinstance(obj, collections.Iterator):
+            return obj
+        obj = self.m_formatter.convert_field(obj, conversion)
+        if format_spec and '{' in format_spec:
+            out = []
+            self.render_segments(self.parse(format_spec), params, depth, state, out)
+            format_spec = ''.join(out)
+        text = self.m_formatter.format_field(obj, format_spec)
+
+        name = re.match(r'[^.\[]*', field_name).group(0)
+        if depth > 0 and '{' in text and name not in state.m_literal:
+            segments = state.m_value_segments.get(text)
+            if segments is None:
+                try:
+                    segments = self.parse(text)
+                except ValueError:
+                    segments = [text]  # unbalanced braces are not variables
+                state.m_value_segments[text] = segments
+            out = []
+            self.render_segments(segments, params, depth - 1, state, out)
+            text = ''.join(out)
+        return text
+
+
+class TemplateRenderState(object):
+    '''
+    The state of a single rendering of a template, so that it is
+    not shared by the threads that render the same template.
+    '''
+    def __init__(self, literal):
+        self.m_literal = literal  # the parameters that are not expanded
+        self.m_resolved = {}  # variable --> formatted text
+        self.m_value_segments = {}  # value --> segments of its variables
+
+
+class TemplateWorkerError(Exception):
+    '''
+    A template python fragment failed in a template worker process.
+    '''
+    pass
+
+
+class TemplateLimitError(TemplateWorkerError):
+    '''
+    A template python fragment exceeded the wall clock, CPU time or
+    memory limit of the template workers.
+    '''
+    pass
+
+
+class TemplateCPULimit(Exception):
+    '''
+    A template python fragment exceeded its CPU time limit.
+    '''
+    pass
+
+
+def set_memory_limit(limit):
+    '''
+    Limit the address space of a worker process so that it can only
+    grow by limit bytes, allocations beyond that raise MemoryError.
+
+    The limit is relative to the current size because a forked worker
+    starts with the address space of the server.
+    '''
+    try:
+        with open('/proc/self/statm') as ifp:
+            size = int(ifp.read().split()[0]) * resource.getpagesize()
+    except (IOError, OSError, ValueError):
+        # The maximum resident set size is in KB on Linux.
+        size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    soft = size + limit
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def template_worker_values(params, before=None):
+    '''
+    Get the parameters that can be sent between processes.
+
+    If before is specified only the new or changed parameters
+    are returned. Iterators (streamed values) are converted to
+    strings. Modules, functions and the params = locals() alias
+    cannot be sent so they are left out.
+    '''
+    values = {}
+    for key, val in params.items():
+        if val is params:
+            continue
+        if before is not None and key in before and before[key] is val:
+            continue
+        if isinstance(val, collections.Iterator):
+            val = ''.join(val)
+        try:
+            pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            continue
+        values[key] = val
+    return values
+
+
+def template_worker_main(conn, cpu_limit, memory_limit):
+    '''
+    Run template python fragments sent by the server.
+
+    The compiled code is cached by key. Each request is a
+    (key, marshalled code or None, params) tuple and each reply is
+    a (status, params or error message, recycle) tuple where the
+    status is ok, error or limit. When the CPU time or memory limit
+    is exceeded the process exits after replying so that it is
+    replaced.
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the server stops the workers
+    if memory_limit > 0:
+        set_memory_limit(memory_limit)
+
+    def cpu_limit_handler(signum, frame):
+        raise TemplateCPULimit('CPU time limit of {0} seconds exceeded'.format(cpu_limit))
+    signal.signal(signal.SIGXCPU, cpu_limit_handler)
+
+    codes = {}
+    while True:
+        try:
+            key, data, params = conn.recv()
+        except (EOFError, IOError, KeyboardInterrupt):
+            break
+
+        if data is not None:
+            codes[key] = marshal.loads(data)
+
+        if cpu_limit > 0:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(usage.ru_utime + usage.ru_stime) + cpu_limit + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        try:
+            before = dict(params)
+            exec(codes[key], dict(globals()), params)  # same modules as the request handler
+            reply = ['ok', template_worker_values(params, before), False]
+        except TemplateCPULimit as exc:
+            reply = ['limit', str(exc), True]
+        except MemoryError:
+            reply = ['limit', 'memory limit of {0} bytes exceeded'.format(memory_limit), True]
+        except Exception:
+            reply = ['error', traceback.format_exc(), False]
+        finally:
+            if cpu_limit > 0:
+                resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        conn.send(reply)
+        if reply[2]:
+            break
+    conn.close()
+
+
+class TemplatePool(WorkerPool):
+    '''
+    Pool of warm worker processes that run the template python
+    fragments with CPU time, wall clock and memory limits.
+
+    Each fragment gets the request parameters and only the
+    parameters that it sets are sent back.
+
+    The exceptions are also available as the Error and LimitError
+    class attributes for plugins that cannot import them.
+    '''
+    Error = TemplateWorkerError
+    LimitError = TemplateLimitError
+
+    def __init__(self, count, timeout, cpu_limit, memory_limit):
+        WorkerPool.__init__(self, count, template_worker_main, cpu_limit, memory_limit)
+        self.m_timeout = timeout
+        self.m_runs = 0
+        self.m_errors = 0
+        self.m_timeouts = 0
+        self.m_run_time = 0.
+
+    def execute(self, tmpl, index, params):
+        '''
+        Run a python fragment of a template in a worker process.
+
+        It returns the parameters that the fragment set. It raises
+        TemplateLimitError if the fragment exceeded a limit and
+        TemplateWorkerError if it failed.
+        '''
+        key = (tmpl.m_path, tmpl.m_version, index)
+        start = time.time()
+        worker = self.m_idle.get()
+        try:
+            data = None
+            if key not in worker.m_keys:
+                data = marshal.dumps(tmpl.m_codes[index])
+            worker.m_conn.send((key, data, template_worker_values(params)))
+            worker.m_keys.add(key)
+            if worker.m_conn.poll(self.m_timeout if self.m_timeout > 0 else None) is False:
+                with self.m_lock:
+                    self.m_timeouts += 1
+                worker = self.replace(worker, kill=True)
+                status, value = 'limit', 'wall clock time limit of {0} seconds exceeded'.format(self.m_timeout)
+            else:
+                status, value, recycle = worker.m_conn.recv()
+                if recycle:
+                    worker = self.replace(worker)
+        except (EOFError, IOError, OSError) as exc:
+            worker = self.replace(worker, kill=True)
+            status, value = 'error', 'worker process failed: {0!r}'.format(exc)
+        finally:
+            self.m_idle.put(worker)
+
+        with self.m_lock:
+            self.m_runs += 1
+            self.m_run_time += time.time() - start
+            if status != 'ok':
+                self.m_errors += 1
+        if status == 'limit':
+            raise TemplateLimitError('{0}: {1}'.format(tmpl.m_path, value))
+        if status != 'ok':
+            raise TemplateWorkerError('{0}: {1}'.format(tmpl.m_path, value))
+        return value
+
+    def stats(self):
+        '''
+        Get the pool statistics.
+        '''
+        with self.m_lock:
+            return {'workers': len(self.m_workers),
+                    'idle': self.m_idle.qsize(),
+                    'runs': self.m_runs,
+                    'run_avg_ms': round(1000. * self.m_run_time / self.m_runs, 3) if self.m_runs else 0.,
+                    'errors': self.m_errors,
+                    'timeouts': self.m_timeouts,
+                    'restarts': self.m_restarts}
+
+
+class TemplateCompileCache(object):
+    '''
+    Directory of compiled templates.
+
+    Each parsed template is saved in a marshal file named after the
+    checksum of its path. It holds the code objects, the segments
+    and the included files with their modification times, sizes and
+    checksums. A saved template is used only if the checksum of the
+    template matches and each included file has the same modification
+    time and size, or else the same checksum (a deploy that copies
+    the files changes the times but not the contents). The python
+    version is part of the file so that a python upgrade does not
+    load incompatible code objects.
+    '''
+    m_magic = 'webserver-template-1:' + imp.get_magic().encode('hex')
+
+    def __init__(self, directory):
+        self.m_directory = directory
+        self.m_lock = threading.Lock()
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_stale = 0
+        self.m_writes = 0
+        self.m_errors = 0
+
+    def incr(self, attr):
+        '''
+        Increment a counter.
+        '''
+        with self.m_lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def filename(self, path):
+        '''
+        Get the name of the compiled file of a template.
+        '''
+        return os.path.join(self.m_directory, hashlib.md5(os.path.realpath(path)).hexdigest() + '.tmplc')
+
+    @staticmethod
+    def checksum(data):
+        '''
+        Get the checksum of the contents of a file.
+        '''
+        return hashlib.md5(data).hexdigest()
+
+    @classmethod
+    def file_checksum(cls, path):
+        '''
+        Get the checksum of a file, None if it cannot be read.
+        '''
+        try:
+            with open(path, 'rb') as ifp:
+                return cls.checksum(ifp.read())
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def version(path):
+        '''
+        Get the modification time and size of a file,
+        (None, None) if it does not exist.
+        '''
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return (None, None)
+
+    def load(self, path, data, stat, loader):
+        '''
+        Get the compiled template.
+        It is None if there is none or if it is out of date.
+        '''
+        try:
+            with open(self.filename(path), 'rb') as ifp:
+                entry = marshal.load(ifp)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            self.incr('m_misses')
+            return None
+
+        try:
+            if entry['magic'] != self.m_magic or \
+               entry['path'] != os.path.realpath(path) or \
+               entry['checksum'] != self.checksum(data):
+                self.incr('m_stale')
+                return None
+            deps = {}
+            for dep, (mtime, size, checksum) in entry['deps'].items():
+                current = self.version(dep)
+                if current != (mtime, size):
+                    if checksum is None or current[0] is None or self.file_checksum(dep) != checksum:
+                        self.incr('m_stale')
+                        return None
+                deps[dep] = current
+            tmpl = Template.decode(path, data, stat, entry, deps, loader)
+        except (KeyError, TypeError, ValueError):
+            self.incr('m_errors')
+            return None
+
+        self.incr('m_hits')
+        return tmpl
+
+    def save(self, tmpl):
+        '''
+        Save a parsed template.
+        '''
+        deps = {}
+        for dep, version in tmpl.m_deps.items():
+            if version == (None, None):
+                deps[dep] = (None, None, None)  # the include failed
+                continue
+            if self.version(dep) != version:
+                return  # changed since it was parsed
+            deps[dep] = version + (self.file_checksum(dep), )
+
+        entry = tmpl.encode()
+        entry.update({'magic': self.m_magic,
+                      'path': os.path.realpath(tmpl.m_path),
+                      'checksum': self.checksum(tmpl.m_data),
+                      'deps': deps})
+        filename = self.filename(tmpl.m_path)
+        tmpname = '{0}.{1}.{2}'.format(filename, os.getpid(), threading.current_thread().ident)
+        try:
+            # Write a temporary file and rename it so that
+            # readers never see a partial file.
+            with open(tmpname, 'wb') as ofp:
+                marshal.dump(entry, ofp)
+            os.rename(tmpname, filename)
+        except (IOError, OSError, ValueError):
+            self.incr('m_errors')
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return
+        self.incr('m_writes')
+
+    def stats(self):
+        '''
+        Get the statistics.
+        '''
+        with self.m_lock:
+            return {'hits': self.m_hits,
+                    'misses': self.m_misses,
+                    'stale': self.m_stale,
+                    'writes': self.m_writes,
+                    'errors': self.m_errors}
+
+
+def precompile_templates(cache, webdir):
+    '''
+    Parse and compile all of the templates in the web directory
+    with the template cache.
+
+    It returns the number of compiled templates and the
+    (path, exception) pairs of the templates that failed.
+    '''
+    count = 0
+    errors = []
+    for root, dirs, files in os.walk(os.path.realpath(webdir)):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in ('.tmpl', '.html', '.htm'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                cache.get(path)
+                count += 1
+            except (IOError, OSError, SyntaxError, ValueError) as exc:
+                errors.append((path, exc))
+    return count, errors
+
+
+def precompile(opts):
+    '''
+    Compile all of the templates in the web directory
+    into the compiled template directory and exit.
+    '''
+    if opts.precompile is False:
+        return
+
+    compiled = TemplateCompileCache(opts.template_compile_dir)
+    cache = TemplateCache(0, opts.webdir, 0, compiled)
+    count, errors = precompile_templates(cache, opts.webdir)
+    for path, exc in errors:
+        print('ERROR: {0}: {1}'.format(path, exc), file=sys.stderr)
+
+    stats = compiled.stats()
+    print('Compiled {0} templates ({1} up to date), {2} failed.'.format(count, stats['hits'], len(errors)))
+    sys.exit(1 if errors else 0)
+
+
+class TemplateCache(object):
+    '''
+    Thread safe cache of parsed templates.
+
+    The templates are keyed by path and evicted in least recently
+    used order. The included files are parsed once and shared by
+    all of the templates that include them.
+
+    A template is checked at most once every ttl seconds, so
+    most requests do not touch the file system. The check compares
+    the modification time and size of the template and of each of
+    the files that it includes. When an included file changes,
+    exactly the templates that depend on it are parsed again.
+
+    It also holds the output of the cached template fragments.
+
+    If there is a compiled template cache (compiled), the templates
+    are loaded from it and the parsed templates are saved in it.
+    '''
+    m_max_fragments = 1024
+
+    def __init__(self, max_entries, webdir, ttl, compiled=None):
+        self.m_lock = threading.Lock()
+        self.m_entries = collections.OrderedDict()  # path --> Template
+        self.m_includes = collections.OrderedDict()  # path --> Template
+        self.m_dependents = {}  # included path --> set of template paths
+        self.m_max_entries = max_entries
+        self.m_webdir = os.path.realpath(webdir)
+        self.m_ttl = ttl
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_evictions = 0
+        self.m_invalidations = 0
+        self.m_compile_count = 0
+        self.m_compile_time = 0.
+        self.m_compile_max = 0.
+        self.m_fragments = collections.OrderedDict()  # (name, key) --> (expires, value)
+        self.m_fragment_stats = {}  # name --> [hits, misses]
+        self.m_compiled = compiled
+
+    @staticmethod
+    def changed(tmpl):
+        '''
+        Get the list of the paths of the template and its included
+        files that changed since it was parsed.
+        '''
+        paths = []
+        deps = [(tmpl.m_path, (tmpl.m_mtime, tmpl.m_size))] + list(tmpl.m_deps.items())
+        for path, version in deps:
+            try:
+                stat = os.stat(path)
+                current = (stat.st_mtime, stat.st_size)
+            except OSError:
+                current = (None, None)
+            if current != version:
+                paths.append(path)
+        return paths
+
+    def fresh(self, entries, path):
+        '''
+        Get the template from the entries if it has not changed.
+        '''
+        with self.m_lock:
+            tmpl = entries.get(path)
+        if tmpl is None:
+            return None
+
+        now = time.time()
+        if now - tmpl.m_checked > self.m_ttl:
+            changed = self.changed(tmpl)
+            if changed:
+                self.invalidate(changed)
+                return None
+            tmpl.m_checked = now
+
+        with self.m_lock:
+            if entries.pop(path, None) is not None:
+                entries[path] = tmpl  # most recently used
+        return tmpl
+
+    def invalidate(self, paths):
+        '''
+        Remove the changed files and the templates that include them.
+        '''
+        with self.m_lock:
+            for path in paths:
+                self.m_entries.pop(path, None)
+                self.m_includes.pop(path, None)
+                for dependent in self.m_dependents.pop(path, ()):
+                    if self.m_entries.pop(dependent, None) is not None:
+                        self.m_invalidations += 1
+                    self.m_includes.pop(dependent, None)
+
+    def load(self, path, **kwargs):
+        '''
+        Read and parse a file.
+        '''
+        start = time.time()
+        with open(path, 'r') as ifp:
+            stat = os.fstat(ifp.fileno())
+            data = ifp.read()
+
+        # The included files are part of the compiled templates.
+        if self.m_compiled is not None and not kwargs:
+            tmpl = self.m_compiled.load(path, data, stat, self)
+            if tmpl is not None:
+                return tmpl
+
+        tmpl = Template(path, data, stat, self, **kwargs)
+        secs = time.time() - start
+        if self.m_compiled is not None and not kwargs:
+            self.m_compiled.save(tmpl)
+
+        with self.m_lock:
+            self.m_compile_count += 1
+            self.m_compile_time += secs
+            self.m_compile_max = max(self.m_compile_max, secs)
+        return tmpl
+
+    def store(self, entries, tmpl):
+        '''
+        Store a parsed template and record its dependencies.
+        '''
+        if self.m_max_entries == 0:
+            return
+        with self.m_lock:
+            entries.pop(tmpl.m_path, None)
+            entries[tmpl.m_path] = tmpl
+            for path in tmpl.m_deps:
+                self.m_dependents.setdefault(path, set()).add(tmpl.m_path)
+            while len(entries) > self.m_max_entries:
+                entries.popitem(last=False)
+                self.m_evictions += 1
+
+    def get(self, path):
+        '''
+        Get the parsed template for the path.
+        It raises IOError or OSError if the file cannot be read.
+        '''
+        tmpl = self.fresh(self.m_entries, path)
+        with self.m_lock:
+            if tmpl is not None:
+                self.m_hits += 1
+                return tmpl
+            self.m_misses += 1
+        tmpl = self.load(path)
+        self.store(self.m_entries, tmpl)
+        return tmpl
+
+    def include_path(self, path, name):
+        '''
+        Get the path of a file included by the file at path.
+        '''
+        if name.startswith('/'):
+            return os.path.normpath(os.path.join(self.m_webdir, name.lstrip('/')))
+        return os.path.normpath(os.path.join(os.path.dirname(path), name))
+
+    def get_include(self, path, stack):
+        '''
+        Get the parsed included file.
+        The python code in included files is not run.
+        '''
+        tmpl = self.fresh(self.m_includes, path)
+        if tmpl is None:
+            tmpl = self.load(path, python=False, stack=stack)
+            self.store(self.m_includes, tmpl)
+        return tmpl
+
+    def get_fragment(self, name, key):
+        '''
+        Get the cached output of a template fragment.
+        It is None if it is not cached or it expired.
+        '''
+        now = time.time()
+        with self.m_lock:
+            stats = self.m_fragment_stats.setdefault(name, [0, 0])
+            entry = self.m_fragments.get((name, key))
+            if entry is not None and entry[0] > now:
+                stats[0] += 1
+                return entry[1]
+            stats[1] += 1
+        return None
+
+    def put_fragment(self, name, key, value, ttl):
+        '''
+        Cache the output of a template fragment for ttl seconds.
+        '''
+        with self.m_lock:
+            self.m_fragments.pop((name, key), None)
+            self.m_fragments[(name, key)] = (time.time() + ttl, value)
+            while len(self.m_fragments) > self.m_max_fragments:
+                self.m_fragments.popitem(last=False)
+
+    def stats(self):
+        '''
+        Get the cache statistics.
+        '''
+        with self.m_lock:
+            lookups = self.m_hits + self.m_misses
+            entries = {}
+            for name, (hits, misses) in self.m_fragment_stats.items():
+                entries['fragment_{0}_hits'.format(name)] = hits
+                entries['fragment_{0}_misses'.format(name)] = misses
+            entries.update({'entries': len(self.m_entries),
+                            'includes': len(self.m_includes),
+                            'evictions': self.m_evictions,
+                            'invalidations': self.m_invalidations,
+                            'hits': self.m_hits,
+                            'misses': self.m_misses,
+                            'hit_rate': round(float(self.m_hits) / lookups, 3) if lookups else 0.,
+                            'compile_count': self.m_compile_count,
+                            'compile_avg_ms': round(1000. * self.m_compile_time / self.m_compile_count, 3) if self.m_compile_count else 0.,
+                            'compile_max_ms': round(1000. * self.m_compile_max, 3),
+                            'fragments': len(self.m_fragments)})
+            return entries
+
+
+class ThreadPoolMixIn:
+    '''
+    Mix-in class to handle each request in a bounded pool of worker
+    threads.
+
+    The server thread accepts the connections and puts them on a
+    bounded queue. When the queue is full, the server thread blocks
+    until a worker takes a connection off of the queue so that the
+    pending connections back up in the listen queue.
+    '''
+    workers = 4
+    queue_size = 64
+
+    def start_workers(self):
+        '''
+        Start the worker threads.
+        '''
+        self.ws_queue = Queue.Queue(self.queue_size)
+        self.ws_threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.process_request_worker,
+                                      name='worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.ws_threads.append(thread)
+
+    def stop_workers(self):
+        '''
+        Tell the worker threads to exit.
+        '''
+        for _ in self.ws_threads:
+            self.ws_queue.put(None)
+
+    def process_request_worker(self):
+        '''
+        Handle the queued requests until told to stop.
+        '''
+        self.ws_plugin.on_worker_start(self)
+        stats = self.ws_stats
+        while True:
+            item = self.ws_queue.get()
+            if item is None:
+                break
+            request, client_address, queued = item
+            stats.incr('queue_length', -1)
+            stats.add_time('queue_wait', time.time() - queued)
+            stats.incr('workers_busy')
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                stats.incr('workers_busy', -1)
+
+    def process_request(self, request, client_address):
+        '''
+        Queue the request for a worker.
+        '''
+        self.ws_stats.incr('queue_length')
+        self.ws_queue.put((request, client_address, time.time()))
+
+
+def set_reuse_port(sock):
+    '''
+    Allow several processes to bind sockets to the same port.
+    '''
+    # Python 2.7 does not define SO_REUSEPORT.
+    option = getattr(socket, 'SO_REUSEPORT', 0x200 if sys.platform == 'darwin' else 15)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, option, 1)
+
+
+class EventPoller(object):
+    '''
+    Wait for socket events using epoll, if it is available, or
+    select.
+    '''
+    def __init__(self):
+        self.m_epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.m_events = {}  # fd --> (read, write)
+
+    def update(self, fd, read=True, write=False):
+        '''
+        Register a file descriptor or change the events of interest.
+        '''
+        if self.m_events.get(fd) == (read, write):
+            return
+        if self.m_epoll is not None:
+            mask = (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+            if fd in self.m_events:
+                self.m_epoll.modify(fd, mask)
+            else:
+                self.m_epoll.register(fd, mask)
+        self.m_events[fd] = (read, write)
+
+    def remove(self, fd):
+        '''
+        Unregister a file descriptor.
+        '''
+        if self.m_events.pop(fd, None) is not None and self.m_epoll is not None:
+            self.m_epoll.unregister(fd)
+
+    def poll(self, timeout):
+        '''
+        Wait for events.
+        Return a list of (fd, readable, writable) tuples.
+        '''
+        try:
+            if self.m_epoll is not None:
+                events = self.m_epoll.poll(timeout)
+                err = select.EPOLLERR | select.EPOLLHUP
+                return [(fd, bool(mask & (select.EPOLLIN | err)), bool(mask & select.EPOLLOUT))
+                        for fd, mask in events]
+            rfds = [fd for fd, (read, _) in self.m_events.items() if read]
+            wfds = [fd for fd, (_, write) in self.m_events.items() if write]
+            rdy, wdy, _ = select.select(rfds, wfds, [], timeout)
+        except (IOError, OSError, select.error) as exc:
+            if exc.args[0] == errno.EINTR:
+                return []
+            raise
+        wset = set(wdy)
+        events = [(fd, True, fd in wset) for fd in rdy]
+        events.extend((fd, False, True) for fd in wset.difference(rdy))
+        return events
+
+    def close(self):
+        '''
+        Release the resources.
+        '''
+        if self.m_epoll is not None:
+            self.m_epoll.close()
+
+
+class EventConnection(object):
+    '''
+    The state of a client connection in the event engine.
+    '''
+    def __init__(self, sock, client_address):
+        self.m_sock = sock
+        self.m_client_address = client_address
+        self.m_inbuf = bytearray()  # appending to it is not quadratic
+        self.m_header = None  # the header of the request being received
+        self.m_scan = None  # (pos, total) of the chunked body scan
+        self.m_spool = None  # temporary file of a large request
+        self.m_spooled = 0  # bytes of the request in the temporary file
+        self.m_outbuf = collections.deque()
+        self.m_outpos = 0
+        self.m_last_active = time.time()
+        self.m_requests = 0
+        self.m_handshake = None  # TLS handshake start time, if in progress
+        self.m_continue = False  # sent 100 Continue
+        self.m_closing = False
+
+
+class EventFile(object):
+    '''
+    A file region waiting to be sent by the event engine.
+    '''
+    def __init__(self, fd, offset, count):
+        self.m_fd = fd
+        self.m_offset = offset
+        self.m_count = count
+
+    def close(self):
+        '''
+        Close the file descriptor.
+        '''
+        if self.m_fd is not None:
+            os.close(self.m_fd)
+            self.m_fd = None
+
+
+class EventServer(object):
+    '''
+    Single threaded, non-blocking server engine.
+
+    It multiplexes all of the client connections in one event loop
+    so that idle or slow clients only cost the memory for their
+    connection state. The request data is read incrementally and,
+    once a complete request has been received, it is handed to the
+    request handler class, which runs the plugin request handler
+    with buffered input and output. The output is then written
+    back to the client without blocking.
+
+    It provides the same interface as SocketServer.TCPServer for
+    serving, shutting down and closing.
+    '''
+    reuse_port = False
+    request_queue_size = 128  # listen backlog
+    idle_timeout = 60  # seconds before an idle connection is closed
+    handshake_timeout = 10  # seconds before an unfinished TLS handshake is dropped
+    max_header_size = 65536
+    max_body_size = 0  # no limit
+    spool_size = 1 << 20  # larger requests are received in a temporary file
+    read_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.server_address = server_address
+        self.RequestHandlerClass = self.create_handler_class(RequestHandlerClass)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.reuse_port:
+                set_reuse_port(self.socket)
+            self.socket.bind(self.server_address)
+            self.server_address = self.socket.getsockname()
+            self.socket.listen(self.request_queue_size)
+        except socket.error:
+            self.socket.close()
+            raise
+        self.m_connections = {}  # fd --> EventConnection
+        self.m_shutdown = False
+        self.ws_ssl_context = None  # set for HTTPS
+
+    @staticmethod
+    def create_handler_class(RequestHandlerClass):
+        '''
+        Factory to make a request handler class that handles
+        a single, fully received, request using buffered input
+        and output.
+        '''
+        class EventRequestHandler(RequestHandlerClass):
+            '''
+            Factory generated request handler class for the event
+            engine.
+            '''
+            def __init__(self, request, client_address, server, data, requests):
+                self.ws_data = data  # a string or the temporary file of a large request
+                self.ws_requests = requests - 1  # handle_one_request() counts this one
+                RequestHandlerClass.__init__(self, request, client_address, server)
+
+            def setup(self):
+                self.connection = self.request
+                self.rfile = StringIO.StringIO(self.ws_data) if isinstance(self.ws_data, str) else self.ws_data
+                self.wfile = StringIO.StringIO()
+                self.ws_outbuf = []  # output written before the files
+
+            def ws_send_continue(self):
+                pass  # the event loop sent it before the body was received
+
+            def ws_send_chunked(self, pieces):
+                # The event loop only sends the output when the
+                # handler returns so the pieces are buffered.
+                self.ws_get_logger().debug('Streamed response for {0} is buffered by the event engine.'.format(self.path))
+                RequestHandlerClass.ws_send_chunked(self, pieces)
+
+            def ws_send_file(self, ifp, offset, count):
+                # Queue the file region so that the event loop sends
+                # it without blocking. The file descriptor is
+                # duplicated because the caller closes the file.
+                self.ws_outbuf.append(self.wfile.getvalue())
+                self.wfile = StringIO.StringIO()
+                self.ws_outbuf.append(EventFile(os.dup(ifp.fileno()), offset, count))
+
+            def handle(self):
+                self.handle_one_request()
+
+            def finish(self):
+                pass
+
+        return EventRequestHandler
+
+    def fileno(self):
+        '''
+        The listening socket file descriptor.
+        '''
+        return self.socket.fileno()
+
+    def serve_forever(self):
+        '''
+        Handle the connections until shutdown() is called.
+        '''
+        self.m_poller = EventPoller()
+        self.socket.setblocking(0)
+        self.m_poller.update(self.fileno())
+        last_sweep = time.time()
+        try:
+            while not self.m_shutdown:
+                for fd, readable, writable in self.m_poller.poll(1.):
+                    if fd == self.fileno():
+                        self.handle_accept()
+                        continue
+                    conn = self.m_connections.get(fd)
+                    if conn is not None and conn.m_handshake is not None:
+                        if self.handle_handshake(conn) is False:
+                            continue
+                    if conn is not None and readable:
+                        self.handle_read(conn)
+                    if conn is not None and writable and fd in self.m_connections:
+                        self.handle_write(conn)
+
+                now = time.time()
+                if now - last_sweep >= 1:
+                    last_sweep = now
+                    for conn in list(self.m_connections.values()):
+                        if conn.m_handshake is not None:
+                            if now - conn.m_handshake > self.handshake_timeout:
+                                self.ws_stats.incr('tls_handshake_failures')
+                                self.close_connection(conn)
+                        elif now - conn.m_last_active > self.idle_timeout:
+                            self.close_connection(conn)
+        finally:
+            for conn in list(self.m_connections.values()):
+                self.close_connection(conn)
+            self.m_poller.close()
+
+    def shutdown(self):
+        '''
+        Stop the event loop.
+        '''
+        self.m_shutdown = True
+
+    def server_close(self):
+        '''
+        Close the listening socket.
+        '''
+        self.socket.close()
+
+    def handle_error(self, request, client_address):
+        '''
+        Report an exception raised by the request handler.
+        '''
+        print('-' * 40)
+        print('Exception happened during processing of request from {0}'.format(client_address))
+        traceback.print_exc()
+        print('-' * 40)
+
+    def handle_accept(self):
+        '''
+        Accept all of the pending connections.
+        '''
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as exc:
+                if exc.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    self.handle_error(None, None)
+                return
+            sock.setblocking(0)
+            if self.ws_ssl_context is not None:
+                sock = self.ws_ssl_context.wrap_socket(sock,
+                                                       server_side=True,
+                                                       do_handshake_on_connect=False)
+            conn = EventConnection(sock, client_address)
+            self.m_connections[sock.fileno()] = conn
+            self.m_poller.update(sock.fileno())
+            self.ws_stats.incr('connections_open')
+            if self.ws_ssl_context is not None:
+                conn.m_handshake = time.time()
+                self.handle_handshake(conn)
+
+    def handle_handshake(self, conn):
+        '''
+        Continue the non-blocking TLS handshake.
+        Return True when it is complete.
+        '''
+        try:
+            conn.m_sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.m_poller.update(conn.m_sock.fileno(), read=True, write=False)
+            return False
+        except ssl.SSLWantWriteError:
+            self.m_poller.update(conn.m_sock.fileno(), read=False, write=True)
+            return False
+        except (ssl.SSLError, socket.error):
+            self.ws_stats.incr('tls_handshake_failures')
+            self.close_connection(conn)
+            return False
+        self.ws_stats.add_time('tls_handshake', time.time() - conn.m_handshake)
+        conn.m_handshake = None
+        conn.m_last_active = time.time()
+        self.m_poller.update(conn.m_sock.fileno(), read=True, write=False)
+        return True
+
+    def close_connection(self, conn):
+        '''
+        Close a client connection.
+        '''
+        fd = conn.m_sock.fileno()
+        if self.m_connections.pop(fd, None) is None:
+            return
+        self.m_poller.remove(fd)
+        try:
+            conn.m_sock.close()
+        except socket.error:
+            pass
+        for item in conn.m_outbuf:
+            if isinstance(item, EventFile):
+                item.close()
+        if conn.m_spool is not None:
+            conn.m_spool.close()
+        self.ws_stats.incr('connections_open', -1)
+
+    def handle_read(self, conn):
+        '''
+        Read the available data and handle the complete requests.
+        '''
+        while True:
+            try:
+                data = conn.m_sock.recv(self.read_size)
+            except ssl.SSLWantReadError:
+                break
+            except socket.error as exc:
+                if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close_connection(conn)
+                return
+            if not data:
+                self.close_connection(conn)
+                return
+            conn.m_inbuf += data
+            if not getattr(conn.m_sock, 'pending', None) or conn.m_sock.pending() == 0:
+                break
+
+        conn.m_last_active = time.time()
+        self.handle_requests(conn)
+        if conn.m_sock.fileno() in self.m_connections:
+            self.handle_write(conn)
+
+    def handle_requests(self, conn):
+        '''
+        Handle the complete requests in the input buffer.
+
+        The offsets are from the start of the request. When a request
+        is larger than the spool size, the data that was scanned is
+        moved to a temporary file as it is received so that the
+        input buffer stays small.
+        '''
+        while conn.m_closing is False:
+            header = conn.m_header
+            if header is None:
+                end = conn.m_inbuf.find('\r\n\r\n')
+                if end < 0:
+                    if len(conn.m_inbuf) > self.max_header_size:
+                        conn.m_outbuf.append('HTTP/1.0 431 Request Header Fields Too Large\r\n\r\n')
+                        conn.m_closing = True
+                    return
+                header = conn.m_header = str(conn.m_inbuf[:end + 4])
+
+            base = conn.m_spooled
+            try:
+                if re.search(r'^transfer-encoding:[ \t]*chunked[ \t]*\r?$', header, re.IGNORECASE | re.MULTILINE):
+                    # Resume the scan where the last read stopped.
+                    pos, size = conn.m_scan or (len(header), 0)
+                    total, pos, size = chunked_body_end(conn.m_inbuf, pos - base, size, self.max_body_size)
+                    pos += base
+                    if total >= 0:
+                        total += base
+                    conn.m_scan = (pos, size)
+                else:
+                    match = re.search(r'^content-length:[ \t]*(\d+)[ \t]*\r?$', header, re.IGNORECASE | re.MULTILINE)
+                    length = int(match.group(1)) if match else 0
+                    if 0 < self.max_body_size < length:
+                        raise RequestTooLarge('Request body is larger than {0} bytes'.format(self.max_body_size))
+                    total = pos = len(header) + length
+            except RequestBodyError as exc:
+                # Reject it before the rest of the body is received.
+                self.ws_stats.incr('request_body_errors')
+                reason = HTTPServer.SimpleHTTPRequestHandler.responses[exc.status][0]
+                conn.m_outbuf.append('HTTP/1.0 {0} {1}\r\n\r\n'.format(exc.status, reason))
+                conn.m_closing = True
+                return
+
+            if total < 0 or base + len(conn.m_inbuf) < total:
+                # Wait for the rest of the body.
+                if conn.m_continue is False and re.search(r'^expect:[ \t]*100-continue', header, re.IGNORECASE | re.MULTILINE):
+                    conn.m_continue = True
+                    conn.m_outbuf.append('HTTP/1.1 100 Continue\r\n\r\n')
+                if conn.m_spool is None and base + len(conn.m_inbuf) > self.spool_size:
+                    conn.m_spool = tempfile.TemporaryFile()
+                    self.ws_stats.incr('spooled_requests')
+                if conn.m_spool is not None:
+                    # The scan resumes at pos so the data before it
+                    # is not needed in memory.
+                    self.spool(conn, min(pos - base, len(conn.m_inbuf)))
+                return
+
+            if conn.m_spool is None:
+                data = str(conn.m_inbuf[:total])
+                del conn.m_inbuf[:total]
+            else:
+                self.spool(conn, total - base)
+                data = conn.m_spool
+                data.seek(0)
+            conn.m_header = None
+            conn.m_scan = None
+            conn.m_spool = None
+            conn.m_spooled = 0
+            conn.m_continue = False
+            self.handle_request(conn, data)
+
+    def spool(self, conn, count):
+        '''
+        Move the first count bytes of the input buffer to the
+        temporary file of the request.
+        '''
+        conn.m_spool.write(conn.m_inbuf[:count])
+        del conn.m_inbuf[:count]
+        conn.m_spooled += count
+
+    def handle_request(self, conn, data):
+        '''
+        Run the request handler for a complete request.
+        '''
+        conn.m_requests += 1
+        self.ws_stats.incr('requests')
+        try:
+            handler = self.RequestHandlerClass(conn.m_sock, conn.m_client_address, self, data, conn.m_requests)
+        except Exception:
+            self.handle_error(conn.m_sock, conn.m_client_address)
+            conn.m_closing = True
+            return
+        finally:
+            if isinstance(data, str) is False:
+                data.close()
+        for item in handler.ws_outbuf + [handler.wfile.getvalue()]:
+            if isinstance(item, EventFile) or item:
+                conn.m_outbuf.append(item)
+        if handler.close_connection:
+            conn.m_closing = True
+
+    def write_file(self, conn, item):
+        '''
+        Send the next part of a file region.
+        Return True when all of it has been sent and None if the
+        socket would block.
+        '''
+        if item.m_count == 0:
+            item.close()
+            return True
+        count = min(item.m_count, 1 << 20)
+        if SENDFILE is not None and not isinstance(conn.m_sock, ssl.SSLSocket):
+            sent = SENDFILE(conn.m_sock.fileno(), item.m_fd, item.m_offset, count)
+        else:
+            os.lseek(item.m_fd, item.m_offset, os.SEEK_SET)
+            data = os.read(item.m_fd, min(count, self.read_size))
+            if data:
+                sent = conn.m_sock.send(data)
+                if sent == 0:
+                    return None  # the SSL socket would block
+            else:
+                sent = 0
+
+        if sent == 0:
+            # The file is shorter than expected so the
+            # Content-length was wrong.
+            item.m_count = 0
+            conn.m_closing = True
+        else:
+            conn.m_last_active = time.time()  # a slow download is not idle
+        item.m_offset += sent
+        item.m_count -= sent
+        if item.m_count > 0:
+            return False
+        item.close()
+        return True
+
+    def handle_write(self, conn):
+        '''
+        Write as much of the pending output as possible without
+        blocking.
+        '''
+        while conn.m_outbuf:
+            chunk = conn.m_outbuf[0]
+            try:
+                if isinstance(chunk, EventFile):
+                    done = self.write_file(conn, chunk)
+                else:
+                    sent = conn.m_sock.send(chunk[conn.m_outpos:conn.m_outpos + self.read_size])
+                    if sent == 0:
+                        break  # the SSL socket would block
+                    conn.m_last_active = time.time()  # a slow download is not idle
+                    conn.m_outpos += sent
+                    done = conn.m_outpos >= len(chunk)
+            except ssl.SSLWantWriteError:
+                break
+            except (socket.error, OSError) as exc:
+                if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close_connection(conn)
+                return
+            if done is None:
+                break
+            if done is False:
+                continue
+            conn.m_outbuf.popleft()
+            conn.m_outpos = 0
+
+        if conn.m_outbuf:
+            self.m_poller.update(conn.m_sock.fileno(), read=False, write=True)
+        elif conn.m_closing:
+            self.close_connection(conn)
+        else:
+            self.m_poller.update(conn.m_sock.fileno(), read=True, write=False)
+            conn.m_last_active = time.time()
+
+
+def create_server_class(opts):
+    '''
+    Factory to make the server class for the serving mode specified
+    by the options.
+    '''
+    class WebServer(SocketServer.TCPServer):
+        '''
+        Factory generated server class that can share the port
+        with other processes.
+        '''
+        reuse_port = opts.reuseport
+
+        def server_bind(self):
+            '''
+            Set SO_REUSEPORT before binding, if requested.
+            '''
+            if self.reuse_port:
+                set_reuse_port(self.socket)
+            SocketServer.TCPServer.server_bind(self)
+
+        def handle_error(self, request, client_address):
+            '''
+            Stop the server on ^C or SIGTERM even if the server
+            thread is handling a request, for example waiting on
+            an idle persistent connection.
+            '''
+            if sys.exc_info()[0] is KeyboardInterrupt:
+                raise
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+    if opts.engine == 'event':
+        class EventWebServer(EventServer):
+            '''
+            Factory generated event engine server class.
+            '''
+            reuse_port = opts.reuseport
+            idle_timeout = opts.keep_alive_timeout if opts.keep_alive_timeout > 0 else 60
+            handshake_timeout = opts.tls_handshake_timeout
+            max_body_size = opts.max_body_size
+            spool_size = opts.upload_spool_size
+
+        return EventWebServer
+
+    if opts.workers == 0:
+        return WebServer
+
+    class ThreadPoolTCPServer(ThreadPoolMixIn, WebServer):
+        '''
+        Factory generated server class that handles the requests
+        in a pool of worker threads.
+        '''
+        workers = opts.workers
+        queue_size = max(opts.queue_size, 1)
+        request_queue_size = max(opts.queue_size, 5)  # listen backlog
+
+    return ThreadPoolTCPServer
+
+
+def create_ssl_context(opts, logger):
+    '''
+    Create the SSL context that is shared by all of the connections.
+
+    It is created once so that the certificate is only loaded once
+    and so that returning clients can resume their sessions using
+    the server side session cache or session tickets. When the
+    worker processes are pre-forked, it is created before the fork,
+    with or without --reuseport, so that they inherit the same
+    session ticket key and the tickets work across processes. The
+    session cache is not shared, each process has its own.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+
+    # Python 2.7 does not define OP_NO_TICKET.
+    op_no_ticket = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+    try:
+        context.options &= ~op_no_ticket  # enable session tickets
+    except ValueError as exc:
+        logger.warning('Cannot enable TLS session tickets: {0}.'.format(exc))
+
+    try:
+        context.load_cert_chain(opts.cert)
+    except (IOError, ssl.SSLError) as exc:
+        logger.error('Cannot load the certificate file {0}: {1}.'.format(opts.cert, exc))
+        sys.exit(1)
+    return context
+
+
+def create_server(opts, logger, plugin, ssl_context=None):
+    '''
+    Create the server and bind it to the port.
+
+    The SSL context for HTTPS is created unless it is passed
+    in by the parent of the pre-forked worker processes.
+    '''
+    try:
+        RequestHandlerClass = create_request_handler_class(opts, logger, plugin)
+        ServerClass = create_server_class(opts)
+        port = int(opts.port)
+        server = ServerClass((opts.host, port), RequestHandlerClass)
+    except socket.error as exc:
+        logger.error('Failed to start server {0}:{1}: {2}'.format(opts.host, port, exc))
+        sys.exit(1)
+
+    server.ws_opts = opts
+    server.ws_logger = logger
+    server.ws_plugin = plugin
+    server.ws_stats = ServerStats()
+
+    # The plugin can add its own routes.
+    server.ws_routes = RouteTable()
+    server.ws_stats.register('routes_', server.ws_routes.stats)
+    plugin.register_routes(server.ws_routes)
+    server.ws_file_cache = None
+    if opts.file_cache_size > 0:
+        server.ws_file_cache = FileCache(opts.file_cache_size)
+        server.ws_stats.register('file_cache_', server.ws_file_cache.stats)
+
+    server.ws_script_pool = None
+    if opts.script_workers > 0:
+        # The worker processes are started by run_server() in
+        # the process that serves the requests.
+        server.ws_script_pool = ScriptPool(opts.script_workers,
+                                           opts.script_max_requests,
+                                           opts.script_memory_limit)
+        server.ws_stats.register('script_pool_', server.ws_script_pool.stats)
+
+    server.ws_cmd_executor = CommandExecutor(opts.exec_max_running,
+                                             opts.exec_max_per_script,
+                                             opts.exec_queue_size,
+                                             opts.exec_timeout,
+                                             server.ws_script_pool)
+    server.ws_stats.register('exec_', server.ws_cmd_executor.stats)
+
+    server.ws_exec_cache = None
+    if opts.exec_cache_ttl > 0 or opts.exec_cache_path:
+        server.ws_exec_cache = ExecCache(opts.exec_cache_ttl, opts.exec_cache_path)
+        server.ws_stats.register('exec_cache_', server.ws_exec_cache.stats)
+
+    server.ws_path_index = PathIndex(opts.webdir, opts.stat_cache_ttl, RequestHandlerClass.extensions_map)
+    server.ws_path_index.build()
+    if opts.stat_cache_ttl > 0:
+        server.ws_stats.register('stat_cache_', server.ws_path_index.stats)
+
+    compiled = None
+    if opts.template_compile_dir is not None:
+        compiled = TemplateCompileCache(opts.template_compile_dir)
+        server.ws_stats.register('template_compile_', compiled.stats)
+    server.ws_template_cache = TemplateCache(opts.template_cache_size, opts.webdir, opts.stat_cache_ttl, compiled)
+    server.ws_stats.register('template_cache_', server.ws_template_cache.stats)
+    if opts.precompile_on_start:
+        count, errors = precompile_templates(server.ws_template_cache, opts.webdir)
+        for path, exc in errors:
+            logger.warning('Cannot compile template {0}: {1}.'.format(path, exc))
+        logger.info('Compiled {0} templates, {1} failed.'.format(count, len(errors)))
+    server.ws_template_pool = None
+    if opts.template_workers > 0:
+        # The worker processes are started by run_server() in
+        # the process that serves the requests.
+        server.ws_template_pool = TemplatePool(opts.template_workers,
+                                               opts.template_timeout,
+                                               opts.template_cpu_limit,
+                                               opts.template_memory_limit)
+        server.ws_stats.register('template_pool_', server.ws_template_pool.stats)
+
+    server.ws_ssl_context = None
+    if opts.https:
+        # The TLS handshake is done for each connection by the
+        # request handler or the event engine, not by accept().
+        server.ws_ssl_context = ssl_context or create_ssl_context(opts, logger)
+        server.ws_stats.register('tls_session_', server.ws_ssl_context.session_stats)
+
+    return server
+
+
+def run_server(opts, logger, server):
+    '''
+    Handle requests until the user types ^C or the process is
+    killed.
+    '''
+    spawner = None
+    if server.ws_template_pool is not None or server.ws_script_pool is not None:
+        # Start it before the worker threads so that it is forked
+        # from a single threaded process (see WorkerSpawner).
+        spawner = WorkerSpawner()
+        spawner.start()
+
+    if server.ws_template_pool is not None:
+        server.ws_template_pool.start(spawner)
+        logger.info('Started {0} template worker processes.'.format(opts.template_workers))
+
+    if server.ws_script_pool is not None:
+        server.ws_script_pool.start(spawner)
+        logger.info('Started {0} script worker processes.'.format(opts.script_workers))
+
+    # The plugin sets up the state of this process after the
+    # worker processes were forked.
+    server.ws_plugin.on_start(server)
+
+    if opts.workers > 0:
+        server.start_workers()
+        logger.info('Started {0} worker threads, queue size {1}.'.format(opts.workers, opts.queue_size))
+    else:
+        server.ws_plugin.on_worker_start(server)  # this thread handles the requests
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt.')
 
     try:
         server.shutdown()
+        if opts.workers > 0:
+            server.stop_workers()
+        if server.ws_template_pool is not None:
+            server.ws_template_pool.stop()
+        if server.ws_script_pool is not None:
+            server.ws_script_pool.stop()
+        if spawner is not None:
+            spawner.stop()
+        server.ws_plugin.on_shutdown(server)
         server.server_close()
     except Exception as exc:
         logger.error('Server shutdown failed: {0!r}.'.format(exc))
 
 
+def sigterm_handler(signum, frame):
+    '''
+    Treat SIGTERM like ^C so that the server shuts down cleanly.
+    '''
+    raise KeyboardInterrupt
+
+
+def get_sendfile():
+    '''
+    Get a sendfile(out_fd, in_fd, offset, count) function, like
+    os.sendfile, or None if it is not available.
+
+    Python 2.7 does not have os.sendfile so call the C library
+    directly on Linux.
+    '''
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (AttributeError, OSError, TypeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        '''
+        Copy count bytes from in_fd, starting at offset, to out_fd.
+        Return the number of bytes copied.
+        '''
+        pos = ctypes.c_int64(offset)
+        sent = function(out_fd, in_fd, ctypes.byref(pos), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+
+    return sendfile
+
+
+SENDFILE = get_sendfile()
+
+
+def set_cpu_affinity(logger, cpu):
+    '''
+    Pin the current process to a single CPU.
+
+    Python 2.7 does not have os.sched_setaffinity so call the C
+    library directly on Linux.
+    '''
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [cpu])
+        else:
+            # The mask is a cpu_set_t (1024 CPUs) of unsigned longs.
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+            mask = (ctypes.c_ulong * max(1024 // bits, cpu // bits + 1))()
+            mask[cpu // bits] = 1 << (cpu % bits)
+            if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        logger.debug('Process {0} pinned to CPU {1}.'.format(os.getpid(), cpu))
+    except (AttributeError, OSError, TypeError) as exc:
+        logger.warning('Cannot pin process {0} to CPU {1}: {2}.'.format(os.getpid(), cpu, exc))
+
+
+def serve_prefork(opts, logger, plugin):
+    '''
+    Pre-fork the worker processes and restart them if they die.
+
+    If --reuseport was specified, each worker process binds its own
+    socket to the port with SO_REUSEPORT and the kernel distributes
+    the connections. Otherwise the listening socket is created once
+    here and shared by all of the worker processes.
+
+    This process only manages the worker processes so when the
+    server is daemonized it is the one that owns the PID file.
+    '''
+    # The worker processes share the session ticket key
+    # of the SSL context even if they create their own server.
+    ssl_context = create_ssl_context(opts, logger) if opts.https else None
+    server = None
+    if opts.reuseport is False:
+        server = create_server(opts, logger, plugin, ssl_context)
+
+    ncpus = multiprocessing.cpu_count()
+    children = {}  # pid --> (slot, start time)
+
+    def spawn(slot):
+        '''
+        Fork a worker process.
+        '''
+        pid = os.fork()
+        if pid:
+            children[pid] = (slot, time.time())
+            return
+
+        # This is the worker process.
+        # It never returns so that the PID file is left alone.
+        status = 0
+        try:
+            if opts.cpu_affinity:
+                set_cpu_affinity(logger, slot % ncpus)
+            child_server = server
+            if child_server is None:
+                child_server = create_server(opts, logger, plugin, ssl_context)
+            logger.info('Worker process {0} started, PID={1}.'.format(slot, os.getpid()))
+            run_server(opts, logger, child_server)
+        except SystemExit as exc:
+            status = exc.code if isinstance(exc.code, int) else 1
+        except BaseException as exc:
+            logger.error('Worker process {0} failed: {1!r}.'.format(slot, exc))
+            status = 1
+        os._exit(status)
+
+    try:
+        for slot in range(opts.processes):
+            spawn(slot)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in children:
+                continue
+            slot, started = children.pop(pid)
+            if os.WIFSIGNALED(status):
+                reason = 'signal {0}'.format(os.WTERMSIG(status))
+            else:
+                reason = 'status {0}'.format(os.WEXITSTATUS(status))
+            logger.warning('Worker process {0} exited, PID={1}, {2}, restarting.'.format(slot, pid, reason))
+            if time.time() - started < 1:
+                time.sleep(1)  # do not fork continuously if the worker fails at startup
+            spawn(slot)
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt.')
+
+    # Stop the worker processes.
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    if server is not None:
+        server.server_close()
+
+
+def serve(opts, logger, plugin):
+    '''
+    Run the webserver until the user types ^C or the process is
+    killed.
+    '''
+    if opts.https is True and opts.cert is None:
+        logger.error('HTTPS must have a cert file (--cert).')
+        sys.exit(1)
+    if opts.https is False and opts.cert is not None:
+        logger.warning('Cert file specified but --https was not specified, did you mean to specify --https?')
+
+    if opts.engine == 'event' and opts.workers > 0:
+        logger.error('The event engine (--engine event) cannot be used with --workers.')
+        sys.exit(1)
+    if opts.engine == 'event':
+        logger.info('The event engine buffers the streamed responses until they are complete.')
+
+    if opts.keep_alive_timeout > 0 and opts.workers == 0 and opts.engine != 'event':
+        logger.info('Persistent connections are disabled, they need --workers or --engine event.')
+
+    protocol = 'HTTP'
+    if opts.https:
+        protocol += 'S'
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    if opts.processes > 0:
+        logger.info('Listening on {0}:{1} for {2} requests in {3} processes.'.format(opts.host,
+                                                                                     opts.port,
+                                                                                     protocol,
+                                                                                     opts.processes))
+        os.chdir(opts.webdir)
+        serve_prefork(opts, logger, plugin)
+        return
+
+    server = create_server(opts, logger, plugin)
+    logger.info('Listening on {0}:{1} for {2} requests.'.format(opts.host, opts.port, protocol))
+    os.chdir(opts.webdir)
+    run_server(opts, logger, server)
+
+
 def generate(opts):
     '''
     Generate the default plugin module by parsing this source file.
@@ -1595,15 +6561,17 @@ def generate(opts):
     flag = False
     for line in lines:
         line = line.rstrip()
-        if line.find('def default_request_handler') == 0:
-            line = line.replace('def default_request_handler', 'def request_handler')
+        if line.find('def default_plugin') == 0:
+            line = line.replace('def default_plugin', 'def request_handler')
             flag = True
             print("'''")
-            print('# Default request handler.')
+            print('# Default plugin.')
             print("'''")
             print('import Cookie')
             print('import cgi')
             print('import datetime')
+            print('import email.utils')
+            print('import hashlib')
             print('import mimetypes')
             print('import os')
             print('import random')
@@ -1611,8 +6579,9 @@ def generate(opts):
             print('import select')
             print('import string')
             print('import subprocess')
+            print('import zlib')
             print('')
-        elif line.find('def ') == 0:
+        elif line.find('def ') == 0 or line.find('class ') == 0:
             flag = False
         if flag:
             print(line)
@@ -1626,16 +6595,17 @@ def main():
     '''
     opts, name = getopts()
     generate(opts)
+    precompile(opts)
 
     logger = logger_init(opts, name)
     logger = logger_update(opts, logger)
 
     logger.info('********************************')
     logger.info('Starting the server.')
-    request_handler = get_request_handler(opts, logger)
+    plugin = get_plugin(opts, logger)
     log_setup_info(opts, logger)
     daemon_start(opts, logger)
-    serve(opts, logger, request_handler)
+    serve(opts, logger, plugin)
     daemon_stop(opts, logger)
     logger.info('Stopping the server.')
 
@@ -1,9 +1,11 @@
 '''
-# Default request handler.
+# Default plugin.
 '''
 import Cookie
 import cgi
 import datetime
+import email.utils
+import hashlib
 import mimetypes
 import os
 import random
@@ -11,10 +13,16 @@ import re
 import select
 import string
 import subprocess
+import zlib
 
-def request_handler(req):
+def request_handler():
     '''
-    This is the default request handler.
+    This is the default plugin. It returns the plugin object.
+
+    The helper functions are defined once, when the plugin is
+    created, and the setup that is shared by all of the requests,
+    like the globals and the routes of the special URLs, is done
+    once in on_start(). Each request only dispatches and renders.
 
     It is not meant for production but it shows how flexible the
     system is. Here is how it behaves.
@@ -133,10 +141,16 @@ def request_handler(req):
            req.m_syspath   system path
            req.m_protocol  HTTP or HTTPS
            req.m_params    GET/POST parameters
-        '''
-        # Initialize the globals.
-        init_globals(opts)
+           req.m_files     uploaded files (UploadFile objects)
+
+        The contents of the uploaded files that are kept in memory
+        (--upload-spool-size) are also in req.m_params, like in the
+        earlier versions, so that the plugins that read them there
+        still work.
 
+        It returns False if the POST data could not be read, the
+        error response was sent.
+        '''
         # Parse the GET options.
         if req.path.find('?') >= 0:
             parts = req.path.split('?')
@@ -147,20 +161,25 @@ def request_handler(req):
             urlpath = req.path
 
         # Parse the POST options.
+        # The uploaded files are not read into memory.
+        files = {}
         if req.command == 'POST':
             assert len(params) == 0
-            ctype, pdict = cgi.parse_header(req.headers.getheader('content-type'))
-            if ctype == 'multipart/form-data':
-                params = cgi.parse_multipart(req.rfile, pdict)
-            elif ctype == 'application/x-www-form-urlencoded':
-                length = int(req.headers['content-length'])
-                data = req.rfile.read(length)
-                params = cgi.parse_qs(data, keep_blank_values=1)
+            form = req.ws_read_form()
+            if form is None:
+                return False
+            params, files = form
+            for name, entries in files.items():
+                if not any(entry.spooled() for entry in entries):
+                    params.setdefault(name, []).extend(entry.read() for entry in entries)
 
             # some browser send 2 more bytes
-            rdy, _, _ = select.select([req.connection], [], [], 0)
-            if rdy:
-                req.rfile.read(2)
+            # Only discard them when the connection is about to be
+            # closed, otherwise they could belong to the next request.
+            if req.close_connection:
+                rdy, _, _ = select.select([req.connection], [], [], 0)
+                if rdy:
+                    req.rfile.read(2)
 
         # Get the system path and the root path.
         syspath = req.translate_path(urlpath)
@@ -172,6 +191,7 @@ def request_handler(req):
         setattr(req, 'm_syspath', syspath)   # system path, file or dir
         setattr(req, 'm_sysroot', sysroot)   # system path to the root directory
         setattr(req, 'm_params', params)     # parameters from GET or POST
+        setattr(req, 'm_files', files)       # uploaded files from POST
         setattr(req, 'm_protocol', protocol) # HTTP or HTTPS
         setattr(req, 'm_headers', [])        # additional headers
 
@@ -210,6 +230,7 @@ def request_handler(req):
             for header in headers.split('\n'):
                 if len(header):  # skip zero length headers
                     logger.debug('   {0} {1}'.format(len(header), header))
+        return True
 
     def nocache(req):
         '''
@@ -220,13 +241,15 @@ def request_handler(req):
             req.m_headers.append(('Pragma', 'no-cache'))  # HTTP 1.0
             req.m_headers.append(('Expires', '0'))  # HTTP 1.0 proxies
 
-    def send(req, ctype, out):
+    def send_headers(req, ctype, length, code=200):
         '''
-        Send the page.
+        Send the response headers.
         '''
-        req.send_response(200)
-        req.send_header('Content-type', ctype)
-        req.send_header('Content-length', len(out))
+        req.send_response(code)
+        if ctype is not None:
+            req.send_header('Content-type', ctype)
+        if length is not None:
+            req.send_header('Content-length', length)
 
         # Cookies - this always resets all of the cookies.
         for morsel in req.m_cookie.values():  # SimpleCookie object.
@@ -238,8 +261,397 @@ def request_handler(req):
 
         req.end_headers()
 
+    def send(req, ctype, out):
+        '''
+        Send the page.
+
+        It is compressed on the fly if the client accepts it.
+        '''
+        if isinstance(out, unicode):
+            out = out.encode('utf-8')  # the length must be in bytes
+        encoding = choose_encoding(req, ctype, len(out))
+        if encoding is not None:
+            out = compress(out, encoding)
+            req.m_headers.append(('Content-Encoding', encoding))
+        send_headers(req, ctype, len(out))
         req.wfile.write(out)
 
+    def compressible(ctype):
+        '''
+        Is it worth compressing this content type?
+        Images (other than SVG), audio, video and archives are
+        already compressed.
+        '''
+        ctype = ctype.split(';')[0].strip().lower()
+        return ctype.startswith('text/') or ctype in ['application/javascript',
+                                                      'application/json',
+                                                      'application/x-javascript',
+                                                      'application/xml',
+                                                      'image/svg+xml', ]
+
+    def choose_encoding(req, ctype, size, min_size=256):
+        '''
+        Choose the content encoding (gzip or deflate) from the
+        Accept-Encoding header.
+
+        It is None if the content is not compressible, too small
+        to be worth compressing or the client does not accept a
+        compressed encoding.
+        '''
+        if ctype is None or compressible(ctype) is False:
+            return None
+
+        # The response depends on the Accept-Encoding header.
+        if ('Vary', 'Accept-Encoding') not in req.m_headers:
+            req.m_headers.append(('Vary', 'Accept-Encoding'))
+
+        header = req.headers.getheader('accept-encoding')
+        if header is None or size < min_size:
+            return None
+
+        qvals = {}
+        for item in header.split(','):
+            fields = item.split(';')
+            qval = 1.
+            for field in fields[1:]:
+                key, _, val = field.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        qval = float(val)
+                    except ValueError:
+                        qval = 0.
+            qvals[fields[0].strip().lower()] = qval
+
+        for encoding in ['gzip', 'deflate']:
+            if qvals.get(encoding, qvals.get('*', 0.)) > 0:
+                return encoding
+        return None
+
+    def compressor(encoding):
+        '''
+        Create a compression object for the gzip or deflate (zlib)
+        content encoding.
+        '''
+        wbits = zlib.MAX_WBITS
+        if encoding == 'gzip':
+            wbits += 16  # gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+    def compress(data, encoding):
+        '''
+        Compress the data using the gzip or deflate (zlib)
+        content encoding.
+        '''
+        cobj = compressor(encoding)
+        return cobj.compress(data) + cobj.flush()
+
+    def compress_stream(pieces, encoding):
+        '''
+        Compress the pieces of a stream. Each piece is flushed so
+        that the client can decompress it right away.
+        '''
+        cobj = compressor(encoding)
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            if piece:
+                yield cobj.compress(piece) + cobj.flush(zlib.Z_SYNC_FLUSH)
+        yield cobj.flush()
+
+    def stream_pieces(first, pieces):
+        '''
+        Generate the first piece, that was already produced, followed
+        by the rest of the pieces.
+        '''
+        yield first
+        for piece in pieces:
+            yield piece
+
+    def send_stream(req, ctype, pieces):
+        '''
+        Send the page pieces as they are produced.
+
+        The headers are sent, without a Content-length, once the
+        first piece is produced so that an error raised before that,
+        like a missing template variable, can still be reported by
+        the caller. The pieces are sent using the chunked transfer
+        encoding.
+        '''
+        source = pieces
+        try:
+            pieces = iter(pieces)
+            first = next(pieces, '')
+        except Exception:
+            if hasattr(source, 'close'):
+                source.close()
+            raise
+        pieces = stream_pieces(first, pieces)
+
+        if req.request_version == 'HTTP/1.0':
+            req.close_connection = 1  # the end of the connection ends the body
+        else:
+            req.m_headers.append(('Transfer-Encoding', 'chunked'))
+        encoding = choose_encoding(req, ctype, 0, min_size=0)  # the size is not known
+        if encoding is not None:
+            pieces = compress_stream(pieces, encoding)
+            req.m_headers.append(('Content-Encoding', encoding))
+        send_headers(req, ctype, None)
+        try:
+            req.ws_send_chunked(pieces)
+        except Exception as exc:
+            # It is too late to report the error to the client.
+            # Closing the connection without the last chunk tells
+            # it that the page is not complete.
+            req.ws_get_logger().error('Streaming failed for {0}: {1!r}.'.format(req.path, exc))
+            req.close_connection = 1
+        finally:
+            # Release what produces the pieces, like a command,
+            # even if the client went away.
+            if hasattr(source, 'close'):
+                source.close()
+
+    def file_etag(stat):
+        '''
+        Get the strong entity tag of a static file from its
+        modification time and size.
+        '''
+        return '"{0:x}-{1:x}"'.format(int(stat.st_mtime * 1000000), stat.st_size)
+
+    def template_etag(req, tmpl):
+        '''
+        Get the weak entity tag of a rendered template from the
+        versions of the template and its included files and the
+        parameters.
+
+        Templates with embedded python do not have one because
+        the python code can produce different output for the same
+        parameters (the date, for example).
+        '''
+        if tmpl.m_python:
+            return None
+        params = define_template_parameters(req)
+        key = '{0}:{1!r}'.format(tmpl.m_version, sorted(params.items()))
+        return 'W/"{0}"'.format(hashlib.md5(key).hexdigest())
+
+    def not_modified(req, etag, mtime):
+        '''
+        Check the conditional request headers.
+
+        Return True if the client copy is still valid so that a
+        304 (Not Modified) response can be sent.
+        '''
+        if req.command not in ['GET', 'HEAD']:
+            return False
+
+        if_none_match = req.headers.getheader('if-none-match')
+        if if_none_match is not None:
+            # It takes precedence over If-Modified-Since.
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags:
+                return True
+            # Weak comparison.
+            return etag.replace('W/', '', 1) in [tag.replace('W/', '', 1) for tag in tags]
+
+        if_modified_since = req.headers.getheader('if-modified-since')
+        if if_modified_since is not None and mtime is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= email.utils.mktime_tz(date)
+        return False
+
+    def send_not_modified(req, etag, last_modified=None):
+        '''
+        Send the 304 (Not Modified) response.
+        It does not have a body.
+        '''
+        req.m_headers.append(('ETag', etag))
+        if last_modified is not None:
+            req.m_headers.append(('Last-Modified', last_modified))
+        send_headers(req, None, None, 304)
+
+    def parse_ranges(req, size, last_modified, etag):
+        '''
+        Parse the Range header of a request for a file with the
+        specified size.
+
+        Return None if the whole file should be sent, otherwise
+        return the list of (first, last) byte positions. The list
+        is empty if none of the ranges can be satisfied.
+        '''
+        header = req.headers.getheader('range')
+        if header is None or req.command != 'GET':
+            return None
+
+        # The range only applies if the file has not changed.
+        if_range = req.headers.getheader('if-range')
+        if if_range is not None and if_range.strip() not in [last_modified, etag]:
+            return None
+
+        match = re.search(r'^\s*bytes\s*=(.+)$', header)
+        if match is None:
+            return None  # not a byte range, ignore it
+        specs = match.group(1).split(',')
+        if len(specs) > 32:
+            return None  # too many ranges, ignore them
+
+        ranges = []
+        for spec in specs:
+            match = re.search(r'^\s*(\d*)\s*-\s*(\d*)\s*$', spec)
+            if match is None or match.group(1) + match.group(2) == '':
+                return None  # invalid syntax, ignore the header
+            if match.group(1) == '':
+                # Suffix range: the last N bytes.
+                count = int(match.group(2))
+                if count > 0 and size > 0:
+                    ranges.append((max(size - count, 0), size - 1))
+                continue
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.group(2) else None
+            if last is not None and last < first:
+                return None  # invalid syntax, ignore the header
+            if first < size:
+                ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+        return ranges
+
+    def file_info(req, ctype, stat, encoding=None):
+        '''
+        Get the precomputed headers of a static file.
+
+        Compressed variants have their own entity tag.
+        '''
+        etag = file_etag(stat)
+        if encoding is not None:
+            etag = etag[:-1] + '-' + encoding + '"'
+        return {'ctype': ctype,
+                'encoding': encoding,
+                'etag': etag,
+                'last_modified': req.date_time_string(stat.st_mtime),
+                'mtime': stat.st_mtime}
+
+    def send_file(req, ctype, ifp, encoding=None):
+        '''
+        Send a static file without reading it into memory.
+        Each range is sent directly from the file.
+        '''
+        stat = os.fstat(ifp.fileno())
+        info = file_info(req, ctype, stat, encoding)
+        send_ranges(req, info, stat.st_size, lambda offset, count: req.ws_send_file(ifp, offset, count))
+
+    def send_compressed_file(req, ctype, path, encoding, cache):
+        '''
+        Send the compressed variant of a static file.
+
+        A precompressed gzip sibling (path + '.gz') that is not
+        older than the file is sent directly. Otherwise the file
+        is compressed once and kept in the file cache.
+
+        Return False if there is no compressed variant.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        if encoding == 'gzip':
+            try:
+                gzstat = os.stat(path + '.gz')
+            except OSError:
+                gzstat = None
+            if gzstat is not None and gzstat.st_mtime >= stat.st_mtime:
+                etag = file_info(req, ctype, gzstat, encoding)['etag']
+                if not_modified(req, etag, gzstat.st_mtime):
+                    send_not_modified(req, etag, req.date_time_string(gzstat.st_mtime))
+                    return True
+                try:
+                    ifp = open(path + '.gz', 'rb')
+                except IOError:
+                    return False
+                with ifp:
+                    send_file(req, ctype, ifp, encoding)
+                return True
+
+        if cache is None:
+            return False
+        entry = cache.lookup(path, encoding)
+        if entry is None:
+            if cache.cacheable(stat.st_size) is False:
+                return False
+            try:
+                with open(path, 'rb') as ifp:
+                    stat = os.fstat(ifp.fileno())
+                    data = compress(ifp.read(), encoding)
+            except IOError:
+                return False
+            info = file_info(req, ctype, stat, encoding)
+            cache.store(path, stat, data, info, encoding)
+            entry = (data, info)
+        send_cached_file(req, *entry)
+        return True
+
+    def send_cached_file(req, data, info):
+        '''
+        Send a static file from the file cache.
+        '''
+        etag = info['etag']
+        if not_modified(req, etag, info['mtime']):
+            send_not_modified(req, etag, info['last_modified'])
+            return
+        send_ranges(req, info, len(data), lambda offset, count: req.wfile.write(data[offset:offset + count]))
+
+    def send_ranges(req, info, size, write):
+        '''
+        Send the static file data with the write(offset, count)
+        function.
+
+        It supports byte range requests (206 Partial Content)
+        so that clients can resume downloads or seek in media
+        files.
+        '''
+        ctype = info['ctype']
+        last_modified = info['last_modified']
+        etag = info['etag']
+        if info['encoding'] is not None:
+            req.m_headers.append(('Content-Encoding', info['encoding']))
+        req.m_headers.append(('Accept-Ranges', 'bytes'))
+        req.m_headers.append(('ETag', etag))
+        req.m_headers.append(('Last-Modified', last_modified))
+
+        ranges = parse_ranges(req, size, last_modified, etag)
+        if ranges is None:
+            send_headers(req, ctype, size)
+            write(0, size)
+        elif len(ranges) == 0:
+            req.m_headers.append(('Content-Range', 'bytes */{0}'.format(size)))
+            send_headers(req, ctype, 0, 416)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            req.m_headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, size)))
+            send_headers(req, ctype, last - first + 1, 206)
+            write(first, last - first + 1)
+        else:
+            # Multiple ranges are sent as multipart/byteranges.
+            boundary = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(24))
+            parts = []
+            length = 0
+            for first, last in ranges:
+                part = '\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(boundary,
+                                                                                                                 ctype,
+                                                                                                                 first,
+                                                                                                                 last,
+                                                                                                                 size)
+                parts.append((part, first, last - first + 1))
+                length += len(part) + last - first + 1
+            end = '\r\n--{0}--\r\n'.format(boundary)
+            length += len(end)
+
+            send_headers(req, 'multipart/byteranges; boundary=' + boundary, length, 206)
+            for part, first, count in parts:
+                req.wfile.write(part)
+                write(first, count)
+            req.wfile.write(end)
+
     def escape_text(text):
         '''
         Escape text for HTML presentation.
@@ -283,6 +695,13 @@ def request_handler(req):
                 text = text.rstrip()
             lines.append('   {0:<16} {1}'.format(key, text))
 
+        lines.append('')
+
+        lines.append('Server Statistics')
+        entries = req.ws_get_stats().snapshot()
+        for key in sorted(entries, key=str.lower):
+            lines.append('   {0:<24} {1}'.format(key, entries[key]))
+
         lines.append('    </pre>')
         lines.append('  </body>')
         lines.append('</html>')
@@ -290,25 +709,36 @@ def request_handler(req):
         out = '\n'.join(lines)
         send(req, 'text/html', out)
 
-    def runcmd(cmd):
+    def send_cmd(req, ctype, cmd, key):
         '''
-        Run a command with a lot of output.
+        Send the output of a command.
+
+        If the output of the URL path is cached (--exec-cache-ttl),
+        the cached output is sent or the command is run once for
+        all of the concurrent requests. Otherwise the output is sent
+        as it is produced.
+
+        The commands are run by the command executor, which limits
+        how many run at once and how long they run. If there is no
+        free slot the response is 503 (Service Unavailable), if the
+        command times out before anything was sent it is 504 (Gateway
+        Timeout).
         '''
-        proc = subprocess.Popen(cmd,
-                                shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-
-        # Read the output 1 character at a time so that it can be
-        # displayed in real time.
-        text = ''
-        while not proc.returncode:
-            data = proc.stdout.read(32)
-            if not data:
-                break # all done, wait for returncode to get populated
-            text += data.decode('utf-8')
-        proc.wait()
-        return proc.returncode, text
+        executor = req.ws_get_cmd_executor()
+        cache = req.ws_get_exec_cache()
+        ttl = 0 if cache is None else cache.ttl(req.m_urlpath)
+        try:
+            if ttl == 0:
+                send_stream(req, ctype, executor.start(cmd))
+                return
+            out = cache.get(key, ttl, lambda: ''.join(executor.start(cmd)))
+        except executor.Busy as exc:
+            req.send_error(503, str(exc))
+            return
+        except executor.Timeout as exc:
+            req.send_error(504, str(exc))
+            return
+        send(req, ctype, out)
 
     def redirect(req, opts, logger, url):
         '''
@@ -317,6 +747,7 @@ def request_handler(req):
         logger.debug('REDIRECT: "{0}".'.format(url))
         req.send_response(301)
         req.send_header('Location', url)
+        req.send_header('Content-length', 0)
 
         # Cookies - this always resets all of the cookies.
         for morsel in req.m_cookie.values():  # SimpleCookie object.
@@ -346,51 +777,75 @@ def request_handler(req):
         params['sid'] = req.m_sid  # session id
         return params
 
+    def run_python(req, tmpl, index, params):
+        '''
+        Run a python fragment of a template.
+
+        If there is a template worker process pool (--template-workers)
+        it runs there and only the parameters that it sets are sent
+        back, otherwise it runs here.
+        '''
+        pool = req.ws_get_template_pool()
+        if pool is None:
+            exec(tmpl.m_codes[index], globals(), params)
+        else:
+            params.update(pool.execute(tmpl, index, params))
 
-    def compile_template(data, depth=8):
+    def compile_template(req, tmpl, depth=8, stream=False):
         '''
         Compile a template with embedded python code.
 
         The python code sits between <!-- python and --> statements.
         It sets the parameter values so that they can be used
         for variable substitution.
+
+        The template was parsed by the template cache so the python
+        code is already compiled, it only has to be executed.
         '''
         params = define_template_parameters(req)
+        initial = dict(params)
 
-        # Find all of the python fragments.
+        # Run all of the python fragments to get all of the
+        # parameters. They look like this.
         # <!-- python
         #   # Set the variables here.
         #   params = locals()
         #   params['title'] = 'Template Test of Embedded Python'
         # -->
-        fragments = re.findall(r'<!-- python(.*?)-->', data, flags=re.DOTALL | re.MULTILINE)
-        if len(fragments) == 0:
-            html = data
-            if re.search(r'[^{][{][^}]+[}][^}]', html):
-                html = html.format(**params)
-        else:
-            # Load up all of the fragments to get all of the
-            # parameters.
-            for fragment in fragments:
-                # left justify so that statements are in the leftmost column.
-                min_indent = min(map(len, re.findall('^([ ]+)', fragment, re.MULTILINE)))
-                fragment = re.sub('^[ ]{' + str(min_indent) + '}', '', fragment, flags=re.MULTILINE)
-                exec(fragment, globals(), params)
-
-            # Remove the python fragments.
-            html = re.sub(r'<!-- python.*?-->\s*\n?', '', data, flags=re.DOTALL | re.MULTILINE).strip()
-
-            # Substitute the values for the variables.
-            # This must be done multiple times because
-            # there may be variables defined in nested
-            # files.
-            html = html.format(**params)
-            for i in range(depth):
-                if not re.search(r'[^{][{][^}]+[}][^}]', html):
-                    break
-                html = html.format(**params)
-
-        return html
+        #
+        # Cached fragments only run when the parameters that they
+        # set are not cached.
+        for index, fragment in enumerate(tmpl.m_fragments):
+            if fragment is None:
+                run_python(req, tmpl, index, params)
+                continue
+            key = fragment.key(params)
+            cached = fragment.get_values(key)
+            if cached is None:
+                before = dict(params)
+                run_python(req, tmpl, index, params)
+                # The params = locals() idiom refers to the
+                # parameters of this request, it is not cached.
+                aliases = [k for k, v in params.items() if v is params]
+                values = dict((k, v) for k, v in params.items()
+                              if v is not params and (k not in before or before[k] is not v))
+                fragment.put_values(key, values, aliases)
+                cached = (values, aliases)
+            values, aliases = cached
+            params.update(values)
+            for alias in aliases:
+                params[alias] = params
+
+        # Substitute the values for the variables in a single
+        # pass. Variables in the values set by the python code
+        # are expanded up to depth levels. The values that come
+        # from the request are substituted literally so that a
+        # client cannot inject variables. Streamed templates
+        # produce the output in pieces.
+        literal = set(key for key, val in initial.items() if params.get(key) is val)
+        if stream:
+            return tmpl.render_iter(params, depth, literal)
+        return tmpl.render(params, depth, literal)
 
     def template(req, logger, ext='.tmpl'):
         '''
@@ -462,20 +917,48 @@ def request_handler(req):
         # Do the substitution and display the results.
         logger.debug('TEMPLATE: "{0}".'.format(req.m_syspath))
         try:
-            with open(req.m_syspath, 'r') as ifp:
-                out = ifp.read()
-            out = compile_template(out)
-            send(req, 'text/html', out)
-        except IOError:
+            tmpl = req.ws_get_template_cache().get(req.m_syspath)
+        except (IOError, OSError):
             req.send_error(404, 'Not found')
+            return True
+
+        # The template worker errors, if there are template workers.
+        pool = req.ws_get_template_pool()
+        limit_error = () if pool is None else pool.LimitError
+        worker_error = () if pool is None else pool.Error
+        try:
+            send_template(req, 'text/html', tmpl)
         except KeyError as exc:
             # At least one of the arguments is not
             # defined. Display the result as plain
             # text.
-            out = '<!-- ERROR: {0!r} -->\n{1}'.format(exc, out)
+            out = '<!-- ERROR: {0!r} -->\n{1}'.format(exc, tmpl.m_data)
             send(req, 'text/plain', out)
+        except limit_error as exc:
+            logger.warning('TEMPLATE: {0}'.format(exc))
+            req.send_error(503, 'Template limit exceeded')
+        except worker_error as exc:
+            logger.error('TEMPLATE: {0}'.format(exc))
+            req.send_error(500, 'Template error')
         return True
 
+    def send_template(req, ctype, tmpl):
+        '''
+        Send the compiled template unless the client copy is
+        still valid.
+        '''
+        etag = template_etag(req, tmpl)
+        if etag is not None:
+            if not_modified(req, etag, None):
+                send_not_modified(req, etag)
+                return
+            req.m_headers.append(('ETag', etag))
+        if tmpl.m_stream:
+            send_stream(req, ctype, compile_template(req, tmpl, stream=True))
+            return
+        out = compile_template(req, tmpl)
+        send(req, ctype, out)
+
     def display_directory(req):
         '''
         Display the directory listing with active links.
@@ -522,7 +1005,7 @@ def request_handler(req):
         out = '\n'.join(lines)
         send(req, 'text/html', out)
 
-    def display_file(req, opts, logger, path):
+    def display_file(req, opts, logger, path, ctype=None):
         '''
         Display the file specified by the path
         argument.
@@ -530,24 +1013,67 @@ def request_handler(req):
         If it is HTML, allow embedded python code.
         '''
         # Load the file data.
-        ctype = req.guess_type(path)
+        if ctype is None:
+            ctype = req.guess_type(path)
         if ctype in ['application/x-sh', ]:
             ctype = 'text/plain'  # fix .sh
         logger.debug('Content type is "{0}".'.format(ctype))
 
+        if ctype == 'text/html':
+            # Allow embedded python in HTML code.
+            try:
+                tmpl = req.ws_get_template_cache().get(path)
+            except (IOError, OSError) as exc:
+                req.send_error(404, 'File not found {0}'.format(exc))
+                return
+            send_template(req, ctype, tmpl)
+            return
+
+        # Send the compressed variant of static files if the
+        # client accepts it.
+        cache = req.ws_get_file_cache()
         try:
-            mode = 'r' if ctype.startswith('text/') else 'rb'
-            with open(path, mode) as ifp:
-                out = ifp.read()
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        encoding = choose_encoding(req, ctype, size)
+        if encoding is not None and send_compressed_file(req, ctype, path, encoding, cache):
+            return
 
-            # Allow embedded python in HTML code.
-            if ctype == 'text/html':
-                out = compile_template(out)
+        # Static files in the file cache already have
+        # their headers.
+        if cache is not None:
+            entry = cache.lookup(path)
+            if entry is not None:
+                send_cached_file(req, *entry)
+                return
 
-            # Create the page.
-            send(req, ctype, out)
-        except IOError as exc:
+        try:
+            # Static files are only opened if the client
+            # copy is not valid.
+            stat = os.stat(path)
+            etag = file_etag(stat)
+            if not_modified(req, etag, stat.st_mtime):
+                send_not_modified(req, etag, req.date_time_string(stat.st_mtime))
+                return
+            mode = 'r' if ctype.startswith('text/') else 'rb'
+            ifp = open(path, mode)
+        except (IOError, OSError) as exc:
             req.send_error(404, 'File not found {0}'.format(exc))
+            return
+
+        with ifp:
+            if cache is not None and cache.cacheable(stat.st_size):
+                # Small static files are read once and then sent
+                # from the file cache.
+                stat = os.fstat(ifp.fileno())
+                data = ifp.read()
+                info = file_info(req, ctype, stat)
+                cache.store(path, stat, data, info)
+                send_cached_file(req, data, info)
+            else:
+                # Static files are sent directly from the file.
+                send_file(req, ctype, ifp)
 
     def url_webinfo(req, opts, logger):
         '''
@@ -559,9 +1085,8 @@ def request_handler(req):
         '''
         Special dispatched URL: /system/name.
         '''
-        # run uname -a, capture the output and display it
-        sts, out = runcmd('uname -a')
-        send(req, 'text/plain', out)
+        # run uname -a and display the output
+        send_cmd(req, 'text/plain', 'uname -a', ('uname -a', ))
 
     def url_redirect1(req, opts, logger, path):
         '''
@@ -615,6 +1140,10 @@ def request_handler(req):
         # If the content-type parameter is not specified
         # then display the output as plain text.
         #
+        # The output is sent as it is produced so long running
+        # scripts show progress and the output is never held
+        # in memory, unless it is cached (--exec-cache-ttl).
+        #
         # Here is an example:
         #   localhost:8080/scripts/make_page.sh?content-type=text/html
         if 'content-type' in req.m_params:
@@ -626,8 +1155,11 @@ def request_handler(req):
         req.m_urlpath = req.m_urlpath[:-1]
 
         if os.path.isfile(req.m_syspath):
-            sts, out = runcmd(req.m_syspath)
-            send(req, ctype, out)
+            # The cached output depends on the script version
+            # and the URL parameters.
+            params = tuple((key, tuple(val)) for key, val in sorted(req.m_params.items()))
+            key = (req.m_syspath, os.path.getmtime(req.m_syspath), params)
+            send_cmd(req, ctype, req.m_syspath, key)
         else:
             req.send_error(404, 'Not found: "{0}"'.format(req.m_syspath))
 
@@ -638,79 +1170,96 @@ def request_handler(req):
         # If control reaches this point, this is not a special
         # case, the user specified a directory or file to
         # handle.
-        if os.path.exists(req.m_syspath) is False:
+        # The web directory index knows whether it exists, whether
+        # it is a directory and which index file to use.
+        entry = req.ws_get_path_index().lookup(req.m_syspath)
+        if entry is None:
             req.send_error(404, 'Not found {0}'.format(req.m_syspath))  # path must exist
             return
 
-        if os.path.isdir(req.m_syspath) is True:
-            # This is a directory.
-            # See if index files are there.
-            sysfile = None
-            for index in ['index.html', 'index.htm', 'default.htm', ]:
-                path = os.path.join(req.m_syspath, index)
-                if os.path.exists(path) is True:
-                    sysfile = path
-                    break
-
-            # Special case, if this is a directory with no
-            # index files, display the directory contents.
-            if sysfile is None:
-                display_directory(req)
-                return
+        # Special case, if this is a directory with no
+        # index files, display the directory contents.
+        if entry['file'] is None:
+            display_directory(req)
+            return
 
-            req.m_syspath = sysfile
+        req.m_syspath = entry['file']
 
         # Process templates or non-templates.
         if template(req, logger) is False:
-            display_file(req, opts, logger, req.m_syspath)
+            display_file(req, opts, logger, req.m_syspath, entry['ctype'])
 
     def url_dispatcher(req, opts, logger):
         '''
         Dispatch the special urls to functions.
         '''
-        global ws_globals
-        logger.debug('REQUEST PATH {0}'.format(req.path))
+        # The log messages are only formatted if debug logging is on.
+        logger.debug('REQUEST PATH %s', req.path)
+
+        route = req.ws_get_routes().match(req.m_urlpath)
+        if route is not None:
+            function, args, kwargs = route
+            logger.debug('URL DISPATCH "%s" "%s".', function.__name__, req.m_urlpath)
+            function(req, opts, logger, *args, **kwargs)
+            return
+
+        url_general_dispatch(req, opts, logger)
+
+    class DefaultPlugin(object):
+        '''
+        The plugin object.
+        '''
+        def on_start(self, server):
+            '''
+            Set up the shared state once per process.
+            '''
+            init_globals(server.ws_opts)
 
-        if 'url_dispatch' not in ws_globals:
             # Add in the url dispatches for the 'special' URLs.
-            # This is done here to avoid re-compiling them every
-            # time a request is handled.
+            # The route table compiles them.
             # The first argument is the URL pattern to match.
-            # The second argument is the name of the dispatch function.
+            # The second argument is the dispatch function.
             # The dispatch function has 3 fixed arguments plus the arguments
             # defined in the re.
             # Example:
-            #    (re.compile('/foo/([^/]+)/([^/]+)/?'), 'url_func'), # <-- dispatch: 2 args: arg1, arg2
+            #    (r'^/foo/([^/]+)/([^/]+)/?$', url_func), # <-- dispatch: 2 args: arg1, arg2
             #
             #    def url_func(req, opts, logger, arg1, arg2): ...
-            ws_globals['url_dispatch'] = (
-                (re.compile(r'^/webserver/info/?$'), url_webinfo),
-                (re.compile(r'^/system/name/?$'), url_sysname),
-                (re.compile('^/redirect/to/(https?)/(.+)$'), url_redirect2),
-                (re.compile('^/redirect/to(/.+)$'), url_redirect1),
-                (re.compile('^(.+)@$'), url_dir),
-                (re.compile('^(.+)!$'), url_exec),
-            )
-
-        for dispatch in ws_globals['url_dispatch']:
-            regex = dispatch[0]
-            function = dispatch[1]  # function name
-            match = regex.search(req.m_urlpath)
-            logger.debug('URL_DISPATCH DEBUG "{0}" "{1}" "{2}"'.format(req.m_urlpath, regex.pattern, function.__name__))
-            if match:
-                args = match.groups()
-                kwargs = match.groupdict()
-                logger.debug('URL DISPATCH "{0}" "{1}".'.format(function.__name__, req.m_urlpath))
-                function(req, opts, logger, *args, **kwargs)
+            #
+            # Routes added by the plugin register_routes(routes)
+            # function come first.
+            server.ws_routes.add_group('default', (
+                (r'^/webserver/info/?$', url_webinfo),
+                (r'^/system/name/?$', url_sysname),
+                (r'^/redirect/to/(https?)/(.+)$', url_redirect2),
+                (r'^/redirect/to(/.+)$', url_redirect1),
+                (r'^(.+)@$', url_dir),
+                (r'^(.+)!$', url_exec),
+            ))
+
+        def on_worker_start(self, server):
+            '''
+            Set up the state of a thread that handles requests.
+            '''
+            pass
+
+        def handle(self, req):
+            '''
+            Handle a request.
+            '''
+            logger = req.ws_get_logger()
+            opts = req.ws_get_opts()
+            if not init(req, opts, logger):
                 return
+            # nocache(req)  # test
+            url_dispatcher(req, opts, logger)
 
-        url_general_dispatch(req, opts, logger)
+        def on_shutdown(self, server):
+            '''
+            Release the shared state.
+            '''
+            pass
 
-    # Main.
-    logger = req.ws_get_logger()
-    opts = req.ws_get_opts()
-    init(req, opts, logger)
-    # nocache(req)  # test
-    url_dispatcher(req, opts, logger)
+    return DefaultPlugin()
 
 
@@ -0,0 +1,45 @@
+'''
+# Plugin with lifecycle hooks.
+#
+# The counters show how many times each hook was called.
+'''
+import threading
+
+
+class Plugin(object):
+    '''
+    The plugin object.
+    '''
+    def __init__(self):
+        self.m_lock = threading.Lock()
+        self.m_starts = 0
+        self.m_workers = 0
+        self.m_requests = 0
+
+    def on_start(self, server):
+        '''
+        Called once before the server accepts requests.
+        '''
+        self.m_starts += 1
+
+    def on_worker_start(self, server):
+        '''
+        Called once in each thread that handles requests.
+        '''
+        with self.m_lock:
+            self.m_workers += 1
+
+    def handle(self, req):
+        '''
+        Report the counters.
+        '''
+        with self.m_lock:
+            self.m_requests += 1
+            body = 'starts={0} workers={1} requests={2}\n'.format(self.m_starts,
+                                                                self.m_workers,
+                                                                self.m_requests)
+        req.send_response(200)
+        req.send_header('Content-type', 'text/plain')
+        req.send_header('Content-length', str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
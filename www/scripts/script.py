@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+#
+# Generate HTML for display.
+#
+import sys
+
+sys.stdout.write('''<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>WebServer Test Script</title>
+  </head>
+  <body>
+    <p>Hello, world!</p>
+    <pre>{0}</pre>
+  </body>
+</html>
+'''.format(' '.join(sys.argv[1:])))